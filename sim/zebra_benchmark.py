@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Zebra benchmarks against the simulator: arm latency, download throughput, collect_pages() cost
+
+Start the simulator first, then run the benchmark against the same prefix:
+    python sim/zebra_ioc.py --prefix 'SIM:ZEBRA:' &
+    python sim/zebra_benchmark.py --prefix 'SIM:ZEBRA:' --points 100000
+
+The Zebra device is loaded from startup/26-zebra.py.
+"""
+
+import argparse
+import os
+import runpy
+import time
+
+import numpy as np
+from ophyd import EpicsSignal
+
+
+STARTUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'startup')
+
+
+def load_zebra(prefix):
+    ns = runpy.run_path(os.path.join(STARTUP, '26-zebra.py'))
+    zebra = ns['Zebra'](prefix, name='zebra')
+    # The simulator only serves position capture and the encoders, not the
+    # soft inputs, pulses, outputs, gates and dividers
+    for dev in [zebra.pos_capt, zebra.reset, zebra.download_status] + list(zebra.encoder.values()):
+        dev.wait_for_connection(timeout=10)
+    return zebra, ns
+
+
+def setup_scan(zebra, points, master=0, offset=1, **kwargs):
+    # One capture per 1 unit gate, starting offset units ahead of the master
+    start = zebra.encoder[master+1].motor_pos.get() + offset
+    zebra.setup(master=master, arm_source=0, gate_start=start, gate_width=0.5, gate_step=1,
+                num_gates=points, direction=0, pulse_width=0.5, pulse_step=1, capt_delay=0,
+                max_pulses=1, collect=[True, False, False, False], **kwargs)
+
+
+def bench_setup(zebra):
+    print('Setup')
+    setup_scan(zebra, 10, reset=True)
+    tFull = zebra.timing['setup']
+    # Next scans only move the gate start
+    setup_scan(zebra, 10, offset=2)
+    tReadback = zebra.timing['setup']
+    setup_scan(zebra, 10, offset=3, useCache=True)
+    tCache = zebra.timing['setup']
+    print('  full {:8.1f} ms, gate start only: read back {:8.1f} ms, cached {:8.1f} ms'.format(
+        1e3*tFull, 1e3*tReadback, 1e3*tCache))
+
+
+def bench_arm(zebra, n=10):
+    print('Arm latency')
+    latency = []
+    for _ in range(n):
+        setup_scan(zebra, 1, verbose=False)
+        t0 = time.perf_counter()
+        zebra.kickoff().wait(10)
+        latency.append(time.perf_counter() - t0)
+        zebra.complete().wait(10)
+    latency = 1e3*np.array(latency)
+    print('  {} arms, median {:.1f} ms, max {:.1f} ms'.format(n, np.median(latency), latency.max()))
+
+
+def bench_download(zebra, ns, points, speed, poll=0.2):
+    print('Download, {} points'.format(points))
+    EpicsSignal(zebra.prefix + 'SIM_SPEED', name='speed').put(speed, wait=True)
+    setup_scan(zebra, points, verbose=False)
+
+    t0 = time.perf_counter()
+    zebra.kickoff().wait(10)
+    done = zebra.complete()
+    nPages = nPoints = 0
+    tCollect = 0.0
+    while True:
+        finished = done.done
+        t1 = time.perf_counter()
+        for page in zebra.collect_pages():
+            nPages += 1
+            nPoints += len(page['time'])
+        tCollect += time.perf_counter() - t1
+        if finished:
+            break
+        time.sleep(poll)
+    tTotal = time.perf_counter() - t0
+    capture = zebra._capture
+    print('  incremental: {} points in {} pages, {} reads, {:.2f} M elements transferred'.format(
+        nPoints, nPages, capture.reads, capture.transferred/1e6))
+    print('  transferred {:.2f} elements per point and waveform'.format(
+        capture.transferred/max(nPoints*len(capture.signals), 1)))
+    print('  run {:.2f} s, collect {:.1f} ms total'.format(tTotal, 1e3*tCollect))
+
+    t1 = time.perf_counter()
+    full = ns['ZebraCaptureBuffer']({'time': zebra.pos_capt.data.time,
+                                     'enc1': zebra.pos_capt.data.enc1},
+                                    counter=zebra.pos_capt.data.num_downloaded)
+    full.update(force=True)
+    tFull = time.perf_counter() - t1
+    print('  full read after the run: {} points, {:.1f} ms, {:.2f} M points/s'.format(
+        full.n, 1e3*tFull, full.n/tFull/1e6 if tFull else np.nan))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--prefix', default='SIM:ZEBRA:')
+    parser.add_argument('--points', type=int, default=100000)
+    parser.add_argument('--speed', type=float, default=50000, help='Master speed [units/s]')
+    args = parser.parse_args()
+
+    zebra, ns = load_zebra(args.prefix)
+    bench_setup(zebra)
+    bench_arm(zebra)
+    bench_download(zebra, ns, args.points, args.speed)
+    print('Collect')
+    ns['zebra_collect_benchmark'](n=args.points, nEnc=1)
+
+
+if __name__ == '__main__':
+    main()
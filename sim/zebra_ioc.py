@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Zebra position compare simulator
+
+A caproto IOC with the position capture PVs of a Zebra, as used by the Zebra
+device in startup/26-zebra.py: the PC_ARM/GATE/PULSE registers, ARM_OUT,
+ARRAY_ACQ, the PC_TIME/PC_ENCn waveforms with their .NORD, PC_NUM_CAP and
+PC_NUM_DOWN, and the POSn_SET/Mn:SETPOS encoder sync. Setpoint registers have
+a :RBV readback. The soft inputs, pulses, outputs, gates and dividers are not
+served.
+
+When armed, the master encoder (PC_ENC) moves at SIM_SPEED in the PC_DIR
+direction from its current position. Gates and pulses are generated from
+this trajectory, by position or by time as selected, and a capture is made
+at each pulse plus PC_PULSE_DLY. Captures count up in PC_NUM_CAP as they
+happen; every SIM_DOWNLOAD_PERIOD the arrays are published and PC_NUM_DOWN
+is updated, like the IOC downloading from the box. After the last gate the
+box disarms and ARRAY_ACQ drops to 0. External arming is emulated with
+PC_ARM as well.
+
+Usage:
+    python sim/zebra_ioc.py --list-pvs
+    python sim/zebra_ioc.py --prefix 'SIM:ZEBRA:'
+
+Do not serve the prefix of a real Zebra on the beamline network.
+
+See sim/zebra_benchmark.py for arm latency, download and collect benchmarks.
+"""
+
+import asyncio
+import time
+
+import numpy as np
+from caproto import ChannelDouble, ChannelEnum, ChannelInteger, ChannelString
+from caproto.server import ioc_arg_parser, run
+
+
+ENCODERS = range(1, 5)
+
+# Enum registers
+PC_ENC_STRINGS = ['Enc1', 'Enc2', 'Enc3', 'Enc4', 'Enc1-4Av']
+PC_DIR_STRINGS = ['Positive', 'Negative']
+PC_TSPRE_STRINGS = ['ms', 's', '10s']
+PC_TSPRE_UNITS = {'ms': 1e-3, 's': 1.0, '10s': 10.0}
+PC_ARM_SEL_STRINGS = ['Soft', 'External']
+PC_SEL_STRINGS = ['Position', 'Time', 'External']
+
+
+class _Register:
+    """
+    Channel mixin that calls the simulator on writes and mirrors the value to a :RBV channel
+    """
+
+    def __init__(self, *args, rbv=None, on_write=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rbv = rbv
+        self.on_write = on_write
+
+    async def verify_value(self, value):
+        value = await super().verify_value(value)
+        if self.on_write is not None:
+            await self.on_write(value)
+        if self.rbv is not None:
+            await self.rbv.write(value)
+        return value
+
+
+class RegisterDouble(_Register, ChannelDouble):
+    pass
+
+
+class RegisterInteger(_Register, ChannelInteger):
+    pass
+
+
+class RegisterEnum(_Register, ChannelEnum):
+    pass
+
+
+class ZebraSim:
+    """
+    Zebra position capture simulator, see the module docstring
+
+    Parameters
+    ----------
+
+    prefix: PV prefix, e.g. 'SIM:ZEBRA:'
+    maxPoints: Length of the capture waveforms, default = 100000
+    period: Simulation loop period [s], default = 0.005
+    """
+
+    def __init__(self, prefix, maxPoints=100000, period=0.005):
+        self.prefix = prefix
+        self.maxPoints = maxPoints
+        self.period = period
+        self.pv = {}
+
+        self.motor = np.zeros(5)      # Motor positions by encoder index, 0 unused
+        self.posRef = np.zeros(5)     # Zebra position at the last sync ...
+        self.motorRef = np.zeros(5)   # ... and the motor position then
+
+        self.armed = False
+        self._tArm = None
+        self._tEnd = None
+        self._captures = None         # {'time': ..., 'enc1': ...}, all captures of the armed run
+        self._tCaptures = None        # Capture times [s after arm]
+        self._numCap = 0
+        self._numDown = 0
+        self._tDownload = 0.0
+        self._trajectory = None       # (encoder, zebra position at arm, signed speed)
+
+        self._build()
+
+    # PV database
+
+    def _add(self, name, channel):
+        self.pv[name] = channel
+        return channel
+
+    def _register(self, name, cls, value, on_write=None, **kwargs):
+        rbvCls = {RegisterDouble: ChannelDouble, RegisterInteger: ChannelInteger,
+                  RegisterEnum: ChannelEnum}[cls]
+        rbv = self._add(name + ':RBV', rbvCls(value=value, **kwargs))
+        return self._add(name, cls(value=value, rbv=rbv, on_write=on_write, **kwargs))
+
+    def _input(self, name):
+        # Input address register with its string and status
+        self._register(name + '_INP', RegisterInteger, 0)
+        self._add(name + '_INP:STR', ChannelString(value='DISCONNECT'))
+        self._add(name + '_INP:STA', ChannelInteger(value=0))
+
+    def _build(self):
+        reg = self._register
+
+        self._add('SYS_RESET.PROC', RegisterInteger(value=0, on_write=self._reset))
+
+        # Position capture selection
+        reg('PC_ENC', RegisterEnum, 'Enc1', enum_strings=PC_ENC_STRINGS)
+        reg('PC_DIR', RegisterEnum, 'Positive', enum_strings=PC_DIR_STRINGS)
+        reg('PC_TSPRE', RegisterEnum, 'ms', enum_strings=PC_TSPRE_STRINGS)
+        for b in range(10):
+            self._add(f'PC_BIT_CAP:B{b}', RegisterInteger(value=int(b < 4)))
+
+        # Arm
+        reg('PC_ARM_SEL', RegisterEnum, 'Soft', enum_strings=PC_ARM_SEL_STRINGS)
+        self._input('PC_ARM')
+        self._add('PC_ARM_OUT', ChannelInteger(value=0))
+        self._add('PC_ARM', RegisterInteger(value=0, on_write=self._arm))
+        self._add('PC_DISARM', RegisterInteger(value=0, on_write=self._disarm))
+
+        # Gate
+        reg('PC_GATE_SEL', RegisterEnum, 'Position', enum_strings=PC_SEL_STRINGS)
+        self._input('PC_GATE')
+        self._add('PC_GATE_OUT', ChannelInteger(value=0))
+        self._add('PC_GATE_NGATE', RegisterInteger(value=1))
+        for name in ('START', 'WID', 'STEP'):
+            self._add('PC_GATE_' + name, RegisterDouble(value=0.0, precision=4))
+
+        # Pulse
+        reg('PC_PULSE_SEL', RegisterEnum, 'Time', enum_strings=PC_SEL_STRINGS)
+        self._input('PC_PULSE')
+        self._add('PC_PULSE_OUT', ChannelInteger(value=0))
+        self._add('PC_PULSE_MAX', RegisterInteger(value=1))
+        for name in ('START', 'WID', 'STEP', 'DLY'):
+            self._add('PC_PULSE_' + name, RegisterDouble(value=0.0, precision=4))
+
+        # Captured data
+        self._add('ARRAY_ACQ', ChannelInteger(value=0))
+        self._add('PC_NUM_CAP', ChannelInteger(value=0))
+        self._add('PC_NUM_DOWN', ChannelInteger(value=0))
+        for name in (['TIME'] + [f'ENC{i}' for i in ENCODERS] + ['SYS1', 'SYS2'] +
+                     [f'DIV{i}' for i in ENCODERS]):
+            self._add('PC_' + name, ChannelDouble(value=[], max_length=self.maxPoints))
+            self._add('PC_' + name + '.NORD', ChannelInteger(value=0))
+
+        # Encoders
+        for i in ENCODERS:
+            self._add(f'M{i}:RBV', ChannelDouble(value=0.0, precision=4))
+            self._add(f'POS{i}_SET', RegisterDouble(value=0.0, precision=4,
+                                                    on_write=self._pos_set(i)))
+            self._add(f'M{i}:MRES', RegisterDouble(value=1.0, precision=6))
+            self._add(f'M{i}:OFF', RegisterDouble(value=0.0, precision=4))
+            self._add(f'M{i}:SETPOS.PROC', RegisterInteger(value=0, on_write=self._copy_pos(i)))
+
+        # Simulation parameters
+        self._add('SIM_SPEED', RegisterDouble(value=100.0, units='/s', precision=3))
+        self._add('SIM_DOWNLOAD_PERIOD', RegisterDouble(value=0.1, units='s', precision=3))
+
+        self.pvdb = {self.prefix + name: channel for name, channel in self.pv.items()}
+
+    def value(self, name):
+        return self.pv[name].value
+
+    def enum(self, name):
+        # Enum registers may hold the index or the string
+        value = self.pv[name].value
+        return self.pv[name].enum_strings[value] if isinstance(value, int) else value
+
+    # Encoders
+
+    def zebra_position(self, i, motor=None):
+        motor = self.motor[i] if motor is None else motor
+        return self.posRef[i] + motor - self.motorRef[i]
+
+    def _pos_set(self, i):
+        async def on_write(value):
+            self.posRef[i] = value
+            self.motorRef[i] = self.motor[i]
+        return on_write
+
+    def _copy_pos(self, i):
+        async def on_write(value):
+            await self.pv[f'POS{i}_SET'].write(float(self.motor[i]))
+        return on_write
+
+    # Commands
+
+    async def _reset(self, value):
+        await self._stop(download=False)
+        await self._clear()
+
+    async def _clear(self):
+        self._captures = None
+        self._numCap = self._numDown = 0
+        await self.pv['PC_NUM_CAP'].write(0)
+        await self.pv['PC_NUM_DOWN'].write(0)
+        for name in ['TIME'] + [f'ENC{i}' for i in ENCODERS]:
+            await self._write_array('PC_' + name, [])
+
+    async def _arm(self, value):
+        if self.armed:
+            return
+        await self._clear()
+        self._captures, self._tEnd = self.plan_captures()
+        self._tCaptures = self._captures['time']*PC_TSPRE_UNITS[self.enum('PC_TSPRE')]
+        self._tArm = self._tDownload = time.monotonic()
+        self.armed = True
+        await self.pv['ARRAY_ACQ'].write(1)
+        await self.pv['PC_ARM_OUT'].write(1)
+        await self.pv['PC_ARM_INP:STA'].write(1)
+
+    async def _disarm(self, value):
+        await self._stop()
+
+    async def _stop(self, download=True):
+        if not self.armed:
+            return
+        self.armed = False
+        self._trajectory = None
+        await self.pv['PC_ARM_OUT'].write(0)
+        await self.pv['PC_ARM_INP:STA'].write(0)
+        await self.pv['PC_GATE_OUT'].write(0)
+        if download:
+            await self._download()
+        await self.pv['ARRAY_ACQ'].write(0)
+
+    # Gate and pulse generation
+
+    def plan_captures(self):
+        """
+        Computes all captures of a run from the registers and the master trajectory
+
+        Returns ({'time': [time units], 'enc1': ...}, run length [s])
+        """
+        unit = PC_TSPRE_UNITS[self.enum('PC_TSPRE')]
+        master = min(PC_ENC_STRINGS.index(self.enum('PC_ENC')), 3) + 1
+        sign = -1.0 if self.enum('PC_DIR') == 'Negative' else 1.0
+        speed = max(abs(self.value('SIM_SPEED')), 1e-9)
+        x0 = self.zebra_position(master)
+        self._trajectory = (master, x0, sign*speed)
+
+        nGates = max(int(self.value('PC_GATE_NGATE')), 0)
+        start, width, step = (self.value('PC_GATE_' + k) for k in ('START', 'WID', 'STEP'))
+        n = np.arange(nGates)
+
+        if self.enum('PC_GATE_SEL') == 'Time':
+            tOpen = (start + n*step)*unit
+            tClose = tOpen + width*unit
+        else:
+            # Position gates open when the master crosses start + n*step in the scan direction
+            tOpen = sign*(start + sign*n*step - x0)/speed
+            tClose = tOpen + width/speed
+        keep = tOpen >= 0
+        tOpen, tClose = tOpen[keep], tClose[keep]
+        tEnd = float(tClose.max()) if len(tClose) else 0.0
+
+        pStart, pStep = self.value('PC_PULSE_START'), self.value('PC_PULSE_STEP')
+        maxPulses = max(int(self.value('PC_PULSE_MAX')), 1)
+        delay = self.value('PC_PULSE_DLY')*unit
+        if self.enum('PC_PULSE_SEL') == 'Position':
+            scale = 1/speed
+        else:
+            scale = unit
+        gateLength = float((tClose - tOpen).max()) if len(tOpen) else 0.0
+        nPulses = maxPulses if pStep <= 0 else min(maxPulses, int(gateLength/(pStep*scale)) + 1)
+        rel = (pStart + np.arange(nPulses)*pStep)*scale
+
+        t = tOpen[:, None] + rel[None, :]
+        valid = t < tClose[:, None]
+        t = t[valid] + delay
+        t = np.sort(t)[:self.maxPoints]
+
+        captures = {'time': t/unit}
+        for i in ENCODERS:
+            if i == master:
+                captures[f'enc{i}'] = x0 + sign*speed*t
+            else:
+                captures[f'enc{i}'] = np.full(len(t), self.zebra_position(i))
+        return captures, max(tEnd, float(t.max()) if len(t) else 0.0)
+
+    async def _write_array(self, name, values):
+        # Waveform first, so its NORD never counts elements not yet posted
+        await self.pv[name].write(values)
+        await self.pv[name + '.NORD'].write(len(values))
+
+    async def _download(self):
+        self._tDownload = time.monotonic()
+        if self._captures is None or self._numCap <= self._numDown:
+            return
+        n = self._numCap
+        await self._write_array('PC_TIME', self._captures['time'][:n])
+        for i in ENCODERS:
+            await self._write_array(f'PC_ENC{i}', self._captures[f'enc{i}'][:n])
+        self._numDown = n
+        await self.pv['PC_NUM_DOWN'].write(n)
+
+    async def step(self):
+        if not self.armed:
+            return
+        elapsed = time.monotonic() - self._tArm
+
+        # Master motor follows the trajectory while armed
+        master, x0, velocity = self._trajectory
+        tMove = min(elapsed, self._tEnd)
+        self.motor[master] = self.motorRef[master] + x0 - self.posRef[master] + velocity*tMove
+        await self.pv[f'M{master}:RBV'].write(float(self.motor[master]))
+
+        numCap = int(np.searchsorted(self._tCaptures, elapsed, side='right'))
+        if numCap != self._numCap:
+            self._numCap = numCap
+            await self.pv['PC_NUM_CAP'].write(numCap)
+
+        if elapsed >= self._tEnd:
+            await self._stop()
+        elif time.monotonic() - self._tDownload >= self.value('SIM_DOWNLOAD_PERIOD'):
+            await self._download()
+
+    async def loop(self):
+        while True:
+            await asyncio.sleep(self.period)
+            await self.step()
+
+
+if __name__ == '__main__':
+    ioc_options, run_options = ioc_arg_parser(
+        default_prefix='SIM:ZEBRA:',
+        desc='Zebra position compare simulator')
+    sim = ZebraSim(ioc_options['prefix'])
+
+    async def startup_hook(async_lib):
+        asyncio.get_running_loop().create_task(sim.loop())
+
+    run(sim.pvdb, startup_hook=startup_hook, **run_options)
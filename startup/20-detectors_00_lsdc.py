@@ -3,6 +3,11 @@ from ophyd import (SingleTrigger, ProsilicaDetector,
                    TransformPlugin, ProcessPlugin, AreaDetector)
 
 from ophyd import Component as Cpt
+from contextlib import contextmanager
+import time
+import numpy as np
+import bluesky.preprocessors as bpp
+import bluesky.plan_stubs as bps
 
 keithley = EpicsSignalRO('XF:17IDC-BI:FMX{Keith:1}readFloat', name='keithley')
 
@@ -44,3 +49,156 @@ for camera in all_standard_pros:
     camera.tiff.read_attrs = []
 
 cam_fs2.stats1.total.kind = 'hinted'
+
+
+# Read profiles: which stats are read on every trigger
+# 'minimal' reads only the fields passed along, e.g. 'stats4_sigma_x'
+
+PROSILICA_READ_PROFILES = {
+    'minimal': [],
+    'centroid': ['stats4.total', 'stats4.centroid.x', 'stats4.centroid.y'],
+    'full': ['stats1.total', 'stats1.centroid.x', 'stats1.centroid.y',
+             'stats2.total', 'stats2.centroid.x', 'stats2.centroid.y',
+             'stats3.total', 'stats3.centroid.x', 'stats3.centroid.y',
+             'stats4.total', 'stats4.centroid.x', 'stats4.centroid.y', 'stats4.sigma_x', 'stats4.sigma_y',
+             'stats5.total', 'stats5.centroid.x', 'stats5.centroid.y'],
+}
+
+PROSILICA_STATS = ['stats1', 'stats2', 'stats3', 'stats4', 'stats5']
+
+
+def read_profile_attr(camera, field):
+    """
+    Returns the attribute path of a data key or field, e.g. 'stats4_sigma_x' -> 'stats4.sigma_x'
+    """
+    if field.startswith(camera.name + '_'):
+        field = field[len(camera.name) + 1:]
+    if '.' in field:
+        return field
+    plugin, attr = field.split('_', 1)
+    if attr.startswith('centroid_'):
+        attr = 'centroid.' + attr[len('centroid_'):]
+    return plugin + '.' + attr
+
+
+def read_profile_apply(camera, profile='minimal', fields=(), disablePlugins=True):
+    """
+    Sets camera read_attrs, kinds and stats plugin enables for a read profile
+
+    fields are read in any profile and hinted. With disablePlugins, stats
+    plugins that are not read are disabled. Returns the state for
+    read_profile_restore().
+    """
+    if profile not in PROSILICA_READ_PROFILES:
+        raise ValueError('profile must be one of: {}'.format(', '.join(PROSILICA_READ_PROFILES)))
+    if isinstance(fields, str):
+        fields = [fields]
+    hinted = [read_profile_attr(camera, field) for field in fields]
+    attrs = PROSILICA_READ_PROFILES[profile] + [a for a in hinted if a not in PROSILICA_READ_PROFILES[profile]]
+    if not attrs:
+        raise ValueError("Read profile 'minimal' needs fields, e.g. 'stats4_sigma_x'")
+
+    state = {'read_attrs': list(camera.read_attrs),
+             'kinds': {a: getattr(camera, a).kind for a in hinted},
+             'enables': {}}
+
+    camera.read_attrs = attrs
+    for a in hinted:
+        getattr(camera, a).kind = 'hinted'
+
+    if disablePlugins:
+        used = {a.split('.')[0] for a in attrs}
+        for plugin in PROSILICA_STATS:
+            if plugin not in used:
+                enable = getattr(camera, plugin).enable
+                state['enables'][plugin] = enable.get()
+        statuses = [getattr(camera, plugin).enable.set('Disable') for plugin in state['enables']]
+        for st in statuses:
+            st.wait(5)
+
+    return state
+
+
+def read_profile_restore(camera, state):
+    """
+    Restores camera read_attrs, kinds and stats plugin enables saved by read_profile_apply()
+    """
+    statuses = [getattr(camera, plugin).enable.set(value) for plugin, value in state['enables'].items()]
+    for a, kind in state['kinds'].items():
+        getattr(camera, a).kind = kind
+    camera.read_attrs = state['read_attrs']
+    for st in statuses:
+        st.wait(5)
+
+
+@contextmanager
+def read_profile(camera, profile='minimal', fields=(), disablePlugins=True):
+    """
+    Context manager to read a camera with a read profile, restored afterward
+
+    camera: StandardProsilica, e.g. cam_8
+    profile: One of 'minimal', 'centroid', 'full', default = 'minimal'
+    fields: Data keys or fields to read and hint, e.g. 'stats4_sigma_x'
+    disablePlugins: Disable stats plugins that are not read, default = True
+
+    Examples:
+    with read_profile(cam_8, 'minimal', 'stats4_sigma_x'):
+        RE(bp.scan([cam_8], gonio.gx, -10, 10, 11))
+    with read_profile(cam_7, 'centroid'):
+        RE(bp.count([cam_7], 10))
+    """
+    state = read_profile_apply(camera, profile, fields, disablePlugins)
+    try:
+        yield camera
+    finally:
+        read_profile_restore(camera, state)
+
+
+def read_profile_wrapper(plan, camera, profile='minimal', fields=(), disablePlugins=True):
+    """
+    Runs plan with a camera read profile, applied when the plan starts and restored at its end
+
+    Examples:
+    yield from read_profile_wrapper(bp.scan([cam_8], gonio.gx, -10, 10, 11), cam_8, fields='stats4_sigma_x')
+
+    @read_profile_decorator(cam_8, 'centroid')
+    def plan():
+        ...
+    """
+    state = {}
+
+    def inner():
+        state.update(read_profile_apply(camera, profile, fields, disablePlugins))
+        return (yield from plan)
+
+    def restore():
+        if state:
+            read_profile_restore(camera, state)
+        yield from bps.null()
+
+    return (yield from bpp.finalize_wrapper(inner(), restore()))
+
+
+read_profile_decorator = bpp.make_decorator(read_profile_wrapper)
+
+
+def read_profile_benchmark(camera, fields='stats4_sigma_x', n=20):
+    """
+    Prints the per point read latency of a camera for each read profile
+
+    Times camera.read(), the part of a scan point after the acquisition.
+    fields are added to every profile.
+
+    Examples:
+    read_profile_benchmark(cam_8)
+    """
+    for profile in PROSILICA_READ_PROFILES:
+        with read_profile(camera, profile, fields):
+            camera.read()
+            t = np.zeros(n)
+            for i in range(n):
+                t0 = time.perf_counter()
+                reading = camera.read()
+                t[i] = time.perf_counter() - t0
+        print('{:8s} {:3d} values, read {:.2f} ms (median of {})'.format(
+            profile, len(reading), 1e3*np.median(t), n))
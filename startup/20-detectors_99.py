@@ -1,4 +1,8 @@
 import ophyd.areadetector.cam as cam # Is this used anywhere?
+import glob
+import time
+import h5py
+import dask.array
 
 from ophyd.areadetector.filestore_mixins import (FileStoreTIFFIterativeWrite,
                                                  FileStoreHDF5IterativeWrite)
@@ -12,6 +16,126 @@ class StandardProsilicaWithTIFF(StandardProsilica):
                write_path_template='/tmp/',
                root='/tmp')
 
+
+# HDF5: all frames of a run in one file, with Resource/Datum documents
+
+PROSILICA_HDF5_ROOT = '/nsls2/data/fmx/shared'
+PROSILICA_HDF5_PATH = PROSILICA_HDF5_ROOT + '/cameras/%Y/%m/%d/'
+
+
+class HDF5PluginWithFileStore(HDF5Plugin, FileStoreHDF5IterativeWrite):
+    """
+    HDF5 plugin streaming all frames of a run into one chunked, compressed file
+
+    One frame per chunk, so a single frame reads without decompressing others.
+    zlib needs no HDF5 filter plugins on the reading side. Resources use the
+    AD_HDF5_LAZY spec, read by AreaDetectorHDF5LazyHandler.
+    """
+
+    def __init__(self, *args, compression='zlib', zlevel=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.filestore_spec = 'AD_HDF5_LAZY'
+        self.stage_sigs.update([('compression', compression),
+                                ('zlevel', zlevel),
+                                ('num_row_chunks', 0),    # 0: whole frame
+                                ('num_col_chunks', 0),
+                                ('num_frames_chunks', 1)])
+        self.stage_sigs.move_to_end('capture')
+
+
+class StandardProsilicaWithHDF5(StandardProsilica):
+    hdf5 = Cpt(HDF5PluginWithFileStore,
+               suffix='HDF1:',
+               write_path_template=PROSILICA_HDF5_PATH,
+               root=PROSILICA_HDF5_ROOT)
+
+
+class AreaDetectorHDF5LazyHandler:
+    """
+    Databroker handler for AD_HDF5_LAZY resources returning lazy dask arrays
+
+    Frames are only read from the file when the array is computed or sliced.
+    The file is reopened if a point beyond the frames seen so far is
+    requested, e.g. while the run is still being written. Arrays are squeezed
+    like those of the standard AD_HDF5 handler, so one frame per point is 2D.
+    """
+    spec = 'AD_HDF5_LAZY'
+
+    def __init__(self, filename, frame_per_point=1):
+        self._filename = filename
+        self._fpp = frame_per_point
+        self._file = None
+        self._dataset = None
+
+    def _open(self):
+        self.close()
+        self._file = h5py.File(self._filename, 'r')
+        self._dataset = self._file['entry/data/data']
+
+    def __call__(self, point_number):
+        start = point_number*self._fpp
+        if self._dataset is None or start + self._fpp > self._dataset.shape[0]:
+            self._open()
+        frames = dask.array.from_array(self._dataset, chunks=(1,) + self._dataset.shape[1:])
+        return frames[start:start + self._fpp].squeeze()
+
+    def get_file_list(self, datum_kwarg_gen):
+        return [self._filename]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._dataset = None
+
+
+db.reg.register_handler(AreaDetectorHDF5LazyHandler.spec, AreaDetectorHDF5LazyHandler, overwrite=True)
+
+cam_fs4_hdf5 = StandardProsilicaWithHDF5('XF:17IDC-BI:FMX{FS:4-Cam:1}', name='cam_fs4_hdf5')
+cam_7_hdf5 = StandardProsilicaWithHDF5('XF:17IDC-ES:FMX{Cam:7}', name='cam_7_hdf5')
+cam_8_hdf5 = StandardProsilicaWithHDF5('XF:17IDC-ES:FMX{Cam:8}', name='cam_8_hdf5')
+
+all_standard_pros_hdf5 = [cam_fs4_hdf5, cam_7_hdf5, cam_8_hdf5]
+for camera in all_standard_pros_hdf5:
+    camera.read_attrs = ['stats4', 'hdf5']
+    camera.stats4.read_attrs = ['total', 'centroid', 'sigma_x', 'sigma_y']
+    camera.stats4.centroid.read_attrs = ['x', 'y']
+    camera.tiff.read_attrs = []
+    camera.hdf5.read_attrs = []  # leaving just the 'image'
+
+
+def frame_files_benchmark(tiffFiles=None, h5File=None):
+    """
+    Prints the read throughput of a TIFF series and of an HDF5 frame file
+
+    tiffFiles: List of TIFF files, or a glob pattern
+    h5File: HDF5 file written by the AD HDF5 plugin
+
+    Examples:
+    frame_files_benchmark(tiffFiles='/tmp/focus_*.tif', h5File='/tmp/focus_000000.h5')
+    """
+    import tifffile
+
+    if isinstance(tiffFiles, str):
+        tiffFiles = sorted(glob.glob(tiffFiles))
+
+    if tiffFiles:
+        t0 = time.perf_counter()
+        nBytes = sum(tifffile.imread(f).nbytes for f in tiffFiles)
+        dt = time.perf_counter() - t0
+        print('TIFF: {} files, {:.0f} frames/s, {:.1f} MB/s'.format(
+            len(tiffFiles), len(tiffFiles)/dt, nBytes/dt/1e6))
+
+    if h5File:
+        t0 = time.perf_counter()
+        with h5py.File(h5File, 'r') as f:
+            dataset = f['entry/data/data']
+            nFrames = dataset.shape[0]
+            nBytes = sum(dataset[i].nbytes for i in range(nFrames))
+        dt = time.perf_counter() - t0
+        print('HDF5: 1 file, {} frames, {:.0f} frames/s, {:.1f} MB/s'.format(
+            nFrames, nFrames/dt, nBytes/dt/1e6))
+
 #cam_fs1_tiff = StandardProsilicaWithTIFF('XF:17IDA-BI:FMX{FS:1-Cam:1}', name='cam_fs1_tiff')
 #cam_mono_tiff = StandardProsilicaWithTIFF('XF:17IDA-BI:FMX{Mono:DCM-Cam:1}', name='cam_mono_tiff')
 #cam_fs2_tiff = StandardProsilicaWithTIFF('XF:17IDA-BI:FMX{FS:2-Cam:1}', name='cam_fs2_tiff')
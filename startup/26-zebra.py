@@ -2,11 +2,14 @@ from enum import IntEnum
 
 from ophyd import (Device, Component as Cpt, FormattedComponent as FC,
                    Signal)
-from ophyd import (EpicsSignal, EpicsSignalRO, DeviceStatus)
+from ophyd import (EpicsSignal, EpicsSignalRO, DeviceStatus, Kind)
 from ophyd.utils import set_and_wait
 from bluesky.plans import fly
+import numpy as np
 import pandas as pd
 
+import json
+import math
 import uuid
 import time
 import datetime as dt
@@ -328,6 +331,27 @@ class ZebraGate(Device):
         set_and_wait(self.input2.edge, int(edge2))
 
 
+class ZebraDivider(Device):
+    input_addr = Cpt(ZebraSignalWithRBV, 'INP')
+    input_str = Cpt(EpicsSignalRO, 'INP:STR', string=True)
+    input_status = Cpt(EpicsSignalRO, 'INP:STA')
+    divisor = Cpt(ZebraSignalWithRBV, 'DIV')
+    output_divided = Cpt(EpicsSignalRO, 'OUTD')
+    output_not_divided = Cpt(EpicsSignalRO, 'OUTN')
+
+    def __init__(self, prefix, *, index=None, read_attrs=None,
+                 configuration_attrs=None, **kwargs):
+        self.index = index
+
+        if read_attrs is None:
+            read_attrs = ['output_divided', 'output_not_divided']
+        if configuration_attrs is None:
+            configuration_attrs = ['input_addr', 'divisor']
+
+        super().__init__(prefix, configuration_attrs=configuration_attrs,
+                         read_attrs=read_attrs, **kwargs)
+
+
 class ZebraPositionCaptureDeviceBase(Device):
     source = Cpt(ZebraSignalWithRBV, 'SEL', put_complete=True)
     input_addr = Cpt(ZebraSignalWithRBV, 'INP')
@@ -365,6 +389,9 @@ class ZebraPositionCaptureArm(ZebraPositionCaptureDeviceBase):
     def __init__(self, prefix, *, parent=None,
                  configuration_attrs=None, read_attrs=None, **kwargs):
 
+        if configuration_attrs is None:
+            configuration_attrs = ['source', 'input_addr']
+
         self._parent_prefix = parent.prefix
 
         super().__init__(prefix, read_attrs=read_attrs,
@@ -506,6 +533,11 @@ class ZebraBase(Device):
     gate3 = Cpt(ZebraGate, 'GATE3_', index=3)
     gate4 = Cpt(ZebraGate, 'GATE4_', index=4)
 
+    divider1 = Cpt(ZebraDivider, 'DIV1_', index=1)
+    divider2 = Cpt(ZebraDivider, 'DIV2_', index=2)
+    divider3 = Cpt(ZebraDivider, 'DIV3_', index=3)
+    divider4 = Cpt(ZebraDivider, 'DIV4_', index=4)
+
     encoder1 = Cpt(ZebraEncoder, '', index=1)
     encoder2 = Cpt(ZebraEncoder, '', index=2)
     encoder3 = Cpt(ZebraEncoder, '', index=3)
@@ -517,6 +549,16 @@ class ZebraBase(Device):
 
     addresses = ZebraAddresses
 
+    # Enum registers that are read and written as strings
+    _string_registers = ('pos_capt.time_units', 'pos_capt.gate.source', 'pos_capt.pulse.source')
+
+    # Configuration signals that are commands or states rather than settings
+    _config_exclude = ('sync', 'delay_sync', 'write_output', 'write_input', 'output',
+                       'soft_input1', 'soft_input2', 'soft_input3', 'soft_input4')
+
+    # Register names ending in these are parameters, written after the selection registers
+    _config_parameters = ('start', 'width', 'step', 'num_gates', 'max_pulses', 'delay')
+
     def __init__(self, prefix, *, configuration_attrs=None, read_attrs=None,
                  **kwargs):
         if read_attrs is None:
@@ -527,6 +569,7 @@ class ZebraBase(Device):
                 [f'pulse{i}' for i in range(1,5)] +
                 [f'output{i}' for i in range(1,9)] +
                 [f'gate{i}' for i in range(1,5)] +
+                [f'divider{i}' for i in range(1,5)] +
                 [f'encoder{i}' for i in range(1,5)] +
                 ['pos_capt']
             )
@@ -537,8 +580,172 @@ class ZebraBase(Device):
         self.pulse = dict(self._get_indexed_devices(ZebraPulse))
         self.output = dict(self._get_indexed_devices(ZebraOutputBase))
         self.gate = dict(self._get_indexed_devices(ZebraGate))
+        self.divider = dict(self._get_indexed_devices(ZebraDivider))
         self.encoder = dict(self._get_indexed_devices(ZebraEncoder))
 
+        self._config_cache = None  # {register name: last value written}
+        self.timing = {}
+
+    def invalidate_config(self):
+        """
+        Forgets the cached configuration, the next Zebra.setup(useCache=True) reads the box
+
+        Call this after the box was configured by other means, e.g. from CSS or caput,
+        when setup() is used with useCache=True.
+        """
+        self._config_cache = None
+
+    def _signal(self, name):
+        obj = self
+        for attr in name.split('.'):
+            obj = getattr(obj, attr)
+        return obj
+
+    def read_config(self, names):
+        """
+        Reads the current values of the registers names, returns {name: value}
+        """
+        config = {}
+        for name in names:
+            if name in self._string_registers:
+                value = self._signal(name).get(as_string=True)
+            else:
+                value = self._signal(name).get()
+            config[name] = value.item() if hasattr(value, 'item') else value
+        return config
+
+    @staticmethod
+    def _config_equal(current, value, tol=1e-9):
+        if current is None:
+            return False
+        if isinstance(value, str) or isinstance(current, str):
+            return str(current) == str(value)
+        return math.isclose(current, value, rel_tol=tol, abs_tol=tol)
+
+    def _put_concurrently(self, values, timeout=10):
+        """
+        Writes {name: value} with put completion callbacks, then waits for all of them
+        """
+        statuses = []
+        for name, value in values.items():
+            status = DeviceStatus(self, timeout=timeout)
+            self._signal(name).put(value, use_complete=True,
+                                   callback=lambda *args, status=status, **kwargs: status._finished())
+            statuses.append((name, status))
+
+        failed = []
+        for name, status in statuses:
+            try:
+                status.wait(timeout)
+            except Exception:
+                failed.append(name)
+        if failed:
+            raise RuntimeError('Zebra write failed for: ' + ', '.join(failed))
+
+    def config_names(self):
+        """
+        Returns the names of all writable configuration registers, e.g. 'pulse1.width'
+        """
+        names = []
+        for walk in self.walk_signals(include_lazy=True):
+            sig, name = walk.item, walk.dotted_name
+            if not sig.kind & Kind.config or isinstance(sig, EpicsSignalRO):
+                continue
+            if name.split('.')[-1] in self._config_exclude:
+                continue
+            names.append(name)
+        return names
+
+    def config_snapshot(self, names=None):
+        """
+        Reads the configuration registers, returns {name: value}
+
+        names: Registers to read, default = config_names()
+        """
+        return self.read_config(self.config_names() if names is None else names)
+
+    def _config_groups(self, config):
+        # Selection registers, then parameters, then the outputs
+        groups = [{}, {}, {}]
+        for name, value in config.items():
+            if name.startswith('output'):
+                groups[2][name] = value
+            elif name.split('.')[-1] in self._config_parameters:
+                groups[1][name] = value
+            else:
+                groups[0][name] = value
+        return groups
+
+    def config_apply(self, config, verify=True, settleTime=0.5, verbose=True):
+        """
+        Writes a configuration {name: value}, returns True on success
+
+        Registers are compared with the values read from the box and only the
+        changed ones are written, concurrently in groups: selection registers,
+        then parameters, then output routing. Encoders with registers in config
+        are synchronized to their motors last, after settleTime if their
+        resolution or offset changed. If a write fails or a register reads back
+        wrong, the changed registers are restored. An armed position capture,
+        e.g. left by an aborted scan, is disarmed first, as in Zebra.setup().
+
+        config: {name: value}, names as in config_names(), may be a subset
+        verify: Read back the written registers, default = True
+        settleTime: Wait after encoder resolution or offset changes [s], default = 0.5
+        verbose: Print the number of registers written and the timing, default = True
+        """
+        names = set(self.config_names())
+        unknown = [name for name in config if name not in names]
+        if unknown:
+            print('Not Zebra configuration registers:', ', '.join(unknown))
+            return False
+
+        t0 = time.perf_counter()
+        if self.pos_capt.arm.output.get():
+            self.pos_capt.arm.disarm.put(1, wait=True)
+        current = self.read_config(config)
+        changed = {name: value for name, value in config.items()
+                   if not self._config_equal(current[name], value)}
+        groups = self._config_groups(changed)
+        tRead = time.perf_counter() - t0
+
+        failed = []
+        for group in groups:
+            try:
+                self._put_concurrently(group)
+            except RuntimeError as e:
+                failed.append(str(e))
+                break
+        if not failed and verify and changed:
+            readback = self.read_config(changed)
+            wrong = [name for name, value in changed.items()
+                     if not self._config_equal(readback[name], value, tol=1e-6)]
+            if wrong:
+                failed.append('Zebra read back wrong for: ' + ', '.join(wrong))
+
+        if failed:
+            print(failed[0])
+            self.invalidate_config()
+            try:
+                for group in reversed(groups):
+                    self._put_concurrently({name: current[name] for name in group})
+                print('Zebra configuration rolled back.')
+            except RuntimeError as e:
+                print('Zebra rollback failed, check the box.', e)
+            return False
+
+        encoders = sorted({int(name[len('encoder')]) for name in config if name.startswith('encoder')})
+        if any(name.startswith('encoder') for name in changed):
+            time.sleep(settleTime)
+        self._put_concurrently({f'encoder{i}._copy_pos_signal': 1 for i in encoders})
+
+        if self._config_cache is not None:
+            self._config_cache.update(changed)
+        self.timing = {'apply': time.perf_counter() - t0, 'read': tRead, 'changed': len(changed)}
+        if verbose:
+            print('Zebra configuration: {} of {} registers written, read {:.0f} ms, total {:.0f} ms'.format(
+                len(changed), len(config), 1e3*tRead, 1e3*self.timing['apply']))
+        return True
+
     def _get_indexed_devices(self, cls):
         for attr in self._sub_devices:
             dev = getattr(self, attr)
@@ -552,23 +759,192 @@ class ZebraBase(Device):
         return status
 
 
+# Largest number of points per event page. With uids and all four encoders a
+# page stays below the 1 MB default Kafka message size.
+ZEBRA_PAGE_SIZE = 5000
+
+
+def zebra_event_pages(t, data, timestamps=None, pageSize=ZEBRA_PAGE_SIZE):
+    """
+    Yields event pages {'time', 'data', 'timestamps'} of at most pageSize points
+
+    t: Array of event times
+    data: {name: array}, all as long as t
+    timestamps: Array of timestamps for all data, default = t
+    """
+    t = np.asarray(t, dtype=float)
+    timestamps = t if timestamps is None else np.asarray(timestamps, dtype=float)
+    data = {k: np.asarray(v) for k, v in data.items()}
+    for i in range(0, len(t), pageSize):
+        j = i + pageSize
+        ts = timestamps[i:j]
+        yield {
+            'time': t[i:j],
+            'data': {k: v[i:j] for k, v in data.items()},
+            'timestamps': {k: ts for k in data},
+        }
+
+
+def zebra_page_events(pages):
+    """
+    Yields one event {'time', 'data', 'timestamps'} per point of the event pages
+
+    For comparisons only. Flyers implement collect_pages() alone, bluesky
+    warns on every collect if a flyer has both collect() and collect_pages().
+    """
+    for page in pages:
+        for i, t in enumerate(page['time']):
+            yield {
+                'data': {k: v[i] for k, v in page['data'].items()},
+                'timestamps': {k: v[i] for k, v in page['timestamps'].items()},
+                'time': t,
+            }
+
+
+def zebra_collect_benchmark(n=100000, nEnc=4, pageSize=ZEBRA_PAGE_SIZE):
+    """
+    Compares per-point events and event pages for a simulated capture of n points
+
+    Examples:
+    zebra_collect_benchmark()
+    zebra_collect_benchmark(n=10000, nEnc=1)
+    """
+    t = time.time() + np.arange(n)*1e-3
+    data = {f'enc{i}': np.cumsum(np.random.normal(size=n)) for i in range(1, nEnc+1)}
+
+    t0 = time.perf_counter()
+    events = list(zebra_page_events([{'time': t, 'data': data, 'timestamps': {k: t for k in data}}]))
+    tEvents = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    pages = list(zebra_event_pages(t, data, pageSize=pageSize))
+    tPages = time.perf_counter() - t0
+
+    print('{} points, {} encoders'.format(n, nEnc))
+    print('  events: {:8d} documents {:10.1f} ms'.format(len(events), 1e3*tEvents))
+    print('  pages:  {:8d} documents {:10.1f} ms'.format(len(pages), 1e3*tPages))
+    return {'events': tEvents, 'pages': tPages}
+
+
+class ZebraCaptureBuffer:
+    """
+    Appends the new elements of growing waveform signals to preallocated buffers
+
+    update() reads the element counter, e.g. NUM_DOWN, and only when it
+    advanced reads the waveforms up to it and copies the new elements into
+    the buffers, which double in size when full. Reads are limited to the
+    elements each waveform has posted, its NORD field, since elements beyond
+    it may be stale or zero padding. Channel Access cannot read an array from
+    an offset, so each read transfers elements 0..n. To keep the transfer
+    linear, the waveforms are only read again once the count has at least
+    doubled since the last read, unless forced: the reads of a run then
+    transfer at most 2n elements, plus n for a final forced read. Buffer
+    memory and copying are linear in the number of points as well.
+
+    Parameters
+    ----------
+
+    signals: {name: waveform signal}
+    counter: Signal with the number of valid elements, default = None (NORD only)
+    size: Initial buffer length, default = 1000
+
+    Examples
+    --------
+
+    buf = ZebraCaptureBuffer({'time': zebra3.pos_capt.data.time}, counter=zebra3.pos_capt.data.num_downloaded)
+    buf.update()
+    buf.update(force=True)  # After the download finished
+    buf.arrays()
+    """
+
+    def __init__(self, signals, counter=None, size=1000):
+        self.signals = signals
+        self.counter = counter
+        self._nord = {name: EpicsSignalRO(sig.pvname + '.NORD', name=sig.name + '_nord')
+                      for name, sig in signals.items()}
+        self._buffers = {name: np.empty(max(int(size), 1)) for name in signals}
+        self.n = 0
+        self.reads = 0
+        self.transferred = 0  # Elements read over CA
+
+    def _reserve(self, n):
+        size = len(next(iter(self._buffers.values())))
+        if n <= size:
+            return
+        while size < n:
+            size *= 2
+        for name, old in self._buffers.items():
+            self._buffers[name] = np.empty(size)
+            self._buffers[name][:self.n] = old[:self.n]
+
+    def update(self, force=False):
+        """
+        Fetches the new elements, returns their number
+
+        force: Read any new elements, not only once their count doubled, default = False
+        """
+        # Fewer elements than this are not worth a read yet
+        need = self.n + 1 if force else max(2*self.n, 1)
+        if self.counter is not None:
+            count = int(self.counter.get(use_monitor=False))
+            if count < need:
+                return 0
+        else:
+            count = np.inf
+
+        # Elements posted, read before the waveforms so none beyond them are used
+        count = min([count] + [int(nord.get(use_monitor=False)) for nord in self._nord.values()])
+        if count < need:
+            return 0
+
+        values = {name: np.atleast_1d(np.asarray(sig.get(use_monitor=False, count=count), dtype=float))
+                  for name, sig in self.signals.items()}
+        self.reads += 1
+        self.transferred += sum(len(v) for v in values.values())
+
+        n = min([count] + [len(v) for v in values.values()])
+        if n <= self.n:
+            return 0
+        self._reserve(n)
+        for name, v in values.items():
+            self._buffers[name][self.n:n] = v[self.n:n]
+        nNew, self.n = n - self.n, n
+        return nNew
+
+    def arrays(self, start=0, stop=None):
+        """
+        Returns {name: array} of the buffered elements start..stop, as views
+        """
+        stop = self.n if stop is None else min(stop, self.n)
+        return {name: b[start:stop] for name, b in self._buffers.items()}
+
+
 class Zebra(ZebraBase):
 
     def __init__(self, prefix, *args, **kwargs):
         self._collection_ts = None
         self._disarmed_status = None
         self._dl_status = None
+        self._capture = None
+        self._collected = 0
         super().__init__(prefix, *args, **kwargs)
 
     def setup(self, master, arm_source, gate_start, gate_width, gate_step, num_gates,
               direction, pulse_width, pulse_step, capt_delay, max_pulses,
-              collect=[True, True, True, True]):
+              collect=[True, True, True, True], reset=False, useCache=False, verbose=True):
 
         # arm_source is either 0 (soft) or 1 (external)
         # direction is either 0 (positive) or 1 (negative)
         # gate_* parameters in motor units
         # pulse_*, capt_delay parameters in ms
         # collect represents which of the four encoders to collect data from
+        # Only registers that differ from the values read back from the box are
+        # written, so settings made by other clients (mx_flyer, LSDC, CSS) are
+        # taken into account.
+        # reset: reset the box and write all registers, default = False
+        # useCache: diff against the values this session last wrote instead of
+        #   reading the box, faster for repeated scans when no other client
+        #   changes the box, default = False. Reads the box if the cache is empty.
 
         # Sanity checks
         if master not in range(4):
@@ -586,42 +962,82 @@ class Zebra(ZebraBase):
         if pulse_width > pulse_step:
             raise ValueError('pulse_width must be smaller than pulse_step')
 
-        # Reset Zebra state
-        self.reset.put(1, wait=True)
-        time.sleep(0.1)
-
-        pc = self.pos_capt
-        
-        pc.arm.source.put(arm_source, wait=True)
-
-        pc.time_units.put("ms", wait=True)
-        pc.gate.source.put("Position", wait=True)
-        pc.pulse.source.put("Time", wait=True)
-
-        # Setup which encoders to capture
-        for encoder, do_capture in zip((pc.capture_enc1, pc.capture_enc2, pc.capture_enc3, pc.capture_enc4), collect):
-            encoder.put(int(do_capture), wait=True)
-
-        # Configure Position Capture
-        pc.source.put(master, wait=True)
-        pc.direction.put(direction, wait=True)
-
-        # Configure Position Capture Gate
-        pc.gate.start.put(gate_start, wait=True)
-        pc.gate.width.put(gate_width, wait=True)
-        pc.gate.step.put(gate_step, wait=True)
-        pc.gate.num_gates.put(num_gates, wait=True)
-
-        # Configure Position Capture Pulses
-        pc.pulse.start.put(0, wait=True)
-        pc.pulse.step.put(pulse_step, wait=True)
-        pc.pulse.width.put(pulse_width, wait=True)
-        pc.pulse.delay.put(capt_delay, wait=True)
-        pc.pulse.max_pulses.put(max_pulses, wait=True)
-
-        # Synchronize encoders (do it last)
-        for encoder in self.encoder.values():
-            encoder.copy_position()
+        groups = self.setup_config(master, arm_source, gate_start, gate_width, gate_step,
+                                   num_gates, direction, pulse_width, pulse_step, capt_delay,
+                                   max_pulses, collect)
+        t0 = time.perf_counter()
+
+        if reset:
+            # Reset Zebra state, the registers are then written unconditionally
+            self.invalidate_config()
+            self.reset.put(1, wait=True)
+            time.sleep(0.1)
+            current = {}
+        else:
+            # A scan that was aborted may have left position capture armed
+            if self.pos_capt.arm.output.get():
+                self.pos_capt.arm.disarm.put(1, wait=True)
+            if useCache and self._config_cache is not None:
+                current = self._config_cache
+            else:
+                names = [name for group in groups for name in group]
+                current = self.read_config(names)
+                self._config_cache = dict(self._config_cache or {}, **current)
+
+        nChanged = 0
+        try:
+            for group in groups:
+                changed = {name: value for name, value in group.items()
+                           if not self._config_equal(current.get(name), value)}
+                self._put_concurrently(changed)
+                self._config_cache = dict(self._config_cache or {}, **changed)
+                nChanged += len(changed)
+
+            # Synchronize encoders (do it last)
+            self._put_concurrently({f'encoder{i}._copy_pos_signal': 1 for i in self.encoder})
+        except Exception:
+            self.invalidate_config()
+            raise
+
+        self.timing = {'setup': time.perf_counter() - t0, 'changed': nChanged, 'reset': reset}
+        if verbose:
+            print('Zebra setup: {} registers written{}, {:.0f} ms'.format(
+                nChanged, ' after reset' if reset else '', 1e3*self.timing['setup']))
+
+    @staticmethod
+    def setup_config(master, arm_source, gate_start, gate_width, gate_step, num_gates,
+                     direction, pulse_width, pulse_step, capt_delay, max_pulses,
+                     collect=[True, True, True, True]):
+        """
+        Returns the position capture registers for setup() as [{name: value}]
+
+        Each group is written concurrently once the group before it completed.
+        Sources, units and direction come first, since they define how the box
+        interprets the gate and pulse parameters.
+        """
+        selection = {
+            'pos_capt.arm.source': arm_source,
+            'pos_capt.time_units': 'ms',
+            'pos_capt.gate.source': 'Position',
+            'pos_capt.pulse.source': 'Time',
+            'pos_capt.source': master,
+            'pos_capt.direction': direction,
+        }
+        for i, do_capture in enumerate(collect, start=1):
+            selection[f'pos_capt.capture_enc{i}'] = int(do_capture)
+
+        parameters = {
+            'pos_capt.gate.start': gate_start,
+            'pos_capt.gate.width': gate_width,
+            'pos_capt.gate.step': gate_step,
+            'pos_capt.gate.num_gates': num_gates,
+            'pos_capt.pulse.start': 0,
+            'pos_capt.pulse.step': pulse_step,
+            'pos_capt.pulse.width': pulse_width,
+            'pos_capt.pulse.delay': capt_delay,
+            'pos_capt.pulse.max_pulses': max_pulses,
+        }
+        return [selection, parameters]
 
     def kickoff(self):
         armed_status = DeviceStatus(self)
@@ -638,6 +1054,8 @@ class Zebra(ZebraBase):
         disarmed_signal = self.download_status
 
         self._collection_ts = time.time()
+        self._capture = self._capture_buffer()
+        self._collected = 0
 
         def armed_status_cb(value, old_value, obj, **kwargs):
             if int(old_value) == 0 and int(value) == 1:
@@ -662,25 +1080,31 @@ class Zebra(ZebraBase):
     def complete(self):
         return self._disarmed_status
 
-    def collect(self):
+    def _capture_buffer(self):
         pc = self.pos_capt
 
-        # Array of timestamps
-        ts = pc.data.time.get() + self._collection_ts
-
-        # Arrays of captured positions
-        data = {
-            f'enc{i}': getattr(pc.data, f'enc{i}').get()
+        # Time and the captured positions
+        signals = {'time': pc.data.time}
+        signals.update({
+            f'enc{i}': getattr(pc.data, f'enc{i}')
                 for i in range(1,5)
                 if getattr(pc, f'capture_enc{i}').get()
-        }
+        })
 
-        for i, timestamp in enumerate(ts):
-            yield {
-                'data': { k: v[i] for k, v in data.items() },
-                'timestamps': { k: timestamp for k in data.keys() },
-                'time' : timestamp
-            }
+        size = (self._config_cache or {}).get('pos_capt.gate.num_gates', 1000)
+        return ZebraCaptureBuffer(signals, counter=pc.data.num_downloaded, size=size)
+
+    def collect_pages(self):
+        # Only the points downloaded since the last collect, all of them once the download is done
+        if self._capture is None:
+            self._capture = self._capture_buffer()
+            self._collected = 0
+        self._capture.update(force=self._disarmed_status is None or self._disarmed_status.done)
+
+        data = self._capture.arrays(self._collected)
+        self._collected = self._capture.n
+        ts = data.pop('time') + self._collection_ts
+        yield from zebra_event_pages(ts, data)
 
     def describe_collect(self):
         return {
@@ -695,4 +1119,175 @@ class Zebra(ZebraBase):
 
 # zebra1 = Zebra('XF:17IDA-ES:FMX{Zeb:1}:', name='zebra1')
 # zebra2 = Zebra('XF:17IDC-ES:FMX{Zeb:2}:', name='zebra2')
-# zebra3 = Zebra('XF:17IDC-ES:FMX{Zeb:3}:', name='zebra3')
+zebra3 = Zebra('XF:17IDC-ES:FMX{Zeb:3}:', name='zebra3')
+
+
+# Named Zebra configurations
+#
+# A preset is {register name: value} with names as in ZebraBase.config_names().
+# Presets saved with zebra_preset_save() are complete snapshots of a box; the
+# presets below only hold the registers that the chip scanner modes change.
+# Saved presets take precedence over these.
+
+ZEBRA_PRESET_FILE = '/nsls2/data/fmx/shared/config/fmx_bluesky_config/zebra_presets.json'
+
+_ZEBRA_CHIP_SCANNER = {
+    'pos_capt.source': 0,  # Enc1
+    'pos_capt.arm.source': 0,  # Soft
+    'pos_capt.gate.source': 'Position',
+    'pos_capt.pulse.source': 'Time',
+    'pos_capt.pulse.start': 1,
+    'pos_capt.pulse.width': 4,
+    'pos_capt.pulse.step': 10,
+    'pos_capt.pulse.max_pulses': 1,
+    'encoder1.encoder_res': 0.01,
+}
+
+ZEBRA_PRESETS = {
+    'chip_scanner': _ZEBRA_CHIP_SCANNER,
+    'chip_scanner_droplets_scheme_1': dict(_ZEBRA_CHIP_SCANNER, **{
+        'divider1.input_addr': int(ZebraAddresses.PC_PULSE),
+        'divider1.divisor': 2,
+        'output1.ttl.addr': int(ZebraAddresses.DIV1_OUTD),
+        'output3.ttl.addr': int(ZebraAddresses.DIV1_OUTN),
+    }),
+    'hare': {
+        'output1.ttl.addr': int(ZebraAddresses.IN3_TTL),
+        'output3.ttl.addr': int(ZebraAddresses.IN4_TTL),
+    },
+}
+
+
+def zebra_presets_read():
+    """
+    Returns the saved Zebra presets as {name: {'time': ..., 'prefix': ..., 'config': {...}}}
+
+    Returns an empty dict if the preset file does not exist or cannot be read.
+    """
+    try:
+        with open(ZEBRA_PRESET_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def zebra_preset_get(name):
+    """
+    Returns the configuration of preset name, saved or built in, or None
+    """
+    saved = zebra_presets_read()
+    if name in saved:
+        return saved[name]['config']
+    return ZEBRA_PRESETS.get(name)
+
+
+def zebra_preset_list():
+    """
+    Prints the saved and built-in Zebra presets
+    """
+    saved = zebra_presets_read()
+    for name, preset in sorted(saved.items()):
+        print('{:32s} {:4d} registers, saved {} from {}'.format(
+            name, len(preset['config']),
+            dt.datetime.fromtimestamp(preset['time']).strftime('%Y-%m-%d %H:%M'), preset['prefix']))
+    for name, config in sorted(ZEBRA_PRESETS.items()):
+        if name not in saved:
+            print('{:32s} {:4d} registers, built in'.format(name, len(config)))
+
+
+def zebra_preset_save(name, zebra=zebra3, names=None):
+    """
+    Saves the current configuration of a Zebra as preset name
+
+    Parameters
+    ----------
+
+    name: Preset name, e.g. 'rotation'
+    zebra: Zebra device, default = zebra3
+    names: Registers to save, default = all configuration registers
+
+    Examples
+    --------
+
+    zebra_preset_save('rotation')
+    """
+    presets = zebra_presets_read()
+    presets[name] = {'time': time.time(), 'prefix': zebra.prefix,
+                     'config': zebra.config_snapshot(names)}
+    try:
+        with open(ZEBRA_PRESET_FILE, 'w') as f:
+            json.dump(presets, f, indent=1)
+    except OSError as e:
+        print('Could not write Zebra presets {}: {}'.format(ZEBRA_PRESET_FILE, e))
+        return -1
+    log_fmx('Zebra preset {} saved from {}, {} registers'.format(name, zebra.prefix, len(presets[name]['config'])))
+
+
+def zebra_preset_diff(a, b='current', zebra=zebra3):
+    """
+    Prints and returns the registers that differ between two presets as {name: (value a, value b)}
+
+    a, b: Preset names, configuration dicts, or 'current' for the registers read from zebra.
+          Only registers present in both are compared.
+
+    Examples
+    --------
+
+    zebra_preset_diff('rotation')
+    zebra_preset_diff('rotation', 'chip_scanner')
+    """
+    configs = []
+    for preset in (a, b):
+        if isinstance(preset, dict):
+            configs.append(preset)
+        elif preset != 'current':
+            config = zebra_preset_get(preset)
+            if config is None:
+                print('No Zebra preset', preset)
+                return -1
+            configs.append(config)
+        else:
+            configs.append(None)
+    given = [c for c in configs if c is not None]
+    if not given:
+        names = zebra.config_names()
+    else:
+        names = [n for n in given[0] if all(n in c for c in given)]
+    configs = [zebra.config_snapshot(names) if c is None else c for c in configs]
+
+    diff = {n: (configs[0][n], configs[1][n]) for n in names
+            if not ZebraBase._config_equal(configs[0][n], configs[1][n], tol=1e-6)}
+    for n, (va, vb) in diff.items():
+        print('{:32s} {!s:>12} {!s:>12}'.format(n, va, vb))
+    print('{} of {} registers differ'.format(len(diff), len(names)))
+    return diff
+
+
+def zebra_preset_apply(name, zebra=zebra3, verify=True):
+    """
+    Applies Zebra preset name, see ZebraBase.config_apply(), returns True on success
+
+    Only the registers that differ are written, concurrently; on a failed
+    write or readback the previous values are restored.
+
+    Parameters
+    ----------
+
+    name: Preset name or configuration dict
+    zebra: Zebra device, default = zebra3
+    verify: Read back the written registers, default = True
+
+    Examples
+    --------
+
+    zebra_preset_apply('chip_scanner')
+    zebra_preset_apply('rotation')
+    """
+    config = name if isinstance(name, dict) else zebra_preset_get(name)
+    if config is None:
+        print('No Zebra preset', name)
+        return False
+    ok = zebra.config_apply(config, verify=verify)
+    if ok and not isinstance(name, dict):
+        log_fmx('Zebra preset {} applied to {}'.format(name, zebra.prefix))
+    return ok
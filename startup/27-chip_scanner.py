@@ -28,17 +28,8 @@ acceleration_time = 5
 
 
 def configure_zebra_for_chip_scanner():
-    zebra.pc.encoder.put(0)
-    zebra.pc.arm.trig_source.put(0)
-    zebra.pc.gate.sel.put(0)
-    zebra.pc.pulse.sel.put(1)
-    zebra.pc.pulse.start.put(1)
-    zebra.pc.pulse.width.put(4)
-    zebra.pc.pulse.step.put(10)
-    zebra.pc.pulse.max.put(1)
-    epics.caput("XF:17IDC-ES:FMX{Zeb:3}:M1:MRES", 0.01)
-    time.sleep(0.5)
-    epics.caput("XF:17IDC-ES:FMX{Zeb:3}:M1:SETPOS.PROC", 1)
+    if not zebra_preset_apply('chip_scanner'):
+        raise Exception('Zebra configuration for the chip scanner failed')
 
 
 class ppmac_input(Device):
@@ -353,26 +344,29 @@ class ChipScanner(Device):
             sizes = self.hi_camera.roi1.size.get()
             self.ROI_centers = [int(mins.min_y + sizes.y/2), int(mins.min_x + sizes.x/2)]
 
-        hi_image = self.hi_camera.image.image
+        # Full frames are saved for diagnostics, the fiducial is found in the crop around the ROI center
+        hi_image = camera_frame(self.hi_camera)
         with open(f'hi_pictures/hcam{int(time.time()*10)}.npy', 'wb') as f:
             np.save(f, hi_image)
 
-        d2d = np.sum(hi_image, axis=2)[self.ROI_centers[0]-100:self.ROI_centers[0]+100, self.ROI_centers[1]-100:self.ROI_centers[1]+100]
+        d2d = hi_image[self.ROI_centers[0]-100:self.ROI_centers[0]+100, self.ROI_centers[1]-100:self.ROI_centers[1]+100]
 
         blurred_image = scipy.ndimage.gaussian_filter(d2d, 8, truncate=3.0)
         with open(f'hi_pictures/blurred{int(time.time()*10)}.npy', 'wb') as f:
-            np.save(f, hi_image)
+            np.save(f, blurred_image)
         center_y, center_x = np.unravel_index(np.argmax(blurred_image, axis=None), blurred_image.shape)
 
         dx_mot =  MagCal * (center_x - int(focus_size/2))
         dy_mot =  -MagCal * (center_y - int(focus_size/2))
         print(d2d, center_y, center_x, dx_mot, dy_mot)
         yield from bps.mvr(self.x, dx_mot, self.y, dy_mot)
+        id_moved = self.hi_camera.image.array_counter.get()
         with open(f'hi_pictures/hcam{int(time.time()*10)}.npy', 'wb') as f:
-            np.save(f, hi_image)
+            np.save(f, camera_frame(self.hi_camera, after_id=id_moved))
         yield from bps.sleep(0.5)
+        id_settled = self.hi_camera.image.array_counter.get()
         with open(f'hi_pictures/hcam{int(time.time()*10)}.npy', 'wb') as f:
-            np.save(f, hi_image)
+            np.save(f, camera_frame(self.hi_camera, after_id=id_settled))
 
     def name_to_fiducial_distances(self, location_name):
         """Given a location name of the form @#&& where @ is a capital
@@ -692,8 +686,8 @@ class ChipScanner(Device):
         self.scan_and_cleanup(xl, yl, dwell_list, dl, cl, enc_loc, expose_to_beam=expose_to_beam, transition_before=transition_before, transition_after=transition_after, detector_status=detector_status, control_detector = control_detector)
         
     def configure_zebra_for_hare(self):
-        epics.caput("XF:17IDC-ES:FMX{Zeb:3}:OUT1_TTL", 7)
-        epics.caput("XF:17IDC-ES:FMX{Zeb:3}:OUT3_TTL", 10)
+        if not zebra_preset_apply('hare'):
+            raise Exception('Zebra configuration for HARE failed')
 
     def check_camera_settings(self, camera):
         if camera.cam.acquire_time.get() > 0.1:
@@ -796,14 +790,16 @@ def autofocus(camera, stats, motor, start, end, steps, move2Focus=True, max_repe
         bec_table_enabled = bec._table_enabled
         bec.disable_table()
 
-    fig, ax1 = plt.subplots()
+    fig, ax1 = figure_manager.subplots('autofocus')
     ax1.grid(True)
 
     stats_name = "_".join((camera.name,stats))
-    @bpp.subs_decorator(LivePlot(stats_name, motor.name, ax=ax1))
-    @bpp.subs_decorator(LiveTable([motor.name, stats_name], default_prec=5))
+    @bpp.subs_decorator(LivePlotThrottled(stats_name, motor.name, ax=ax1))
+    @bpp.subs_decorator(LiveTableBatched([motor.name, stats_name], default_prec=5))
     def inner(camera, motor, start, end, steps):
-        uid = yield from bp.relative_scan([camera], motor, start, end, steps)
+        # Only read the focus figure of merit
+        uid = yield from read_profile_wrapper(bp.relative_scan([camera], motor, start, end, steps),
+                                              camera, 'minimal', stats)
         return uid
 
     # Find minimum
@@ -896,21 +892,8 @@ def chip_all_blocks(wait_time = 20):
 
 
 def configure_zebra_for_chip_scanner_with_droplets_scheme_1():
-    zebra.pc.encoder.put(0)
-    zebra.pc.arm.trig_source.put(0)
-    zebra.pc.gate.sel.put(0)
-    zebra.pc.pulse.sel.put(1)
-    zebra.pc.pulse.start.put(1)
-    zebra.pc.pulse.width.put(4)
-    zebra.pc.pulse.step.put(10)
-    zebra.pc.pulse.max.put(1)
-    epics.caput("XF:17IDC-ES:FMX{Zeb:3}:M1:MRES", 0.01)
-    time.sleep(0.5)
-    epics.caput("XF:17IDC-ES:FMX{Zeb:3}:M1:SETPOS.PROC", 1)
-    epics.caput("XF:17IDC-ES:FMX{Zeb:3}:DIV1_INP", 31)
-    epics.caput("XF:17IDC-ES:FMX{Zeb:3}:DIV1_DIV", 2)
-    epics.caput("XF:17IDC-ES:FMX{Zeb:3}:OUT1_TTL", 44)
-    epics.caput("XF:17IDC-ES:FMX{Zeb:3}:OUT3_TTL", 48)
+    if not zebra_preset_apply('chip_scanner_droplets_scheme_1'):
+        raise Exception('Zebra configuration for the chip scanner failed')
 
 
 ## Reference positions
@@ -0,0 +1,281 @@
+# Live callbacks for scans with many points, and figure lifecycle
+#
+# Drop-in replacements for LivePlot and LiveTable with the same constructor
+# arguments, plus keyword-only rate limits. Plans switch over by using
+# LivePlotThrottled / LiveTableBatched instead of LivePlot / LiveTable.
+#
+# Plans get their figures from figure_manager, which reuses one figure per
+# name and caps the number of open figures in the long-lived session.
+
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+from collections import OrderedDict
+from matplotlib._pylab_helpers import Gcf
+from bluesky.callbacks import LiveTable
+from bluesky.callbacks.mpl_plotting import LivePlot
+
+
+def decimate_minmax(x, y, maxPoints):
+    """
+    Reduces a trace to at most maxPoints, keeping the minimum and maximum of each bucket
+
+    Points are bucketed by index, so peaks and dips survive decimation.
+    Returns (x, y) in index order.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    nBuckets = maxPoints // 2
+    if n <= maxPoints or nBuckets < 1:
+        return x, y
+
+    size = -(-n // nBuckets)  # ceil
+    pad = nBuckets*size - n
+    yb = np.concatenate([y, np.full(pad, np.nan)]).reshape(nBuckets, size)
+    valid = ~np.isnan(yb).all(axis=1)
+    yb, offset = yb[valid], np.arange(nBuckets)[valid]*size
+    iMin = offset + np.nanargmin(yb, axis=1)
+    iMax = offset + np.nanargmax(yb, axis=1)
+    idx = np.unique(np.concatenate([iMin, iMax]))
+    return x[idx], y[idx]
+
+
+class LivePlotThrottled(LivePlot):
+    """
+    LivePlot that redraws at most maxFps times per second and decimates long traces
+
+    Events only append to the data caches. A canvas timer redraws when new
+    points arrived, at most maxFps times per second; with backends without
+    timers, an event redraws once the last redraw is older than two timer
+    intervals. The line shows at most maxPoints points, see decimate_minmax().
+    The complete trace is drawn at run stop.
+
+    Same arguments as LivePlot, plus
+    maxFps: Largest redraw rate [1/s], default = 5
+    maxPoints: Largest number of plotted points, default = 2000
+
+    Examples:
+    LivePlotThrottled('bpm1_sum_all', 'hdcm_p_user_setpoint', ax=ax)
+    """
+
+    def __init__(self, y, x=None, *, maxFps=5, maxPoints=2000, **kwargs):
+        super().__init__(y, x, **kwargs)
+        self.maxFps = maxFps
+        self.maxPoints = maxPoints
+        self._dirty = False
+        self._lastDraw = 0.0
+        self._timer = None
+
+    def start(self, doc):
+        super().start(doc)
+        self._dirty = False
+        self._lastDraw = time.monotonic()
+        self._timer = self.ax.figure.canvas.new_timer(interval=int(1000/self.maxFps))
+        self._timer.add_callback(self._redraw_pending)
+        self._timer.start()
+
+    def update_plot(self):
+        self._dirty = True
+        if time.monotonic() - self._lastDraw > 2/self.maxFps:
+            self._redraw()
+
+    def _redraw_pending(self):
+        if self._dirty:
+            self._redraw()
+
+    def _redraw(self, maxPoints=None):
+        x, y = decimate_minmax(self.x_data, self.y_data, maxPoints or self.maxPoints)
+        self.current_line.set_data(x, y)
+        self.ax.relim(visible_only=True)
+        self.ax.autoscale_view(tight=True)
+        self.ax.figure.canvas.draw_idle()
+        self._dirty = False
+        self._lastDraw = time.monotonic()
+
+    def stop(self, doc):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        if self.x_data:
+            self._redraw(maxPoints=max(len(self.y_data), self.maxPoints))
+        super().stop(doc)
+        # The line keeps the data, drop the caches
+        self.x_data, self.y_data = [], []
+
+
+class LiveTableBatched(LiveTable):
+    """
+    LiveTable that writes its rows in batches
+
+    Rows are collected and written together once batchSize rows are waiting
+    or the last write is older than flushInterval, and at run stop.
+
+    Same arguments as LiveTable, plus
+    flushInterval: Longest time between writes [s], default = 1
+    batchSize: Largest number of waiting rows, default = 50
+
+    Examples:
+    LiveTableBatched(['hdcm_p_user_setpoint', 'bpm1_sum_all'])
+    """
+
+    def __init__(self, fields, *, flushInterval=1.0, batchSize=50, out=print, **kwargs):
+        self._batchOut = out
+        self._lines = []
+        self._lastFlush = time.monotonic()
+        self.flushInterval = flushInterval
+        self.batchSize = batchSize
+        super().__init__(fields, out=self._lines.append, **kwargs)
+
+    def flush(self):
+        if self._lines:
+            self._batchOut('\n'.join(self._lines))
+            self._lines.clear()
+        self._lastFlush = time.monotonic()
+
+    def event(self, doc):
+        super().event(doc)
+        if len(self._lines) >= self.batchSize or time.monotonic() - self._lastFlush >= self.flushInterval:
+            self.flush()
+
+    def start(self, doc):
+        super().start(doc)
+        self.flush()
+
+    def stop(self, doc):
+        super().stop(doc)
+        self.flush()
+
+
+class FigureManager:
+    """
+    Reuses one figure per name and caps the number of open figures
+
+    subplots(name, ...) works like plt.subplots(), but clears and returns the
+    figure of an earlier call with the same name. When more than maxFigures
+    are open, the least recently used managed figures are closed. Figures not
+    made by subplots() are never closed, only reported if they keep the
+    count above maxFigures.
+
+    subscribe_run() subscribes a callback to the RunEngine for the next run
+    only. report() prints the memory held by open figures and by RunEngine
+    subscriptions.
+
+    Examples:
+    fig, ax = figure_manager.subplots('dcm_rock')
+    figure_manager.subscribe_run(LiveTableBatched(['bpm1_sum_all']))
+    figure_manager.report()
+    figure_manager.close_all()
+    """
+
+    def __init__(self, maxFigures=20):
+        self.maxFigures = maxFigures
+        self._figures = OrderedDict()  # name -> figure, least recently used first
+
+    def subplots(self, name, *args, **kwargs):
+        """
+        plt.subplots() on the figure named name, cleared if it exists
+        """
+        fig, axes = plt.subplots(*args, num=name, clear=True, **kwargs)
+        self._figures[name] = fig
+        self._figures.move_to_end(name)
+        self._enforce_cap(keep=fig)
+        return fig, axes
+
+    def _enforce_cap(self, keep=None):
+        for name, fig in list(self._figures.items()):
+            if not plt.fignum_exists(fig.number):
+                del self._figures[name]
+
+        managed = list(self._figures.items())  # least recently used first
+        nUnmanaged = sum(all(fig is not f for _, f in managed) for fig in self.open_figures())
+        nClose = len(managed) + nUnmanaged - self.maxFigures
+        for name, fig in managed:
+            if nClose <= 0:
+                break
+            if fig is keep:
+                continue
+            plt.close(fig)
+            del self._figures[name]
+            nClose -= 1
+
+        if nClose > 0:
+            print('{} figures open, {} not managed by figure_manager. '
+                  'Close them with plt.close() to free memory.'.format(
+                      len(self._figures) + nUnmanaged, nUnmanaged))
+
+    @staticmethod
+    def open_figures():
+        """
+        Returns the open pyplot figures by figure number, without changing the current figure
+        """
+        return sorted((m.canvas.figure for m in Gcf.get_all_fig_managers()), key=lambda f: f.number)
+
+    def close_all(self):
+        """
+        Closes all figures
+        """
+        plt.close('all')
+        self._figures.clear()
+
+    def subscribe_run(self, callback, name='all'):
+        """
+        Subscribes callback to the RunEngine until the end of the next run
+        """
+        cid = RE.subscribe(callback, name)
+
+        def unsubscribe_at_stop(docName, doc):
+            if docName == 'stop':
+                RE.unsubscribe(cid)
+                RE.unsubscribe(stopCid)
+
+        stopCid = RE.subscribe(unsubscribe_at_stop, 'stop')
+        return cid
+
+    @staticmethod
+    def figure_bytes(fig):
+        """
+        Estimates the memory held by a figure: plotted data and the canvas buffer [bytes]
+        """
+        nBytes = 0
+        for ax in fig.axes:
+            for line in ax.lines:
+                nBytes += np.asarray(line.get_xydata()).nbytes
+            for image in ax.images:
+                nBytes += np.asarray(image.get_array()).nbytes
+            for collection in ax.collections:
+                nBytes += np.asarray(collection.get_offsets()).nbytes
+        width, height = fig.canvas.get_width_height()
+        return nBytes + 4*width*height
+
+    def report(self):
+        """
+        Prints open figures and RunEngine subscriptions with their estimated memory
+        """
+        names = {fig: name for name, fig in self._figures.items()}
+        total = 0
+        print('{} open figures (cap {})'.format(len(plt.get_fignums()), self.maxFigures))
+        for fig in self.open_figures():
+            nBytes = self.figure_bytes(fig)
+            total += nBytes
+            print('  {:3d} {:24s} {:8.2f} MB'.format(fig.number, names.get(fig, fig.get_label() or '-'), nBytes/1e6))
+        print('  Figures total {:.2f} MB'.format(total/1e6))
+
+        registry = RE.dispatcher.cb_registry.callbacks
+        callbacks = [(docName, proxy) for docName, cbs in registry.items() for proxy in cbs.values()]
+        print('{} RunEngine subscriptions'.format(len(callbacks)))
+        for docName, proxy in callbacks:
+            # bluesky _BoundMethodProxy: a weak reference to the instance of a bound
+            # method, or a strong reference to a plain function or callable object
+            inst = getattr(proxy, 'inst', None)
+            cb = inst() if inst is not None else getattr(proxy, 'func', proxy)
+            if cb is None:
+                continue
+            cached = 0
+            for attr in ('x_data', 'y_data'):
+                cached += 8*len(getattr(cb, attr, []) or [])
+            print('  {:12s} {:40s} {:8.3f} MB cached'.format(
+                getattr(docName, 'name', str(docName)), type(cb).__name__, cached/1e6))
+
+
+figure_manager = FigureManager()
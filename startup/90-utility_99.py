@@ -0,0 +1,152 @@
+import contextlib
+import threading
+import time
+
+
+class BackgroundLoop:
+    """
+    Runs a control step periodically in a daemon thread, outside the RunEngine
+
+    Subclasses implement step() and may implement suspend_reason(), which is
+    checked before every step and returns a string while the loop should not
+    act (e.g. shutter closed), and on_suspend()/on_resume().
+
+    Plans that move what the loop controls suspend it with paused(), which
+    returns once a step in progress has finished.
+
+    Parameters
+    ----------
+
+    name: Name used in messages and the log
+    period: Loop period [s]
+    maxErrors: Consecutive step() exceptions after which the loop stops, default = 5
+
+    Examples
+    --------
+
+    loop.start()
+    loop.status()
+    with loop.paused():
+        ...
+    loop.stop()
+    """
+
+    def __init__(self, name, period, maxErrors=5):
+        self.name = name
+        self.period = period
+        self.maxErrors = maxErrors
+        self.suspended = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._pauses = 0
+        self._stepLock = threading.Lock()
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.metrics = {'started': None, 'iterations': 0, 'steps': 0, 'suspended': 0,
+                        'overruns': 0, 'errors': 0, 'last_error': None,
+                        'step_time_mean': 0.0, 'step_time_max': 0.0}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            print('{} already running'.format(self.name))
+            return
+        self._stop.clear()
+        self.suspended = None
+        self.reset_metrics()
+        self.metrics['started'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        log_fmx('{} started'.format(self.name))
+
+    def stop(self, timeout=10):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        log_fmx('{} stopped'.format(self.name))
+
+    @contextlib.contextmanager
+    def paused(self):
+        """
+        Context manager that suspends the loop, also inside plans. Nests.
+        """
+        self._pauses += 1
+        # Wait for a step in progress
+        with self._stepLock:
+            pass
+        try:
+            yield
+        finally:
+            self._pauses -= 1
+
+    def step(self):
+        raise NotImplementedError
+
+    def suspend_reason(self):
+        return None
+
+    def on_suspend(self, reason):
+        pass
+
+    def on_resume(self):
+        pass
+
+    def _run(self):
+        errors = 0
+        tNext = time.monotonic()
+        while not self._stop.is_set():
+            t0 = time.monotonic()
+            self.metrics['iterations'] += 1
+            try:
+                with self._stepLock:
+                    reason = 'Paused' if self._pauses else self.suspend_reason()
+                    if reason:
+                        if self.suspended is None:
+                            print('{} suspended: {}'.format(self.name, reason))
+                            self.on_suspend(reason)
+                        self.suspended = reason
+                        self.metrics['suspended'] += 1
+                    else:
+                        if self.suspended is not None:
+                            print('{} resumed'.format(self.name))
+                            self.suspended = None
+                            self.on_resume()
+                        self.step()
+                        self.metrics['steps'] += 1
+                errors = 0
+            except Exception as e:
+                errors += 1
+                self.metrics['errors'] += 1
+                self.metrics['last_error'] = repr(e)
+                if errors >= self.maxErrors:
+                    print('{} stopped after {} errors: {!r}'.format(self.name, errors, e))
+                    log_fmx('{} stopped after {} errors: {!r}'.format(self.name, errors, e))
+                    break
+
+            dt = time.monotonic() - t0
+            n = self.metrics['iterations']
+            self.metrics['step_time_mean'] += (dt - self.metrics['step_time_mean']) / n
+            self.metrics['step_time_max'] = max(self.metrics['step_time_max'], dt)
+
+            tNext += self.period
+            tNow = time.monotonic()
+            if tNext < tNow:
+                self.metrics['overruns'] += 1
+                tNext = tNow
+            self._stop.wait(tNext - tNow)
+
+    def status(self):
+        """
+        Prints the loop state and metrics
+        """
+        state = 'running' if self.running else 'stopped'
+        if self.running and self.suspended is not None:
+            state = 'suspended ({})'.format(self.suspended)
+        print('{}: {}'.format(self.name, state))
+        for k, v in self.metrics.items():
+            print('  {:16s} {}'.format(k, '{:.4g}'.format(v) if isinstance(v, float) else v))
@@ -55,13 +55,14 @@ def govStatusGet(stateStr, configStr = 'Robot'):
     return govStatus
 
 
-def govStateSet(stateStr, configStr = 'Robot'):
+def govStateSet(stateStr, configStr = 'Robot', timeout = None):
     """
     Sets Governor state
 
     configStr: Governor configuration, 'Robot', 'Human', 'Chip_Scanner' or 'Hepath'. default: 'Robot'
     stateStr: Governor short version state. Example: 'SA' for sample alignment
               one of ['M','SE','SA','TA','DA','XF','BL','BS','AB','CB','DI','CE','CA','CD','PA']
+    timeout: Raise TimeoutError if the state is not reached within timeout [s]. default: None (wait forever)
 
     Examples:
     govStateSet('SA')
@@ -80,8 +81,11 @@ def govStateSet(stateStr, configStr = 'Robot'):
     pvStr = sysStr + devStr + cmdStr
     epics.caput(pvStr, stateStr)
     
+    tStart = time.monotonic()
     while not govStatusGet(stateStr, configStr = configStr):
         print(govMsgGet(configStr = configStr))
+        if timeout is not None and time.monotonic() - tStart > timeout:
+            raise TimeoutError('Governor did not reach state {} within {} s'.format(stateStr, timeout))
         time.sleep(2)
     print(govMsgGet(configStr = configStr))
     
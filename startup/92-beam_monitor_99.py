@@ -0,0 +1,299 @@
+# Beam stability monitor
+#
+# Samples beam current, XBPM2, BPM1, Keithley and DCM pitch readbacks into a
+# fixed-size ring buffer, publishes rolling statistics as soft signals and
+# runs actions when thresholds are crossed.
+
+import time
+import numpy as np
+from collections import deque
+from ophyd import Signal
+from bluesky.suspenders import SuspendBoolHigh
+
+
+BEAM_MONITOR_STATS = ('mean', 'std', 'drift', 'drift_rel')
+
+
+class BeamMonitorRule:
+    """
+    Threshold on a rolling statistic of a BeamMonitor channel
+
+    Active while stat compares to threshold, e.g. mean < 1 with op '<', or
+    |drift| > 2 with op 'abs>'. The action is called with (rule, value) when
+    the rule becomes active, and again every cooldown seconds while it stays
+    active. With suspend=True the monitor alarm signal is set while the rule
+    is active, see BeamMonitor.suspender().
+
+    Parameters
+    ----------
+
+    channel: Channel name, e.g. 'bpm1_x'
+    stat: One of 'mean', 'std', 'drift' [/min], 'drift_rel' [1/min]
+    op: One of '<', '>', 'abs>'
+    threshold: Threshold value
+    action: Callable (rule, value), e.g. beam_monitor_suggest('RE(dcm_rock())'), default = None
+    cooldown: Shortest time between actions [s], default = 1800
+    suspend: Raise the monitor alarm while active, default = False
+    """
+
+    def __init__(self, channel, stat, op, threshold, action=None, cooldown=1800, suspend=False):
+        if stat not in BEAM_MONITOR_STATS:
+            raise ValueError('stat must be one of: {}'.format(', '.join(BEAM_MONITOR_STATS)))
+        if op not in ('<', '>', 'abs>'):
+            raise ValueError("op must be one of: '<', '>', 'abs>'")
+        self.channel = channel
+        self.stat = stat
+        self.op = op
+        self.threshold = threshold
+        self.action = action
+        self.cooldown = cooldown
+        self.suspend = suspend
+        self.active = False
+        self.lastAction = -np.inf
+
+    def __repr__(self):
+        return '{} {} {} {:g}'.format(self.channel, self.stat, self.op, self.threshold)
+
+    def check(self, value):
+        if not np.isfinite(value):
+            return False
+        if self.op == '<':
+            return value < self.threshold
+        if self.op == '>':
+            return value > self.threshold
+        return abs(value) > self.threshold
+
+
+def beam_monitor_suggest(text):
+    """
+    Returns a BeamMonitorRule action that prints and logs a suggestion
+    """
+    def action(rule, value):
+        msgStr = 'Beam monitor: {} ({:.4g}). Suggest {}'.format(rule, value, text)
+        print(msgStr)
+        log_fmx(msgStr)
+    return action
+
+
+def beam_monitor_pause(rule, value):
+    """
+    BeamMonitorRule action that requests a deferred RunEngine pause if a plan is running
+    """
+    msgStr = 'Beam monitor: {} ({:.4g})'.format(rule, value)
+    if RE.state == 'running':
+        RE.request_pause(defer=True)
+        msgStr += ', RunEngine pause requested'
+    print(msgStr)
+    log_fmx(msgStr)
+
+
+class BeamMonitor(BackgroundLoop):
+    """
+    Rolling beam stability statistics with threshold actions
+
+    Subscribes to the channel signals and samples their latest values once
+    per period into a ring buffer of `length` samples, so memory use is fixed
+    however long it runs. Each period it computes, for all channels at once,
+    the mean and standard deviation over the last `window` seconds and the
+    drift rate (least squares slope) over the last `driftWindow` seconds, and
+    publishes them as soft signals, e.g. beam_monitor.signals['bpm1_x']['drift'].
+    Derived channels are computed from the sampled values of the others.
+
+    Rules are then checked, see BeamMonitorRule. Rules with suspend=True set
+    beam_monitor.alarm while active; install beam_monitor.suspender() on the
+    RunEngine to pause plans until it clears.
+
+    Parameters
+    ----------
+
+    channels: {name: signal}, default = beam current, XBPM2 X/Y, BPM1 X/Y/sum, Keithley, DCM pitch
+    derived: {name: function of {name: value}}, default = BPM1 sum / beam current
+    rules: List of BeamMonitorRule, default = beam_monitor_default_rules()
+    period: Sampling period [s], default = 1
+    length: Ring buffer length [samples], default = 3600
+    window: Statistics window [s], default = 60
+    driftWindow: Drift rate window [s], default = 600
+
+    Examples
+    --------
+
+    beam_monitor.start()
+    beam_monitor.report()
+    beam_monitor.rules.append(BeamMonitorRule('keithley', 'std', '>', 1e-9))
+    RE.install_suspender(beam_monitor.suspender())
+    beam_monitor.stop()
+    """
+
+    def __init__(self, channels=None, derived=None, rules=None, period=1, length=3600,
+                 window=60, driftWindow=600):
+        super().__init__('Beam monitor', period)
+        if channels is None:
+            channels = {'beam_current': beam_current,
+                        'xbpm2_x': xbpm2.x, 'xbpm2_y': xbpm2.y,
+                        'bpm1_x': bpm1.x, 'bpm1_y': bpm1.y, 'bpm1_sum': bpm1.sum_all,
+                        'keithley': keithley,
+                        'hdcm_p': hdcm.p.user_readback}
+        if derived is None:
+            derived = {'bpm1_sum_norm': lambda v: v['bpm1_sum'] / v['beam_current']}
+        self.channels = channels
+        self.derived = derived
+        self.rules = rules if rules is not None else beam_monitor_default_rules()
+        self.length = length
+        self.window = window
+        self.driftWindow = driftWindow
+
+        self.names = list(channels) + list(derived)
+        self._latest = np.full(len(channels), np.nan)
+        self._buffer = np.full((length, len(self.names)), np.nan)
+        self._times = np.full(length, np.nan)
+        self._count = 0
+        self._cids = []
+        self.stats = {}
+        self.events = deque(maxlen=200)
+
+        self.alarm = Signal(name='beam_monitor_alarm', value=0)
+        self.signals = {name: {stat: Signal(name='beam_monitor_{}_{}'.format(name, stat), value=np.nan)
+                               for stat in BEAM_MONITOR_STATS}
+                        for name in self.names}
+
+    def _subscribe(self):
+        for i, sig in enumerate(self.channels.values()):
+            def cb(value, i=i, **kwargs):
+                self._latest[i] = value
+            self._cids.append((sig, sig.subscribe(cb)))
+
+    def _unsubscribe(self):
+        for sig, cid in self._cids:
+            sig.unsubscribe(cid)
+        self._cids = []
+
+    def start(self):
+        if self.running:
+            print('{} already running'.format(self.name))
+            return
+        self._subscribe()
+        super().start()
+
+    def stop(self, timeout=10):
+        super().stop(timeout)
+        self._unsubscribe()
+
+    def samples(self, seconds=None):
+        """
+        Returns the buffered sample times and values, oldest first, as (t, values)
+
+        seconds: Only the last seconds, default = None (whole buffer)
+        """
+        n = min(self._count, self.length)
+        order = np.arange(self._count - n, self._count) % self.length
+        t, values = self._times[order], self._buffer[order]
+        if seconds is not None:
+            keep = t >= time.time() - seconds
+            t, values = t[keep], values[keep]
+        return t, values
+
+    def _sample(self):
+        values = dict(zip(self.channels, self._latest))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for name, f in self.derived.items():
+                try:
+                    values[name] = f(values)
+                except Exception:
+                    values[name] = np.nan
+        i = self._count % self.length
+        self._buffer[i] = [values[name] for name in self.names]
+        self._times[i] = time.time()
+        self._count += 1
+
+    def _compute(self):
+        t, values = self.samples(self.window)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if len(t):
+                mean = np.nanmean(values, axis=0)
+                std = np.nanstd(values, axis=0)
+            else:
+                mean = std = np.full(len(self.names), np.nan)
+
+            t, values = self.samples(self.driftWindow)
+            if len(t) >= 3:
+                tc = t - t.mean()
+                dev = values - np.nanmean(values, axis=0)
+                valid = np.isfinite(dev)
+                dev = np.where(valid, dev, 0)
+                denom = (tc**2) @ valid
+                drift = 60 * (tc @ dev) / np.where(denom > 0, denom, np.nan)
+            else:
+                drift = np.full(len(self.names), np.nan)
+            driftRel = drift / np.abs(mean)
+
+        for k, name in enumerate(self.names):
+            self.stats[name] = {'mean': mean[k], 'std': std[k], 'drift': drift[k], 'drift_rel': driftRel[k]}
+            for stat, value in self.stats[name].items():
+                self.signals[name][stat].put(value)
+
+    def _check_rules(self):
+        tNow = time.monotonic()
+        alarm = False
+        for rule in self.rules:
+            value = self.stats.get(rule.channel, {}).get(rule.stat, np.nan)
+            active = rule.check(value)
+            if active and not rule.active:
+                self.events.append((time.strftime('%Y-%m-%d %H:%M:%S'), repr(rule), value))
+            if active and rule.action is not None and tNow - rule.lastAction >= rule.cooldown:
+                rule.lastAction = tNow
+                rule.action(rule, value)
+            rule.active = active
+            alarm |= active and rule.suspend
+        if self.alarm.get() != int(alarm):
+            self.alarm.put(int(alarm))
+
+    def step(self):
+        self._sample()
+        self._compute()
+        self._check_rules()
+
+    def suspender(self, sleep=10):
+        """
+        Returns a suspender that pauses plans while a suspend rule is active
+
+        Examples:
+        RE.install_suspender(beam_monitor.suspender())
+        """
+        return SuspendBoolHigh(self.alarm, sleep=sleep,
+                               tripped_message='Beam monitor alarm, see beam_monitor.report()')
+
+    def report(self):
+        """
+        Prints the rolling statistics, active rules and recent rule events
+        """
+        print('{:16s} {:>12s} {:>12s} {:>12s} {:>12s}'.format('channel', *BEAM_MONITOR_STATS))
+        for name in self.names:
+            s = self.stats.get(name, dict.fromkeys(BEAM_MONITOR_STATS, np.nan))
+            print('{:16s} {:12.5g} {:12.4g} {:12.4g} {:12.4g}'.format(
+                name, *[s[stat] for stat in BEAM_MONITOR_STATS]))
+        active = [repr(rule) for rule in self.rules if rule.active]
+        print('Active rules:', ', '.join(active) if active else 'none')
+        for event in list(self.events)[-10:]:
+            print('  {} {} ({:.4g})'.format(*event))
+
+
+def beam_monitor_default_rules():
+    """
+    Returns the default BeamMonitor rules, thresholds to be tuned with operation
+
+    Low beam current only raises the alarm, install beam_monitor.suspender() to pause plans on it
+    """
+    return [BeamMonitorRule('beam_current', 'mean', '<', 10, suspend=True),
+            BeamMonitorRule('bpm1_sum_norm', 'drift_rel', '<', -0.005,
+                            action=beam_monitor_suggest('RE(dcm_rock())')),
+            BeamMonitorRule('hdcm_p', 'drift', 'abs>', 0.0005,
+                            action=beam_monitor_suggest('RE(dcm_rock())')),
+            BeamMonitorRule('bpm1_x', 'drift', 'abs>', 2,
+                            action=beam_monitor_suggest('RE(beam_center_align())')),
+            BeamMonitorRule('bpm1_y', 'drift', 'abs>', 2,
+                            action=beam_monitor_suggest('RE(beam_center_align())')),
+            BeamMonitorRule('xbpm2_y', 'std', '>', 5,
+                            action=beam_monitor_suggest('checking the orbit feedback'))]
+
+
+beam_monitor = BeamMonitor()
@@ -55,6 +55,34 @@ def trans_set(transmission, trans = trans_bcu):
     return
 
 
+def trans_set_wait(transmission, trans = trans_bcu, timeout = 60):
+    """
+    Sets the Attenuator transmission and waits for it, outside the RunEngine
+
+    Blocking version of trans_set(), e.g. for setE() stages running in a thread.
+    Raises TimeoutError if the attenuator is not done within timeout [s], default = 60
+    """
+
+    e_dcm = get_energy()
+    if e_dcm < 5000 or e_dcm > 30000:
+        print('Monochromator energy out of range. Must be within 5000 - 30000 eV. Exiting.')
+        return
+
+    trans.energy.set(e_dcm).wait(timeout)
+    trans.transmission.set(transmission).wait(timeout)
+    trans.set_trans.set(1).wait(timeout)
+
+    if trans == trans_bcu:
+        tStart = time.monotonic()
+        while atten_bcu.done.get() != 1:
+            if time.monotonic() - tStart > timeout:
+                raise TimeoutError('BCU attenuator not done within {} s'.format(timeout))
+            time.sleep(0.5)
+
+    print('Attenuator = ' + trans.name + ', Transmission set to %.3f' % trans.transmission.get())
+    return
+
+
 def trans_get(trans = trans_bcu):
     """
     Returns the Attenuator transmission
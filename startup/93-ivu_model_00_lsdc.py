@@ -0,0 +1,236 @@
+import numpy as np
+from scipy.special import jv
+
+# IVU21 harmonic model
+# Planar undulator on-axis harmonics with a Halbach type K(gap) calibration
+# fitted to our own tuned gaps (LUT and setE() cache). Used to predict the
+# harmonic, peak gap and peak width for an energy and to size gap scans.
+
+IVU_PERIOD = 21.0         # Undulator period [mm]
+IVU_NPERIODS = 71         # Number of periods (1.5 m)
+IVU_RING_ENERGY = 3.0     # NSLS-II electron energy [GeV]
+IVU_ENERGY_SPREAD = 8.9e-4  # Relative rms electron energy spread
+
+IVU_model = None  # Cached calibration, set by ivu_model_fit()
+
+
+def ivu_e1(K):
+    """
+    Returns the IVU21 on-axis first harmonic energy [eV] for deflection parameter K
+    """
+    return 1e3 * 0.9496 * IVU_RING_ENERGY**2 / (IVU_PERIOD/10 * (1 + K**2/2))
+
+
+def ivu_k_gap(gap, model=None):
+    """
+    Returns the IVU21 deflection parameter K for a gap [um]
+
+    K = a * exp(b*x + c*x**2), x = gap/period
+    """
+    if model is None:
+        model = ivu_model_get()
+    x = np.asarray(gap) / 1e3 / IVU_PERIOD
+    return model['a'] * np.exp(model['b']*x + model['c']*x**2)
+
+
+def ivu_k_flux(K, n):
+    """
+    Returns the relative central cone flux of odd harmonic n for deflection parameter K
+
+    Qn(K) = n*K**2/(1+K**2/2) * [J_(n-1)/2(xi) - J_(n+1)/2(xi)]**2, xi = n*K**2/(4+2*K**2)
+    """
+    xi = n * K**2 / (4 + 2*K**2)
+    return n * K**2 / (1 + K**2/2) * (jv((n-1)/2, xi) - jv((n+1)/2, xi))**2
+
+
+def _ivu_tuned_history():
+    """
+    Returns energies [eV] and peak gaps [um] of tuned undulator positions
+
+    Taken from the ivu_gap LUT, corrected by the ivu_gap_off LUT offset to the
+    scan peak, and from the setE() tuned-position cache.
+    """
+    lut = read_lut('ivu_gap')
+    off = read_lut('ivu_gap_off')
+    energy = list(lut['Energy'])
+    gap = list(lut['Position'] - np.interp(lut['Energy'], off['Energy'], off['Position']))
+
+    for entry in setE_cache_read().values():
+        energy.append(entry['energy'])
+        gap.append(entry['ivu_gap'] - np.interp(entry['energy'], off['Energy'], off['Position']))
+
+    order = np.argsort(energy)
+    return np.asarray(energy, dtype=float)[order], np.asarray(gap, dtype=float)[order]
+
+
+def ivu_model_fit(energy=None, gap=None):
+    """
+    Fits the IVU21 K(gap) calibration to tuned gaps
+
+    Harmonics are assigned per segment of the gap vs. energy curve: the gap
+    jumps down at every harmonic change, successive segments use successive
+    odd harmonics. The first harmonic in the list is the one giving the best
+    fit of log K vs. gap.
+
+    energy: Photon energies [eV], default = tuned history (LUT and setE() cache)
+    gap: Peak gaps [um]
+
+    Returns the model dict, which is also cached for ivu_model_get().
+
+    Examples:
+    ivu_model_fit()
+    """
+    global IVU_model
+
+    if energy is None:
+        energy, gap = _ivu_tuned_history()
+    energy = np.asarray(energy, dtype=float)
+    gap = np.asarray(gap, dtype=float)
+
+    # Same energy tuned several times: only gaps within a harmonic are comparable
+    seg = np.concatenate([[0], np.cumsum(np.diff(gap) < -0.05*np.ptp(gap))])
+    x = gap / 1e3 / IVU_PERIOD
+
+    best = None
+    for n0 in (1, 3, 5, 7):
+        n = n0 + 2*seg
+        K2 = 2 * (n * ivu_e1(0) / energy - 1)
+        if (K2 <= 0).any():
+            continue
+        coef, res = np.polyfit(x, np.log(np.sqrt(K2)), 2, full=True)[:2]
+        rms = np.sqrt(res[0]/len(x)) if len(res) else 0.0
+        if best is None or rms < best['rms']:
+            best = {'a': np.exp(coef[2]), 'b': coef[1], 'c': coef[0], 'rms': rms, 'n0': n0}
+
+    if best is None:
+        raise ValueError('No harmonic assignment fits the tuned gaps')
+
+    # Model gap residuals [um] for the scan window margin
+    best['gap_min'] = ivu_gap.gap.low_limit
+    best['gap_max'] = ivu_gap.gap.high_limit
+    n = best['n0'] + 2*seg
+    predicted = [ivu_gap_predict(e, n=k, model=best)['gap'] for e, k in zip(energy, n)]
+    best['gap_rms'] = float(np.sqrt(np.nanmean((np.asarray(predicted) - gap)**2)))
+
+    print('IVU21 model: K = {:.3f}*exp({:.3f}*x{:+.3f}*x^2), first harmonic {}, gap rms {:.1f} um'.format(
+        best['a'], best['b'], best['c'], best['n0'], best['gap_rms']))
+
+    IVU_model = best
+    return best
+
+
+def ivu_model_get():
+    """
+    Returns the cached IVU21 model, fitting it first if needed
+    """
+    if IVU_model is None:
+        ivu_model_fit()
+    return IVU_model
+
+
+def ivu_gap_predict(energy, n=None, model=None):
+    """
+    Predicts harmonic, peak gap, peak width and relative flux for an energy
+
+    energy: Photon energy [eV]
+    n: Odd harmonic, default = harmonic of the current LUT gap for this energy
+    model: IVU21 model dict, default = ivu_model_get()
+
+    Returns a dict with keys n, gap [um], width [um] (FWHM), flux (relative),
+    or gap = nan if the harmonic cannot reach the energy within the gap limits.
+
+    Examples:
+    ivu_gap_predict(12660)
+    ivu_gap_predict(12660, n=7)
+    """
+    if model is None:
+        model = ivu_model_get()
+    if n is None:
+        n = ivu_harmonics(energy, model=model)['lut']
+
+    nan = {'n': n, 'gap': np.nan, 'width': np.nan, 'flux': 0.0}
+    K2 = 2 * (n * ivu_e1(0) / energy - 1)
+    if K2 <= 0:
+        return nan
+
+    # K decreases monotonically with gap: invert on a dense grid
+    gaps = np.linspace(model['gap_min'], model['gap_max'], 2001)
+    Ks = ivu_k_gap(gaps, model=model)
+    K = np.sqrt(K2)
+    if not Ks[-1] <= K <= Ks[0]:
+        return nan
+    gap = np.interp(K, Ks[::-1], gaps[::-1])
+
+    # Harmonic FWHM [eV]: natural linewidth 1/(nN) and energy spread
+    widthE = energy * np.sqrt((0.9/(n*IVU_NPERIODS))**2 + (2*IVU_ENERGY_SPREAD)**2)
+    dEdGap = n * (ivu_e1(ivu_k_gap(gap + 1, model=model)) - ivu_e1(ivu_k_gap(gap - 1, model=model))) / 2
+
+    return {'n': n, 'gap': gap, 'width': abs(widthE / dEdGap), 'flux': float(ivu_k_flux(K, n))}
+
+
+def ivu_harmonics(energy, nMax=15, model=None):
+    """
+    Returns the reachable harmonics for an energy and flags a better harmonic
+
+    energy: Photon energy [eV]
+    nMax: Highest odd harmonic considered, default = 15
+
+    Returns a dict with keys:
+    lut: Harmonic of the LUT gap for this energy
+    best: Harmonic with the highest relative flux
+    predictions: List of ivu_gap_predict() results for reachable harmonics
+
+    Examples:
+    ivu_harmonics(7110)
+    """
+    if model is None:
+        model = ivu_model_get()
+
+    predictions = [p for p in (ivu_gap_predict(energy, n=k, model=model) for k in range(1, nMax+1, 2))
+                   if np.isfinite(p['gap'])]
+    if not predictions:
+        raise ValueError('No IVU21 harmonic reaches {} eV'.format(energy))
+
+    lut = read_lut('ivu_gap')
+    off = read_lut('ivu_gap_off')
+    gapLut = np.interp(energy, lut['Energy'], lut['Position']) - np.interp(energy, off['Energy'], off['Position'])
+    nLut = min(predictions, key=lambda p: abs(p['gap'] - gapLut))['n']
+    nBest = max(predictions, key=lambda p: p['flux'])['n']
+
+    return {'lut': nLut, 'best': nBest, 'predictions': predictions}
+
+
+def ivu_gap_scan_window(energy, widthRange=1.5, pointsPerWidth=5, minSteps=7):
+    """
+    Returns IVU gap scan offsets and steps for an energy from the IVU21 model
+
+    The window covers widthRange peak widths (FWHM) on either side of the
+    predicted peak plus the model gap rms, sampled with pointsPerWidth points
+    per FWHM. Warns if a different harmonic gives more flux than the LUT one.
+
+    energy: Photon energy [eV]
+    widthRange: Half window in FWHM, default = 1.5
+    pointsPerWidth: Scan points per FWHM, default = 5
+    minSteps: Minimum number of scan points, default = 7
+
+    Returns (ivuGapStartOff, ivuGapEndOff, ivuGapSteps) as used by setE()
+
+    Examples:
+    ivu_gap_scan_window(12660)
+    """
+    model = ivu_model_get()
+    harm = ivu_harmonics(energy, model=model)
+    pred = ivu_gap_predict(energy, n=harm['lut'], model=model)
+
+    if harm['best'] != harm['lut']:
+        best = [p for p in harm['predictions'] if p['n'] == harm['best']][0]
+        print('Harmonic {} at {:.0f} um gives {:.2f}x the flux of LUT harmonic {} at {:.0f} eV'.format(
+            best['n'], best['gap'], best['flux']/pred['flux'], pred['n'], energy))
+
+    halfWindow = widthRange * pred['width'] + model['gap_rms']
+    step = pred['width'] / pointsPerWidth
+    steps = max(minSteps, int(np.ceil(2*halfWindow/step)) + 1)
+    print('IVU21 harmonic {}: peak width {:.1f} um, scan +-{:.1f} um in {} points'.format(
+        pred['n'], pred['width'], halfWindow, steps))
+
+    return halfWindow, halfWindow, steps
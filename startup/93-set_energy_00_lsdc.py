@@ -6,6 +6,8 @@ import bluesky.preprocessors as bpp
 import bluesky.plans as bp
 import bluesky.plan_stubs as bps
 import epics
+import json
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 
@@ -113,7 +115,7 @@ def setE_motors_FMX(energy):
 
     # Remove CRLs if going to energy < 9 keV (FMX specific)
     if energy < 9001:
-        set_beamsize('V0','H0')
+        yield from set_beamsize('V0','H0')
     
     # Lookup Table
     def lut(motor):
@@ -146,8 +148,165 @@ def setE_motors_FMX(energy):
         # Set KB from known good setpoints
         *lgp(kbm.vy), *lgp(kbm.vp),
         *lgp(kbm.hx), *lgp(kbm.hp)
-    )    
-    
+    )
+
+
+# Tuned-position cache
+# Final positions of a full setE() tuning, keyed by energy, so that returning
+# to a recently tuned energy (e.g. MAD/SAD energy series) can skip the rocking
+# curve and gap scan.
+
+SETE_CACHE_FILE = '/nsls2/data/fmx/shared/config/fmx_bluesky_config/setE_cache.json'
+SETE_CACHE_KEEP = 7*24*3600  # Entries older than this [s] are pruned on write
+
+# LSDC crosshair ROIs set by beam_center_align()
+BEAM_CENTER_ROIS = (('cam_8', 'roi1'), ('cam_8', 'roi2'),
+                    ('cam_7', 'roi2'), ('cam_7', 'roi3'))
+
+
+def setE_cache_read():
+    """
+    Returns the setE() tuned-position cache as a dict keyed by energy string
+
+    Returns an empty dict if the cache file does not exist or cannot be read.
+    """
+    try:
+        with open(SETE_CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def setE_cache_write(cache):
+    """
+    Writes the setE() tuned-position cache, pruning entries older than SETE_CACHE_KEEP
+    """
+    tNow = time.time()
+    cache = {k: v for k, v in cache.items() if tNow - v['time'] < SETE_CACHE_KEEP}
+    try:
+        with open(SETE_CACHE_FILE, 'w') as f:
+            json.dump(cache, f, indent=1)
+    except OSError as e:
+        print('Could not write setE cache {}: {}'.format(SETE_CACHE_FILE, e))
+
+
+def setE_cache_clear():
+    """
+    Removes all entries from the setE() tuned-position cache
+
+    Examples:
+    setE_cache_clear()
+    """
+    setE_cache_write({})
+
+
+def beam_center_get():
+    """
+    Returns the current beam center alignment result: Governor Gonio Y Work
+    position and the LSDC crosshair ROI origins
+    """
+    cams = {'cam_7': cam_7, 'cam_8': cam_8}
+    rois = {}
+    for camName, roiName in BEAM_CENTER_ROIS:
+        roi = getattr(cams[camName], roiName)
+        rois[camName + '.' + roiName] = [roi.min_xyz.min_x.get(), roi.min_xyz.min_y.get()]
+
+    return {'gy_work': govPositionGet('gy', 'Work'), 'rois': rois}
+
+
+def beam_center_restore(beamCenter):
+    """
+    Restores a beam center alignment result returned by beam_center_get()
+
+    Sets the LSDC crosshair ROI origins, moves Gonio Y and sets the Governor
+    Gonio Y Work position.
+
+    Requirements
+    ------------
+    * No sample mounted
+    * Governor in SA state
+    """
+    cams = {'cam_7': cam_7, 'cam_8': cam_8}
+    rois = RoiTransaction()
+    for key, (minX, minY) in beamCenter['rois'].items():
+        camName, roiName = key.split('.')
+        rois.set(getattr(cams[camName], roiName), min_x=minX, min_y=minY)
+    if not rois.commit():
+        print('Crosshair restore failed. Gonio Y not moved.')
+        return -1
+
+    yield from bps.mv(gonio.gy, beamCenter['gy_work'])
+    govPositionSet(beamCenter['gy_work'], 'gy', 'Work')
+    print('Gonio Y Work position restored to %.3f' % beamCenter['gy_work'])
+
+
+def setE_cache_store(energy, beamCenter=None):
+    """
+    Stores the current tuned positions for an energy in the setE() cache
+
+    energy: Photon energy [eV]
+    beamCenter: Beam center alignment result from beam_center_get(), or None
+
+    Stored are HDCM pitch, IVU gap, photon local feedback state and the
+    BPM1 sum together with the time and the ring current.
+    """
+    cache = setE_cache_read()
+    cache['{:.1f}'.format(energy)] = {
+        'energy': energy,
+        'time': time.time(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'beam_current': beam_current.get(),
+        'hdcm_p': hdcm.p.user_readback.get(),
+        'ivu_gap': ivu_gap.gap.user_readback.get(),
+        'feedback_x': photon_local_feedback_c17.x_enable.get(),
+        'feedback_y': photon_local_feedback_c17.y_enable.get(),
+        'bpm1_sum': bpm1.sum_all.get(),
+        'beam_center': beamCenter,
+    }
+    setE_cache_write(cache)
+
+
+def setE_cache_get(energy, maxAge=4*3600, energyTol=1.0):
+    """
+    Returns the most recent cached tune for an energy, or None
+
+    energy: Photon energy [eV]
+    maxAge: Maximum age of the cache entry [s], default = 4 h
+    energyTol: Maximum energy difference to the cached energy [eV], default = 1.0
+
+    Examples:
+    setE_cache_get(12660)
+    setE_cache_get(12660, maxAge=600)
+    """
+    tNow = time.time()
+    entries = [e for e in setE_cache_read().values()
+               if abs(e['energy'] - energy) <= energyTol and tNow - e['time'] <= maxAge]
+    if not entries:
+        return None
+
+    return max(entries, key=lambda e: e['time'])
+
+
+def setE_cache_check(entry, checkTol=0.95):
+    """
+    Verifies that the beamline is on a cached tune
+
+    Compares the BPM1 sum, normalized to the ring current, with the value
+    stored for the cache entry. Returns True if the ratio is at least checkTol.
+
+    entry: Cache entry from setE_cache_get()
+    checkTol: Minimum ratio of normalized BPM1 sum to the cached value, default = 0.95
+    """
+    ringNow = beam_current.get()
+    if ringNow < 1 or entry['beam_current'] < 1:
+        print('Ring current too low for cache check')
+        return False
+
+    ratio = (bpm1.sum_all.get() / ringNow) / (entry['bpm1_sum'] / entry['beam_current'])
+    print('Cache check: normalized BPM1 sum = {:.3f} of tuned value'.format(ratio))
+
+    return ratio >= checkTol
+
     
 def dcm_rock(dcm_p_range=0.03, dcm_p_points=51, logging=True, altDetector=False):
     """
@@ -194,7 +353,7 @@ def dcm_rock(dcm_p_range=0.03, dcm_p_points=51, logging=True, altDetector=False)
     )
 
     # Setup plots
-    fig, ax1 = plt.subplots()
+    fig, ax1 = figure_manager.subplots('dcm_rock')
     ax1.grid(True)
     # fig.tight_layout()
     
@@ -227,8 +386,123 @@ def dcm_rock(dcm_p_range=0.03, dcm_p_points=51, logging=True, altDetector=False)
         elif  rock_det == keithley:
             time.sleep(2.0)  # Range switching is slow
             print('Keithley current = {:.4g} A'.format(keithley.get()))
-        
-    #plt.close(fig)
+
+
+joint_tune_path = None  # Evaluations of the last joint_tune(), DataFrame
+
+
+def joint_tune(pRange=0.03, gapRange=70, maxPoints=40, xTol=0.02, detector=bpm1, gapOffset=True):
+    """
+    Maximizes BPM1 flux over DCM crystal 2 pitch and IVU gap together
+
+    Bounded Nelder-Mead simplex search over (hdcm.p, ivu gap), starting from the
+    current positions, in coordinates normalized to the search ranges. Points
+    outside the ranges are projected onto the bounds. Stops when the simplex is
+    smaller than xTol of the ranges or after maxPoints measurements, then moves
+    to the best point measured, with the gap moved by the ivu_gap_off LUT
+    offset as in ivu_gap_scan().
+
+    Every measurement is an event in one run. The path is kept in joint_tune_path.
+
+    Parameters
+    ----------
+
+    pRange: Pitch search half range [mrad], default = 0.03
+    gapRange: Gap search half range [um], default = 70
+    maxPoints: Measurement budget, default = 40
+    xTol: Convergence size of the simplex, fraction of the ranges, default = 0.02
+    detector: Flux detector, default = bpm1
+    gapOffset: Apply the ivu_gap_off LUT offset to the final gap, default = True
+
+    Examples
+    --------
+
+    RE(joint_tune())
+    RE(joint_tune(pRange=0.02, gapRange=100, maxPoints=60))
+    """
+    global joint_tune_path
+
+    if maxPoints < 3:
+        print('maxPoints must be at least 3, the size of the initial simplex')
+        return -1
+
+    detKey = detector.name + '_sum_all' if detector in (bpm1, bpm4) else detector.name
+    p0 = hdcm.p.user_readback.get()
+    g0 = ivu_gap.gap.user_readback.get()
+    scale = np.array([pRange, gapRange])
+    origin = np.array([p0, g0])
+
+    path = []
+    cache = {}
+
+    class BudgetSpent(Exception):
+        pass
+
+    def measure(x, action):
+        x = np.clip(x, -1, 1)
+        key = tuple(np.round(x, 6))
+        if key in cache:
+            return x, cache[key]
+        if len(path) >= maxPoints:
+            raise BudgetSpent
+        p, g = origin + x*scale
+        yield from bps.mv(hdcm.p, p, ivu_gap, g)
+        reading = yield from bps.trigger_and_read([detector, hdcm.p, ivu_gap])
+        f = reading[detKey]['value']
+        cache[key] = f
+        path.append({'hdcm_p': p, 'ivu_gap': g, detKey: f, 'action': action})
+        return x, f
+
+    @bpp.run_decorator(md={'plan_name': 'joint_tune'})
+    def inner():
+        simplex, values = [], []
+        for dx, action in (((0, 0), 'start'), ((0.3, 0), 'init'), ((0, 0.3), 'init')):
+            x, f = yield from measure(np.array(dx, dtype=float), action)
+            simplex.append(x)
+            values.append(f)
+
+        # Every measurement checks the budget, a step stops when it is spent
+        try:
+            # Iteration cap guards against cycling on cached points at the bounds
+            for _ in range(3*maxPoints):
+                order = np.argsort(values)[::-1]  # Maximize
+                simplex = [simplex[i] for i in order]
+                values = [values[i] for i in order]
+                if max(np.max(np.abs(v - simplex[0])) for v in simplex[1:]) < xTol:
+                    break
+
+                centroid = np.mean(simplex[:-1], axis=0)
+                xr, fr = yield from measure(centroid + (centroid - simplex[-1]), 'reflect')
+                if fr > values[0]:
+                    xe, fe = yield from measure(centroid + 2*(centroid - simplex[-1]), 'expand')
+                    simplex[-1], values[-1] = (xe, fe) if fe > fr else (xr, fr)
+                elif fr > values[-2]:
+                    simplex[-1], values[-1] = xr, fr
+                else:
+                    xc, fc = yield from measure(centroid + 0.5*(simplex[-1] - centroid), 'contract')
+                    if fc > values[-1]:
+                        simplex[-1], values[-1] = xc, fc
+                    else:
+                        for i in (1, 2):
+                            simplex[i], values[i] = yield from measure(
+                                simplex[0] + 0.5*(simplex[i] - simplex[0]), 'shrink')
+        except BudgetSpent:
+            pass
+
+    yield from inner()
+
+    joint_tune_path = pd.DataFrame(path)
+    best = joint_tune_path.loc[joint_tune_path[detKey].idxmax()]
+    gap = best['ivu_gap']
+    if gapOffset:
+        LUT_offset = [epics.caget(LUT_fmt.format('ivu_gap_off', axis)) for axis in 'XY']
+        gap += np.interp(get_energy(), *LUT_offset)
+    yield from bps.mv(hdcm.p, best['hdcm_p'], ivu_gap, gap)
+
+    print('joint_tune: {} points, HDCM cr2 pitch = {:.4f} mrad, IVU gap = {:.1f} um, {} = {:.4g}'.format(
+        len(joint_tune_path), best['hdcm_p'], gap, detKey, best[detKey]))
+    log_fmx('joint_tune: {} points, hdcm_p {:.4f} mrad, ivu_gap {:.1f} um, {} {:.4g}'.format(
+        len(joint_tune_path), best['hdcm_p'], gap, detKey, best[detKey]))
 
     
 def ivu_gap_scan(start, end, steps, detector=bpm1, goToPeak=True):
@@ -272,7 +546,7 @@ def ivu_gap_scan(start, end, steps, detector=bpm1, goToPeak=True):
     LUT_offset = [epics.caget(LUT_fmt.format('ivu_gap_off', axis)) for axis in 'XY']
     
     # Setup plots
-    fig, ax2 = plt.subplots()
+    fig, ax2 = figure_manager.subplots('ivu_gap_scan')
     ax2.grid(True)
     #plt.tight_layout()
 
@@ -292,7 +566,7 @@ def ivu_gap_scan(start, end, steps, detector=bpm1, goToPeak=True):
                 start -= 5*step_size
                 stop -= 5*step_size
 
-        @bpp.subs_decorator(LivePlot(det_name, mot_name, ax=ax))
+        @bpp.subs_decorator(LivePlotThrottled(det_name, mot_name, ax=ax))
         def inner():
             peak_x, peak_y, data = yield from find_peak(detector, motor, start, stop, num)
             ax.plot([peak_x], [peak_y], 'or')
@@ -317,13 +591,155 @@ def ivu_gap_scan(start, end, steps, detector=bpm1, goToPeak=True):
         yield from bps.mv(ivu_gap, gapPreStart)
         print('Gap set to pre-scan value: %.1f' % gapPreStart + ' um')
     
-    #plt.close()
-    
     
+# setE stage pipeline
+# Main stages are plans run in order by the RunEngine. Side stages are blocking
+# functions run in threads, as soon as their dependencies are done and no
+# running main stage conflicts with them in SETE_INTERLOCKS.
+
+# (side stage, main stage): setE option under which the two must not overlap,
+# None = never overlap. Interlocks do not order stages; a side stage that has
+# to run after a main stage lists it in its dependencies, see setE().
+SETE_INTERLOCKS = {
+    # set_beamsize() below 9 keV moves the same transfocator lenses
+    ('crl_out', 'lut_motion'): None,
+}
+# With altDetector, tuning reads the endstation diode, downstream of the CRLs,
+# the Governor AB devices and the attenuators
+SETE_INTERLOCKS.update({(side, main): 'altDetector'
+                        for side in ('crl_out', 'gov_AB', 'atten_preset')
+                        for main in ('dcm_rock', 'gap_scan', 'joint_tune')})
+
+# Longest wait of a setE() side stage [s], so a stuck device cannot hang setE()
+SETE_SIDE_TIMEOUT = 60
+
+setE_timing = None  # Stage timing of the last setE(), DataFrame
+
+
+class SetEStage:
+    """
+    One step of setE()
+
+    name: Stage name, as used in dependencies and SETE_INTERLOCKS
+    run: Plan function (main stage) or blocking function (side stage), no arguments
+    deps: Names of stages that have to be done before this one starts
+    side: True for a side stage, which runs in a thread
+    skip: Function returning True if the stage is not needed, checked before it starts
+    """
+    def __init__(self, name, run, deps=(), side=False, skip=None):
+        self.name = name
+        self.run = run
+        self.deps = set(deps)
+        self.side = side
+        self.skip = skip
+        self.start = self.end = None
+        self.skipped = False
+
+
+def setE_pipeline(stages, overlap=True, options=()):
+    """
+    Runs setE() stages, side stages in parallel with the main stages where allowed
+
+    stages: List of SetEStage, main stages run in list order
+    overlap: Set to False to run every side stage in sequence, in list order, default = True
+    options: setE options in effect, for SETE_INTERLOCKS
+
+    Returns the stage timing as a DataFrame
+    """
+    byName = {st.name: st for st in stages}
+    done = set()
+    futures = {}
+    t0 = time.time()
+
+    def conflicts(side, main):
+        opt = SETE_INTERLOCKS.get((side, main), False)
+        return opt is None or (opt is not False and opt in options)
+
+    def run_side(st):
+        # Side stage dependencies on other side stages are waited for in the thread
+        for dep in st.deps:
+            future = futures.get(dep)
+            if future is not None:
+                future.result()
+        if st.skip is not None and st.skip():
+            st.skipped = True
+            return
+        st.start = time.time()
+        st.run()
+        st.end = time.time()
+
+    def wait_side(name):
+        futures.pop(name).result()
+        done.add(name)
+
+    def submit(st):
+        if overlap:
+            futures[st.name] = executor.submit(run_side, st)
+        else:
+            run_side(st)
+            done.add(st.name)
+
+    def submit_ready(main=None):
+        for st in stages:
+            if not st.side or st.name in done or st.name in futures:
+                continue
+            if not all(dep in done or dep in futures for dep in st.deps):
+                continue
+            if main is not None and conflicts(st.name, main.name):
+                continue
+            submit(st)
+
+    executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='setE')
+    try:
+        for main in stages:
+            if main.side:
+                continue
+            for name in [n for n, f in futures.items() if f.done()]:
+                wait_side(name)
+
+            # Side stages this one depends on, or conflicts with, have to finish first
+            for dep in main.deps:
+                if byName[dep].side and dep not in done and dep not in futures:
+                    submit(byName[dep])
+            for name in list(futures):
+                if name in main.deps or conflicts(name, main.name):
+                    wait_side(name)
+
+            submit_ready(main)
+
+            if main.skip is not None and main.skip():
+                main.skipped = True
+            else:
+                main.start = time.time()
+                yield from main.run()
+                main.end = time.time()
+            done.add(main.name)
+
+        submit_ready()
+        for name in list(futures):
+            wait_side(name)
+    finally:
+        executor.shutdown(wait=True)
+
+    timing = pd.DataFrame([{'Stage': st.name,
+                            'Side': st.side,
+                            'Start [s]': st.start - t0 if st.start else np.nan,
+                            'Duration [s]': st.end - st.start if st.end else np.nan}
+                           for st in stages])
+    total = time.time() - t0
+    print(timing.to_string(index=False, float_format='%.1f', na_rep='skipped'))
+    print('setE total {:.1f} s, sum of stages {:.1f} s'.format(total, timing['Duration [s]'].sum()))
+
+    return timing
+
+
 def setE(energy,
          dcm_p_range=0.03, dcm_p_points=51, altDetector=False,
-         ivuGapStartOff=70, ivuGapEndOff=70, ivuGapSteps=31,
-         transSet='All', beamCenterAlign=True, slit1Set=True):
+         ivuGapStartOff=70, ivuGapEndOff=70, ivuGapSteps=31, ivuGapAuto=False,
+         jointTune=False, jointTuneMaxPoints=40,
+         transSet='All', beamCenterAlign=True, slit1Set=True,
+         useCache=True, cacheMaxAge=4*3600, cacheCheckTol=0.95,
+         overlap=True):
     """
     Automated photon energy change. Master function calling four subroutines:
     * setE_motors_FMX():    Set photon delivery system motor positions for a chosen energy
@@ -351,6 +767,13 @@ def setE(energy,
     ivuGapStartOff: IVU gap scan start offset from tabulated position [um], default = 70
     ivuGapEndOff: IVU gap scan end offset from tabulated position [um], default = 70
     ivuGapSteps: IVU gap scan steps, default = 31
+    ivuGapAuto: Set IVU gap scan offsets and steps from the IVU21 harmonic model
+                with ivu_gap_scan_window(), overriding the three above, default = False
+    
+    jointTune: Replace dcm_rock() and ivu_gap_scan() by one joint_tune() simplex search
+               over DCM pitch and IVU gap, using dcm_p_range and ivuGapStartOff as ranges,
+               and the Keithley with altDetector, default = False
+    jointTuneMaxPoints: Measurement budget of joint_tune(), default = 40
     
     transSet: FMX only: Set to 'RI' if there is a problem with the BCU attenuator.
               FMX only: Set to 'BCU' if there is a problem with the RI attenuator.
@@ -364,6 +787,18 @@ def setE(energy,
     slit1Set: Set to False to skip setting Slit 1 Gap values
                      Default True
     
+    useCache: Use the tuned positions of a recent setE() at the same energy, default = True
+              If the normalized BPM1 sum confirms the cached tune, the rocking curve,
+              gap scan and beam center alignment are skipped and their results restored.
+              Otherwise the full procedure runs. A full run stores its result in the cache.
+    cacheMaxAge: Maximum age of a cached tune [s], default = 4 h
+    cacheCheckTol: Minimum ratio of normalized BPM1 sum to the cached value, default = 0.95
+    
+    overlap: Run the beam_center_align() preparation (detector cover, Governor AB,
+             attenuators, CRLs) in parallel with the energy change, or with
+             altDetector in parallel with the steps after tuning. Set to False to run all stages in sequence. default = True
+             Stage timing is printed and kept in setE_timing.
+    
     Examples
     --------
     
@@ -373,65 +808,190 @@ def setE(energy,
     RE(setE(20000, ivuGapStartOff=100, ivuGapEndOff=150, ivuGapSteps=91))
     RE(setE(9000, beamCenterAlign=False))
     RE(setE(12660, beamCenterAlign=False, slit1Set=False))
+    RE(setE(12660, useCache=False))
+    RE(setE(12660, ivuGapAuto=True))
+    RE(setE(12660, jointTune=True))
+    RE(setE(12660, overlap=False))
     """
     
-    # Store initial Slit 1 gap positions
-    if slit1Set:
-        slits1XGapOrg = slits1.x_gap.user_readback.get()
-        slits1YGapOrg = slits1.y_gap.user_readback.get()
-    
-    print('Setting FMX motor positions')
-    try:
-        yield from setE_motors_FMX(energy)
-    except:
-        print('setE_motors_FMX() failed')
-        raise
-    else:
-        print('setE_motors_FMX() successful')
-        time.sleep(1)
+    global setE_timing
     
     # Check for pre-conditions for dcm_rock() and ivu_gap_scan()
     if shutter_foe.status.get():
         print('FOE shutter closed. Has to be open for this to work. Exiting')
         return -1
-        
-    # DCM rocking curve
-    print('Rocking monochromator')
-    yield from dcm_rock(dcm_p_range=dcm_p_range, dcm_p_points=dcm_p_points, altDetector=altDetector)
-    time.sleep(1)
-    
-    # Undulator gap scan
-    print('Scanning undulator gap')
-    start = ivu_gap.gap.user_readback.get() - ivuGapStartOff
-    end = ivu_gap.gap.user_readback.get() + ivuGapEndOff
-    try:
-        yield from ivu_gap_scan(start, end, ivuGapSteps, goToPeak=True)
-    except:
-        print('ivu_gap_scan() failed')
-        raise
-    else:
-        print('ivu_gap_scan() successful')
-        time.sleep(1)
     
-    # Activate sector 17 photon local feedback
-    photon_local_feedback_c17.x_enable.put(1)
-    photon_local_feedback_c17.y_enable.put(1)
-    
-    # Align LSDC microscope center to beam center
+    # Check for pre-conditions for beam_center_align()
     if beamCenterAlign:
-        # Check for pre-conditions for beam_center_align()
         if shutter_hutch_c.status.get():
             print('Experiment hutch shutter closed. Has to be open for this to work. Exiting')
             return -1
         if not govStatusGet('SA'):
             print('Not in Governor state SA, exiting')
             return -1
-        
-        print('Aligning beam center')
-        yield from beam_center_align(transSet=transSet)
     
-    # Restore initial Slit 1 gap positions
+    # Store initial Slit 1 gap positions
     if slit1Set:
+        slits1XGapOrg = slits1.x_gap.user_readback.get()
+        slits1YGapOrg = slits1.y_gap.user_readback.get()
+    
+    state = {'cacheEntry': setE_cache_get(energy, maxAge=cacheMaxAge) if useCache else None,
+             'transOrg': {}}
+    
+    # A cached beam center makes the beam_center_align() preparation unnecessary,
+    # but only once the cache check has confirmed the cached tune
+    cacheBeamCenter = state['cacheEntry'] is not None and state['cacheEntry']['beam_center'] is not None
+    prepDeps = ['cache_check'] if cacheBeamCenter else []
+    # With altDetector the flux is tuned on the endstation diode, downstream of
+    # the CRLs, attenuators and Governor AB devices: prepare only after tuning
+    if altDetector:
+        prepDeps += ['gap_scan', 'joint_tune']
+    
+    def beam_center_cached():
+        return state['cacheEntry'] is not None and state['cacheEntry']['beam_center'] is not None
+    
+    def skip_prep():
+        return not beamCenterAlign or beam_center_cached()
+    
+    def lut_motion():
+        print('Setting FMX motor positions')
+        try:
+            yield from setE_motors_FMX(energy)
+        except:
+            print('setE_motors_FMX() failed')
+            raise
+        else:
+            print('setE_motors_FMX() successful')
+            time.sleep(1)
+    
+    def cache_check():
+        # Jump to a recent tune at this energy, if it checks out
+        cacheEntry = state['cacheEntry']
+        print('Moving to tuned positions from %s' % cacheEntry['date'])
+        yield from bps.mv(hdcm.p, cacheEntry['hdcm_p'], ivu_gap, cacheEntry['ivu_gap'])
+        time.sleep(1)
+        if not setE_cache_check(cacheEntry, checkTol=cacheCheckTol):
+            print('Cached tune not confirmed, running full procedure')
+            state['cacheEntry'] = None
+    
+    def tune_joint():
+        # Joint DCM pitch and undulator gap search
+        print('Tuning monochromator pitch and undulator gap')
+        yield from joint_tune(pRange=dcm_p_range, gapRange=ivuGapStartOff, maxPoints=jointTuneMaxPoints,
+                              detector=keithley if altDetector else bpm1)
+        time.sleep(1)
+    
+    def rock():
+        # DCM rocking curve
+        print('Rocking monochromator')
+        yield from dcm_rock(dcm_p_range=dcm_p_range, dcm_p_points=dcm_p_points, altDetector=altDetector)
+        time.sleep(1)
+    
+    def gap_scan():
+        # Undulator gap scan
+        print('Scanning undulator gap')
+        if ivuGapAuto:
+            startOff, endOff, steps = ivu_gap_scan_window(energy)
+        else:
+            startOff, endOff, steps = ivuGapStartOff, ivuGapEndOff, ivuGapSteps
+        start = ivu_gap.gap.user_readback.get() - startOff
+        end = ivu_gap.gap.user_readback.get() + endOff
+        try:
+            yield from ivu_gap_scan(start, end, steps, goToPeak=True)
+        except:
+            print('ivu_gap_scan() failed')
+            raise
+        else:
+            print('ivu_gap_scan() successful')
+            time.sleep(1)
+    
+    def feedback():
+        cacheEntry = state['cacheEntry']
+        if cacheEntry is None:
+            # Activate sector 17 photon local feedback
+            photon_local_feedback_c17.x_enable.put(1)
+            photon_local_feedback_c17.y_enable.put(1)
+        else:
+            # Restore sector 17 photon local feedback state
+            photon_local_feedback_c17.x_enable.put(cacheEntry['feedback_x'])
+            photon_local_feedback_c17.y_enable.put(cacheEntry['feedback_y'])
+        yield from bps.null()
+    
+    def crl_out():
+        # Retract all CRLs, i.e. set beamsize to "not expanded"
+        for lens in (transfocator.vs, transfocator.v2a, transfocator.v1a, transfocator.v1b,
+                     transfocator.h4a, transfocator.h2a, transfocator.h1a, transfocator.h1b):
+            lens.mv_out.set(1).wait(SETE_SIDE_TIMEOUT)
+    
+    def cover_close():
+        print('Closing detector cover')
+        cover_detector.close.set(1).wait(SETE_SIDE_TIMEOUT)
+        tStart = time.monotonic()
+        while cover_detector.status.get() == 1:
+            if time.monotonic() - tStart > SETE_SIDE_TIMEOUT:
+                raise TimeoutError('Detector cover not closed within {} s'.format(SETE_SIDE_TIMEOUT))
+            time.sleep(0.5)
+    
+    def gov_AB():
+        # Transition to Governor state AB (Auto-align Beam)
+        govStateSet('AB', timeout=SETE_SIDE_TIMEOUT)
+    
+    def atten_preset():
+        # Set beam transmission that avoids scintillator saturation
+        transTargets = beam_center_trans_targets(transSet, energy)
+        state['transOrg'] = {trans: trans_get(trans=trans) for trans in transTargets}
+        for trans, transmission in transTargets.items():
+            trans_set_wait(transmission, trans=trans, timeout=SETE_SIDE_TIMEOUT)
+    
+    def beam_center():
+        # Align LSDC microscope center to beam center
+        cacheEntry = state['cacheEntry']
+        state['beamCenter'] = None
+        if cacheEntry is not None and cacheEntry['beam_center'] is not None:
+            print('Restoring beam center')
+            yield from beam_center_restore(cacheEntry['beam_center'])
+        else:
+            print('Aligning beam center')
+            yield from beam_center_align(transSet=transSet, prepared=True)
+            state['beamCenter'] = beam_center_get()
+    
+    def atten_restore():
+        # Set previous beam transmission
+        for trans, transmission in state['transOrg'].items():
+            yield from trans_set(transmission, trans=trans)
+    
+    def cache_store():
+        # Store the new tune
+        if state['cacheEntry'] is None:
+            setE_cache_store(energy, beamCenter=state.get('beamCenter'))
+        yield from bps.null()
+    
+    def slits_restore():
+        # Restore initial Slit 1 gap positions
         yield from bps.mv(slits1.x_gap, slits1XGapOrg)  # Move Slit 1 X to original position
         yield from bps.mv(slits1.y_gap, slits1YGapOrg)  # Move Slit 1 Y to original position
     
+    def tuned():
+        return state['cacheEntry'] is not None
+    
+    stages = [
+        SetEStage('crl_out', crl_out, deps=prepDeps, side=True, skip=skip_prep),
+        SetEStage('cover_close', cover_close, deps=prepDeps, side=True, skip=skip_prep),
+        SetEStage('gov_AB', gov_AB, deps=prepDeps + ['cover_close'], side=True, skip=skip_prep),
+        SetEStage('atten_preset', atten_preset, deps=prepDeps + ['lut_motion'], side=True, skip=skip_prep),
+        SetEStage('lut_motion', lut_motion),
+        SetEStage('cache_check', cache_check, deps=['lut_motion'], skip=lambda: not tuned()),
+        SetEStage('joint_tune', tune_joint, deps=['cache_check'], skip=lambda: tuned() or not jointTune),
+        SetEStage('dcm_rock', rock, deps=['cache_check'], skip=lambda: tuned() or jointTune),
+        SetEStage('gap_scan', gap_scan, deps=['dcm_rock'], skip=lambda: tuned() or jointTune),
+        SetEStage('feedback', feedback, deps=['gap_scan', 'joint_tune']),
+        SetEStage('beam_center', beam_center,
+                  deps=['feedback', 'crl_out', 'cover_close', 'gov_AB', 'atten_preset'],
+                  skip=lambda: not beamCenterAlign),
+        SetEStage('atten_restore', atten_restore, deps=['beam_center'], skip=lambda: not state['transOrg']),
+        SetEStage('cache_store', cache_store, deps=['beam_center']),
+        SetEStage('slits_restore', slits_restore, deps=['cache_store'], skip=lambda: not slit1Set),
+    ]
+    
+    options = {name for name, value in (('altDetector', altDetector), ('jointTune', jointTune)) if value}
+    setE_timing = yield from setE_pipeline(stages, overlap=overlap, options=options)
@@ -0,0 +1,419 @@
+import pandas as pd
+import numpy as np
+
+# LUT calibration campaign
+# Rebuilds the setE_motors_FMX() lookup tables from tuned positions over a
+# list of energies. Run lut_campaign(), review the fits with lut_campaign_fit()
+# and lut_campaign_review(), then write them with lut_campaign_write().
+
+LUT_CAMPAIGN_DIR = '/nsls2/data/fmx/shared/config/fmx_bluesky_config/'
+
+# LUT motors recorded by the campaign (atten LUT is a flux setting, not a tune)
+LUT_campaign_motors = (ivu_gap.gap, hdcm.g, hdcm.r, hdcm.p, hfm.y, hfm.x, hfm.pitch, kbm.hy, kbm.vx)
+
+
+def lut_campaign_order(energies, energyStart=None):
+    """
+    Returns energies ordered to minimize total undulator gap and Bragg angle travel
+
+    Gap and Bragg axes move concurrently in setE_motors_FMX(), so the cost of a
+    step is the larger of the two moves, each normalized to its range over the
+    campaign. The route is a nearest-neighbor tour from energyStart, improved
+    by 2-opt segment reversals.
+
+    energies: List of photon energies [eV]
+    energyStart: Energy the tour starts from [eV], default = current HDCM energy
+
+    Examples:
+    lut_campaign_order([6000, 8000, 10000, 12660, 15000, 18000])
+    """
+    if energyStart is None:
+        energyStart = hdcm.e.user_readback.get()
+
+    lutGap = read_lut('ivu_gap')
+    def coords(e):
+        e = np.asarray(e, dtype=float)
+        return np.column_stack([np.interp(e, lutGap['Energy'], lutGap['Position']),
+                                [xf_e2bragg(x) for x in e]])
+
+    energies = np.asarray(energies, dtype=float)
+    xy = coords(energies)
+    span = np.ptp(xy, axis=0)
+    span[span == 0] = 1
+    xy = xy / span
+    xy0 = coords([energyStart])[0] / span
+
+    def cost(a, b):
+        return np.max(np.abs(a - b), axis=-1)
+
+    # Nearest-neighbor tour
+    todo = list(range(len(energies)))
+    route = []
+    pos = xy0
+    while todo:
+        i = todo[int(np.argmin(cost(xy[todo], pos)))]
+        route.append(i)
+        todo.remove(i)
+        pos = xy[i]
+
+    # 2-opt on the open path from the start position
+    def path_cost(r):
+        pts = np.vstack([xy0, xy[r]])
+        return cost(pts[1:], pts[:-1]).sum()
+
+    improved = True
+    while improved:
+        improved = False
+        best = path_cost(route)
+        for i in range(len(route) - 1):
+            for j in range(i + 1, len(route)):
+                trial = route[:i] + route[i:j+1][::-1] + route[j+1:]
+                c = path_cost(trial)
+                if c < best - 1e-9:
+                    route, best, improved = trial, c, True
+
+    return list(energies[route])
+
+
+def lut_campaign(energies,
+                 dcm_p_range=0.03, dcm_p_points=51, altDetector=False,
+                 ivuGapStartOff=70, ivuGapEndOff=70, ivuGapSteps=31,
+                 fileName=None):
+    """
+    Tunes the beamline over a list of energies and records the LUT motor positions
+
+    For every energy: setE_motors_FMX(), dcm_rock() and ivu_gap_scan(), then the
+    readbacks of all LUT motors are recorded. Energies are visited in the order
+    returned by lut_campaign_order(). An energy that fails is logged and skipped.
+    The results are appended to a CSV file after every energy.
+
+    Requirements
+    ------------
+    FOE shutter open
+
+    Parameters
+    ----------
+
+    energies: List of photon energies [eV]
+
+    dcm_p_range, dcm_p_points, altDetector: Passed to dcm_rock()
+    ivuGapStartOff, ivuGapEndOff, ivuGapSteps: Gap scan range around the LUT position, as in setE()
+
+    fileName: CSV file for the results,
+              default = LUT_CAMPAIGN_DIR + 'lut_campaign_<date>.csv'
+
+    Examples
+    --------
+
+    RE(lut_campaign(np.arange(6000, 18001, 500)))
+    RE(lut_campaign([7110, 12660, 13474], ivuGapSteps=41))
+    """
+    if fileName is None:
+        fileName = LUT_CAMPAIGN_DIR + time.strftime('lut_campaign_%Y%m%d_%H%M%S.csv')
+
+    route = lut_campaign_order(energies)
+    print('LUT campaign: {} energies, results in {}'.format(len(route), fileName))
+    log_fmx('LUT campaign started, energies {}'.format(route))
+
+    rows = []
+    for n, energy in enumerate(route):
+        print('LUT campaign {}/{}: {:.1f} eV'.format(n+1, len(route), energy))
+        if shutter_foe.status.get():
+            print('FOE shutter closed. Has to be open for this to work. Exiting')
+            break
+
+        try:
+            yield from setE_motors_FMX(energy)
+            time.sleep(1)
+            yield from dcm_rock(dcm_p_range=dcm_p_range, dcm_p_points=dcm_p_points, altDetector=altDetector)
+            time.sleep(1)
+            start = ivu_gap.gap.user_readback.get() - ivuGapStartOff
+            end = ivu_gap.gap.user_readback.get() + ivuGapEndOff
+            yield from ivu_gap_scan(start, end, ivuGapSteps, goToPeak=True)
+            time.sleep(1)
+        except Exception as e:
+            print('LUT campaign: {:.1f} eV failed: {}'.format(energy, e))
+            log_fmx('LUT campaign: {:.1f} eV failed: {}'.format(energy, e))
+            continue
+
+        row = {'Energy': energy,
+               'Time': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'bpm1_sum': bpm1.sum_all.get()}
+        for m in LUT_campaign_motors:
+            row[m.name] = m.user_readback.get()
+        rows.append(row)
+
+        pd.DataFrame(rows).to_csv(fileName, index=False)
+
+    log_fmx('LUT campaign finished, {}/{} energies tuned, results in {}'.format(len(rows), len(route), fileName))
+
+
+def lut_fit(energy, position, deg=3, nSigma=3.0, maxIter=5, segments=False, minDrop=None, minSegment=4):
+    """
+    Fits a smoothing polynomial with iterative outlier rejection
+
+    Points deviating by more than nSigma robust standard deviations (1.4826*MAD)
+    from the fit are rejected and the fit is repeated until no more points
+    are rejected.
+
+    energy: Photon energies [eV]
+    position: Tuned motor positions
+    deg: Polynomial degree, reduced for segments with few points, default = 3
+    nSigma: Outlier rejection threshold, default = 3.0
+    maxIter: Maximum number of rejection iterations, default = 5
+    segments: Fit separately between downward jumps of position with energy
+              (undulator harmonic changes), default = False
+    minDrop: Smallest downward jump that starts a segment, between the medians
+             of minSegment points before and after it, so single outliers do
+             not split. Default = None (10% of the position range)
+    minSegment: Fewest points in a segment, default = 4
+
+    Returns fitted positions and a boolean mask of accepted points, both in
+    order of increasing energy, and the sorted energies.
+    """
+    if maxIter < 1:
+        raise ValueError('maxIter must be at least 1')
+
+    order = np.argsort(energy)
+    energy = np.asarray(energy, dtype=float)[order]
+    position = np.asarray(position, dtype=float)[order]
+
+    edges = [0, len(energy)]
+    if segments:
+        if minDrop is None:
+            minDrop = 0.1*np.nanmax(position) - 0.1*np.nanmin(position)
+        jumps = []
+        for i in np.where(np.diff(position) < -minDrop)[0] + 1:
+            i0 = jumps[-1] if jumps else 0
+            if i - i0 < minSegment or len(position) - i < minSegment:
+                continue
+            # A harmonic change moves the level, the median ignores single outliers
+            before = np.nanmedian(position[i-minSegment:i])
+            after = np.nanmedian(position[i:i+minSegment])
+            if before - after > minDrop:
+                jumps.append(i)
+        edges = [0] + jumps + [len(energy)]
+
+    fit = np.full(len(energy), np.nan)
+    good = np.isfinite(position)
+    for i0, i1 in zip(edges[:-1], edges[1:]):
+        e, p, g = energy[i0:i1], position[i0:i1], good[i0:i1].copy()
+        for _ in range(maxIter):
+            d = min(deg, g.sum() - 1)
+            if d < 0:
+                break
+            coef = np.polyfit(e[g], p[g], d)
+            resid = p - np.polyval(coef, e)
+            sigma = 1.4826*np.median(np.abs(resid[g] - np.median(resid[g])))
+            gNew = good[i0:i1] & (np.abs(resid) <= nSigma*sigma) if sigma > 0 else g
+            if (gNew == g).all():
+                break
+            g = gNew
+        if d >= 0:
+            fit[i0:i1] = np.polyval(coef, e)
+        good[i0:i1] = g
+
+    return energy, fit, good
+
+
+def lut_campaign_fit(fileName, deg=3, nSigma=3.0):
+    """
+    Fits smoothing curves to the results of lut_campaign()
+
+    fileName: CSV file written by lut_campaign()
+    deg, nSigma: Passed to lut_fit()
+
+    Returns a dict of DataFrames with columns Energy, Measured, Fit, Accepted
+    for every LUT motor. The undulator gap is fit per harmonic.
+
+    Examples:
+    fits = lut_campaign_fit('/nsls2/data/fmx/shared/config/fmx_bluesky_config/lut_campaign_20260101_120000.csv')
+    """
+    df = pd.read_csv(fileName)
+
+    fits = {}
+    for m in LUT_campaign_motors:
+        energy, fit, good = lut_fit(df['Energy'], df[m.name], deg=deg, nSigma=nSigma,
+                                    segments=(m is ivu_gap.gap))
+        fits[m.name] = pd.DataFrame({'Energy': energy,
+                                     'Measured': df[m.name].values[np.argsort(df['Energy'].values)],
+                                     'Fit': fit,
+                                     'Accepted': good})
+        if (~good).any():
+            print('{}: rejected {} outlier(s) at {} eV'.format(m.name, (~good).sum(), list(energy[~good])))
+
+    return fits
+
+
+def lut_campaign_review(fits):
+    """
+    Prints the difference between fitted positions and the current LUTs
+
+    fits: Dict returned by lut_campaign_fit()
+
+    Returns a DataFrame of fitted minus current LUT positions at the campaign energies.
+
+    Examples:
+    lut_campaign_review(fits)
+    """
+    diff = {}
+    for name, fit in fits.items():
+        lut = read_lut(name)
+        diff[name] = fit['Fit'].values - np.interp(fit['Energy'], lut['Energy'], lut['Position'])
+
+    diff = pd.DataFrame(diff, index=pd.Index(fits[next(iter(fits))]['Energy'], name='Energy'))
+    print('Fitted minus current LUT position')
+    print(diff.to_string(float_format='%.4f'))
+
+    return diff
+
+
+def lut_campaign_write(fits, motors=None, confirm=False):
+    """
+    Writes fitted campaign positions to the LUTs
+
+    fits: Dict returned by lut_campaign_fit()
+    motors: List of LUT names to write, default = all in fits
+    confirm: Has to be True to actually write. Review with lut_campaign_review() first.
+
+    Examples:
+    lut_campaign_write(fits, confirm=True)
+    lut_campaign_write(fits, motors=['hdcm_p', 'ivu_gap'], confirm=True)
+    """
+    if motors is None:
+        motors = list(fits)
+
+    for name in motors:
+        fit = fits[name]
+        if not confirm:
+            print('{}: would write {} points (confirm=False)'.format(name, len(fit)))
+            continue
+        write_lut(name, fit['Energy'].values, fit['Fit'].values)
+        log_fmx('LUT {} written from campaign fit, {} points'.format(name, len(fit)))
+        print('{}: wrote {} points'.format(name, len(fit)))
+
+
+class DcmDither(BackgroundLoop):
+    """
+    Keeps the DCM on the rocking curve peak by dithering its pitch
+
+    Steps the pitch through a sampled sine of amplitude `amplitude` around a
+    center position, one phase per loop period, and demodulates the detector
+    signal at the dither frequency. The in-phase component, normalized to the
+    mean signal, is the gradient of log intensity vs. pitch; the center moves
+    by gain times that gradient, limited to maxStep per dither period and
+    maxOffset from the position it started at.
+
+    The loop suspends while the RunEngine is busy, the Eiger acquires, the FOE
+    shutter is closed or the signal is below minFraction of its value at
+    start. The pitch is not moved on suspend, so an exposure that is starting
+    is not disturbed. After a suspension the dither continues around the
+    stored center, not the pitch left at a dither phase, so suspensions do
+    not drift the center. The loop stays suspended while the pitch is more
+    than maxOffset from the origin from start(), e.g. after a plan moved it.
+    Restart the loop to take a new origin.
+
+    Parameters
+    ----------
+
+    motor: Pitch positioner, default = hdcm.p
+    detector: Intensity signal, default = bpm1.sum_all
+    amplitude: Dither amplitude [motor units], default = 0.001 mrad
+    phases: Dither phases per period, default = 8
+    gain: Center step per unit gradient [motor units**2], about 0.3x the squared
+          rocking curve sigma for a damped Newton step, default = 3e-5 mrad**2
+    maxStep: Largest center step per dither period, default = 0.002 mrad
+    maxOffset: Largest total correction from the start position, default = 0.02 mrad
+    minFraction: Suspend below this fraction of the start signal, default = 0.5
+    period: Loop period per phase [s], should cover motor settle and BPM averaging, default = 0.5
+
+    Examples
+    --------
+
+    dcm_dither.start()
+    dcm_dither.status()
+    dcm_dither.gain = 1e-5
+    dcm_dither.stop()
+    """
+
+    def __init__(self, motor=hdcm.p, detector=bpm1.sum_all, amplitude=0.001, phases=8,
+                 gain=3e-5, maxStep=0.002, maxOffset=0.02, minFraction=0.5, period=0.5):
+        super().__init__('DCM pitch dither', period)
+        self.motor = motor
+        self.detector = detector
+        self.amplitude = amplitude
+        self.phases = phases
+        self.gain = gain
+        self.maxStep = maxStep
+        self.maxOffset = maxOffset
+        self.minFraction = minFraction
+
+    def start(self):
+        self.origin = self.center = self.motor.user_readback.get()
+        self.signalRef = self.detector.get()
+        self._reset_period()
+        super().start()
+
+    def reset_metrics(self):
+        super().reset_metrics()
+        self.metrics.update({'periods': 0, 'gradient': np.nan, 'quadrature': np.nan,
+                             'correction': 0.0, 'limited': 0})
+
+    def _reset_period(self):
+        self._phase = -1
+        self._samples = np.zeros(self.phases)
+
+    def _phase_angle(self, k):
+        return 2*np.pi*k/self.phases
+
+    def suspend_reason(self):
+        if RE.state != 'idle':
+            return 'RunEngine {}'.format(RE.state)
+        if eiger_single.cam.acquire.get():
+            return 'Eiger acquiring'
+        if shutter_foe.status.get():
+            return 'FOE shutter closed'
+        if self.detector.get() < self.minFraction*self.signalRef:
+            return 'Low signal'
+        if abs(self.motor.user_readback.get() - self.origin) > self.maxOffset + self.amplitude:
+            return 'Pitch more than maxOffset from the start position, restart to accept it'
+        return None
+
+    def on_suspend(self, reason):
+        # Do not move: an exposure or a plan may be starting
+        self._reset_period()
+
+    def on_resume(self):
+        # Keep the stored center, the pitch was left at center + A*sin(phase)
+        self._reset_period()
+
+    def step(self):
+        # Sample for the phase set in the previous step
+        if self._phase >= 0:
+            self._samples[self._phase] = self.detector.get()
+            if self._phase == self.phases - 1:
+                self._update_center()
+
+        self._phase = (self._phase + 1) % self.phases
+        self.motor.move(self.center + self.amplitude*np.sin(self._phase_angle(self._phase)), wait=True)
+
+    def _update_center(self):
+        phi = self._phase_angle(np.arange(self.phases))
+        mean = self._samples.mean()
+        inPhase = 2*np.mean(self._samples*np.sin(phi))
+        quadrature = 2*np.mean(self._samples*np.cos(phi))
+
+        gradient = inPhase / (self.amplitude*mean)
+        delta = np.clip(self.gain*gradient, -self.maxStep, self.maxStep)
+        center = np.clip(self.center + delta, self.origin - self.maxOffset, self.origin + self.maxOffset)
+        if center != self.center + delta:
+            self.metrics['limited'] += 1
+        self.center = center
+
+        self.metrics['periods'] += 1
+        self.metrics['gradient'] = gradient
+        self.metrics['quadrature'] = quadrature / (self.amplitude*mean)
+        self.metrics['correction'] = self.center - self.origin
+
+
+dcm_dither = DcmDither()
@@ -5,11 +5,206 @@ import bluesky.preprocessors as bpp
 import bluesky.plans as bp
 import bluesky.plan_stubs as bps
 import numpy as np
+import threading
+import time
+from collections import namedtuple
 
 
-def centroid_avg(stats):
+CentroidStats = namedtuple('CentroidStats', ['x', 'y', 'sigma_x', 'sigma_y', 'n'])
+
+
+class CentroidAverager:
+    """
+    Averages the centroids of new camera frames from an AD stats plugin
+
+    Subscribes to the plugin centroid X/Y and UniqueId. A frame is sampled once
+    its centroid X and Y updates carry a timestamp at or after its UniqueId,
+    since the plugin posts UniqueId ahead of the centroid. An axis that does
+    not post keeps its value, so a pending frame is also sampled when the next
+    UniqueId arrives. Frames up to the UniqueId at start() plus skipFrames are
+    discarded, so no frame exposed before the call is counted.
+    Converged once at least minFrames are collected and the standard error of
+    the mean is below tol in X and Y, or once maxFrames are collected. If no
+    frame arrived, result() falls back to the current centroid, with n = 0.
+
+    stats: Stats plugin of an ophyd camera object, e.g. cam_8.stats4
+    tol: Standard error of the mean for convergence [px], default = 0.1
+    minFrames: Minimum number of frames, default = 3
+    maxFrames: Maximum number of frames, size of the ring buffer, default = 30
+    skipFrames: Number of new frames to discard after start(), default = 0
+    """
+
+    def __init__(self, stats, tol=0.1, minFrames=3, maxFrames=30, skipFrames=0):
+        self.stats = stats
+        self.tol = tol
+        self.minFrames = minFrames
+        self.maxFrames = maxFrames
+        self.skipFrames = skipFrames
+        self._xy = np.full((maxFrames, 2), np.nan)
+        self._t = np.zeros(maxFrames)
+        self._n = 0
+        self._latest = [np.nan, np.nan]
+        self._latestT = [-np.inf, -np.inf]
+        self._pending = None
+        self._uidMin = None
+        self._lock = threading.Lock()
+        self._newFrame = threading.Event()
+        self._cids = []
+
+    def _add(self, timestamp):
+        # Called with the lock held
+        i = self._n % self.maxFrames
+        self._xy[i] = self._latest
+        self._t[i] = timestamp
+        self._n += 1
+        self._pending = None
+        self._newFrame.set()
+
+    def _on_centroid(self, axis, value, timestamp):
+        with self._lock:
+            self._latest[axis] = value
+            self._latestT[axis] = timestamp
+            if self._pending is not None and min(self._latestT) >= self._pending:
+                self._add(self._pending)
+
+    def _on_x(self, value, timestamp=None, **kwargs):
+        self._on_centroid(0, value, timestamp)
+
+    def _on_y(self, value, timestamp=None, **kwargs):
+        self._on_centroid(1, value, timestamp)
+
+    def _on_unique_id(self, value, timestamp=None, **kwargs):
+        with self._lock:
+            if self._pending is not None:
+                self._add(self._pending)
+            if self._uidMin is not None and value > self._uidMin:
+                self._pending = timestamp
+
+    def start(self):
+        self._n = 0
+        self._pending = None
+        self._uidMin = self.stats.unique_id.get() + self.skipFrames
+        self._cids = [(self.stats.centroid.x, self.stats.centroid.x.subscribe(self._on_x)),
+                      (self.stats.centroid.y, self.stats.centroid.y.subscribe(self._on_y)),
+                      (self.stats.unique_id, self.stats.unique_id.subscribe(self._on_unique_id, run=False))]
+
+    def stop(self):
+        for sig, cid in self._cids:
+            sig.unsubscribe(cid)
+        self._cids = []
+
+    def samples(self):
+        """
+        Returns the buffered centroids, shape (n, 2), and their timestamps
+        """
+        with self._lock:
+            n = min(self._n, self.maxFrames)
+            return self._xy[:n].copy(), self._t[:n].copy()
+
+    def result(self):
+        xy, _ = self.samples()
+        n = len(xy)
+        if n == 0:
+            print('No new frame from {}, using the current centroid'.format(self.stats.name))
+            return CentroidStats(self.stats.centroid.x.get(), self.stats.centroid.y.get(), np.nan, np.nan, 0)
+        sigma = xy.std(axis=0, ddof=1) if n > 1 else np.full(2, np.nan)
+        return CentroidStats(*xy.mean(axis=0), *sigma, n)
+
+    def converged(self):
+        n = min(self._n, self.maxFrames)
+        if n >= self.maxFrames:
+            return True
+        if n < max(self.minFrames, 2):
+            return False
+        r = self.result()
+        return max(r.sigma_x, r.sigma_y) / np.sqrt(r.n) < self.tol
+
+    def wait(self, timeout=5):
+        """
+        Blocks until converged or timeout [s], returns the result
+        """
+        tEnd = time.monotonic() + timeout
+        while not self.converged():
+            tLeft = tEnd - time.monotonic()
+            if tLeft <= 0:
+                print('Centroid averaging timed out after {} frames'.format(self._n))
+                break
+            self._newFrame.wait(tLeft)
+            self._newFrame.clear()
+        return self.result()
+
+
+def centroid_average(stats, tol=0.1, minFrames=3, maxFrames=30, timeout=5, skipFrames=0):
     """
-    Read centroid X and Y 10x and return mean of centroids.
+    Averages the centroids of new frames until converged, see CentroidAverager
+
+    stats: Stats plugin of an ophyd camera object, e.g. cam_8.stats4
+    tol: Standard error of the mean for convergence [px], default = 0.1
+    minFrames, maxFrames: Frame count limits, default = 3, 30
+    timeout: Maximum averaging time [s], default = 5
+    skipFrames: Number of new frames to discard first, default = 0
+
+    Returns CentroidStats(x, y, sigma_x, sigma_y, n)
+
+    Examples
+    --------
+    centroid_average(cam_8.stats4)
+    centroid_average(cam_7.stats4, tol=0.2, maxFrames=10)
+    """
+    avg = CentroidAverager(stats, tol=tol, minFrames=minFrames, maxFrames=maxFrames, skipFrames=skipFrames)
+    avg.start()
+    try:
+        return avg.wait(timeout=timeout)
+    finally:
+        avg.stop()
+
+
+def centroid_average_plan(stats, tol=0.1, minFrames=3, maxFrames=30, timeout=5, skipFrames=0):
+    """
+    Plan stub version of centroid_average(), waits with bps.sleep()
+
+    Examples
+    --------
+    c = yield from centroid_average_plan(cam_8.stats4)
+    """
+    avg = CentroidAverager(stats, tol=tol, minFrames=minFrames, maxFrames=maxFrames, skipFrames=skipFrames)
+    avg.start()
+    tEnd = time.monotonic() + timeout
+    try:
+        while not avg.converged() and time.monotonic() < tEnd:
+            yield from bps.sleep(0.02)
+    finally:
+        avg.stop()
+    return avg.result()
+
+
+def centroid_average_multi(statsList, tol=0.1, minFrames=3, maxFrames=30, timeout=5, skipFrames=0):
+    """
+    Averages the centroids of several cameras over the same time window
+
+    All averagers start together and run until each has converged, so the
+    cameras see the same frames period. Returns a list of CentroidStats.
+
+    Examples
+    --------
+    hiMag, loMag = centroid_average_multi([cam_8.stats4, cam_7.stats4])
+    """
+    avgs = [CentroidAverager(stats, tol=tol, minFrames=minFrames, maxFrames=maxFrames, skipFrames=skipFrames) for stats in statsList]
+    for avg in avgs:
+        avg.start()
+    tEnd = time.monotonic() + timeout
+    try:
+        return [avg.wait(timeout=max(tEnd - time.monotonic(), 0)) for avg in avgs]
+    finally:
+        for avg in avgs:
+            avg.stop()
+
+
+def centroid_avg(stats, tol=0.1, maxFrames=30, timeout=5):
+    """
+    Average centroid X and Y of new frames and return the mean of centroids.
+    
+    Stops once the standard error is below tol, see centroid_average()
     
     stats : stats method of ophyd camera object to use, e.g. cam_8.stats4
     
@@ -19,19 +214,224 @@ def centroid_avg(stats):
     centroidY = centroid_avg(cam_8.stats4)[1]
     """
     
-    centroidXArr = np.zeros(10)
-    centroidYArr = np.zeros(10)
-    for i in range(0, 10):
-        centroidXArr[i] = stats.centroid.x.get()
-        centroidYArr[i] = stats.centroid.y.get()
-        # print('Centroid X = {:.6g} px'.format(centroidXArr[i]), ', Centroid Y = {:.6g} px'.format(centroidYArr[i]))
-        time.sleep(0.2)
-    CentroidX = centroidXArr.mean()
-    CentroidY = centroidYArr.mean()
-    print('Mean centroid X = {:.6g} px'.format(CentroidX))
-    print('Mean centroid Y = {:.6g} px'.format(CentroidY))
+    c = centroid_average(stats, tol=tol, maxFrames=maxFrames, timeout=timeout)
+    print('Mean centroid X = {:.6g} px'.format(c.x), '(sigma {:.3g} px, {} frames)'.format(c.sigma_x, c.n))
+    print('Mean centroid Y = {:.6g} px'.format(c.y), '(sigma {:.3g} px, {} frames)'.format(c.sigma_y, c.n))
+
+    return c.x, c.y
+
+
+ROI_FIELDS = ('min_x', 'min_y', 'size_x', 'size_y')
+
+
+def roi_signals(roi):
+    """
+    Returns the geometry signals of an AD ROI plugin as {field: signal}
+    """
+    return {'min_x': roi.min_xyz.min_x, 'min_y': roi.min_xyz.min_y,
+            'size_x': roi.size.x, 'size_y': roi.size.y}
+
+
+class RoiTransactionError(ValueError):
+    """
+    Raised by RoiTransaction for a geometry value that can't be staged
+    """
+
+
+class RoiTransaction:
+    """
+    Stages ROI plugin geometry changes across cameras and writes them together
 
-    return CentroidX, CentroidY
+    The current geometry of a ROI is read once, when it is first used. Changes
+    are only staged until commit(), which validates all staged geometries
+    against the camera sensor size, writes the changed PVs concurrently,
+    verifies the readbacks, and writes the original geometry back if any
+    write or readback fails. Nothing is written if validation fails.
+
+    Values are rounded to whole pixels, as the ROI plugin PVs are integers.
+    Non-finite values raise RoiTransactionError and stage nothing.
+
+    Examples:
+    t = RoiTransaction()
+    t.copy(cam_8.roi1, cam_8.roi4)
+    t.shift(cam_8.roi2, dx=3, dy=-2)
+    t.set(cam_7.roi2, min_y=412)
+    t.commit()
+    """
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self._orig = {}
+        self._staged = {}
+        self._maxSize = {}
+        self.timing = {'read': 0.0, 'write': 0.0, 'rollback': 0.0}
+
+    def get(self, roi):
+        """
+        Returns the staged geometry of roi as a dict with keys min_x, min_y, size_x, size_y
+        """
+        if roi not in self._orig:
+            t0 = time.perf_counter()
+            self._orig[roi] = {k: int(round(sig.get())) for k, sig in roi_signals(roi).items()}
+            self._staged[roi] = dict(self._orig[roi])
+            self.timing['read'] += time.perf_counter() - t0
+        return dict(self._staged[roi])
+
+    def set(self, roi, min_x=None, min_y=None, size_x=None, size_y=None):
+        """
+        Stages new geometry values of roi, None keeps the staged value
+
+        Raises RoiTransactionError if any value is not finite, before staging any of them
+        """
+        values = {k: v for k, v in zip(ROI_FIELDS, (min_x, min_y, size_x, size_y)) if v is not None}
+        for k, v in values.items():
+            if not np.isfinite(v):
+                raise RoiTransactionError('{} {} = {} is not finite'.format(roi.name, k, v))
+        self.get(roi)
+        for k, v in values.items():
+            self._staged[roi][k] = int(round(v))
+
+    def shift(self, roi, dx=0, dy=0):
+        """
+        Stages a shift of the roi origin by dx, dy [px]
+        """
+        geo = self.get(roi)
+        self.set(roi, min_x=geo['min_x'] + dx, min_y=geo['min_y'] + dy)
+
+    def copy(self, src, dst):
+        """
+        Stages the staged geometry of src for dst
+        """
+        self.set(dst, **self.get(src))
+
+    def changes(self):
+        """
+        Returns the staged changes as a list of (roi, field, old, new)
+        """
+        return [(roi, k, self._orig[roi][k], geo[k])
+                for roi, geo in self._staged.items() for k in ROI_FIELDS
+                if geo[k] != self._orig[roi][k]]
+
+    def _max_size(self, roi):
+        camera = roi.parent
+        if camera not in self._maxSize:
+            self._maxSize[camera] = (camera.cam.max_size.max_size_x.get(),
+                                     camera.cam.max_size.max_size_y.get())
+        return self._maxSize[camera]
+
+    def validate(self):
+        """
+        Returns a list of problems of the staged geometries, empty if all fit the sensor
+        """
+        problems = []
+        for roi, geo in self._staged.items():
+            maxX, maxY = self._max_size(roi)
+            for axis, maxSize in (('x', maxX), ('y', maxY)):
+                start, size = geo['min_' + axis], geo['size_' + axis]
+                if size < 1:
+                    problems.append('{} size {} = {} < 1'.format(roi.name, axis, size))
+                if start < 0:
+                    problems.append('{} min {} = {} < 0'.format(roi.name, axis, start))
+                if start + size > maxSize:
+                    problems.append('{} min {} + size {} = {} > sensor size {}'.format(
+                        roi.name, axis, axis, start + size, maxSize))
+        return problems
+
+    def _write(self, items, sequential=False):
+        """
+        Writes [(signal, value)], returns the names of signals that failed or read back wrong
+        """
+        failed = []
+        if sequential:
+            for sig, value in items:
+                try:
+                    sig.set(value, timeout=self.timeout).wait(self.timeout)
+                except Exception:
+                    failed.append(sig.name)
+        else:
+            statuses = [(sig, sig.set(value, timeout=self.timeout)) for sig, value in items]
+            for sig, st in statuses:
+                try:
+                    st.wait(self.timeout)
+                except Exception:
+                    failed.append(sig.name)
+
+        for sig, value in items:
+            if sig.name not in failed and int(round(sig.get())) != value:
+                failed.append(sig.name)
+        return failed
+
+    def commit(self, sequential=False, verbose=True):
+        """
+        Validates and writes the staged changes, returns True on success
+
+        sequential: Write one PV after the other, for timing comparison, default = False
+        verbose: Print the number of PVs written and the timing, default = True
+        """
+        problems = self.validate()
+        if problems:
+            for problem in problems:
+                print(problem)
+            print('ROI changes not applied.')
+            return False
+
+        changes = self.changes()
+        if not changes:
+            return True
+        signals = [(roi_signals(roi)[k], new) for roi, k, old, new in changes]
+
+        t0 = time.perf_counter()
+        failed = self._write(signals, sequential=sequential)
+        self.timing['write'] = time.perf_counter() - t0
+
+        if failed:
+            print('ROI write failed for:', ', '.join(failed))
+            t0 = time.perf_counter()
+            rollback = [(roi_signals(roi)[k], old) for roi, k, old, new in changes]
+            failedRollback = self._write(rollback)
+            self.timing['rollback'] = time.perf_counter() - t0
+            if failedRollback:
+                print('ROI rollback failed for:', ', '.join(failedRollback),
+                      '- check the LSDC crosshairs.')
+            else:
+                print('ROI changes rolled back.')
+            return False
+
+        self._orig = {roi: dict(geo) for roi, geo in self._staged.items()}
+        if verbose:
+            print('ROI transaction: {} PVs on {} ROIs, read {:.0f} ms, write {:.0f} ms{}'.format(
+                len(changes), len({roi for roi, *_ in changes}),
+                1e3*self.timing['read'], 1e3*self.timing['write'],
+                ' (sequential)' if sequential else ''))
+        return True
+
+
+def roi_transaction_benchmark(rois=None, n=5):
+    """
+    Compares sequential and concurrent ROI writes, shifting rois by 1 px and back
+
+    rois: ROIs to shift, default = ROI4 of cam_8 and cam_7, which the alignment
+          functions use as scratch ROIs
+
+    Examples:
+    roi_transaction_benchmark()
+    """
+    if rois is None:
+        rois = [cam_8.roi4, cam_7.roi4]
+
+    tWrite = {False: [], True: []}
+    for i in range(n):
+        for sequential in (True, False):
+            for d in (1, -1):
+                t = RoiTransaction()
+                for roi in rois:
+                    t.shift(roi, dx=d, dy=d)
+                if not t.commit(sequential=sequential, verbose=False):
+                    return -1
+                tWrite[sequential].append(t.timing['write'])
+
+    print('{} PVs: sequential {:.0f} ms, concurrent {:.0f} ms'.format(
+        2*len(rois), 1e3*np.median(tWrite[True]), 1e3*np.median(tWrite[False])))
 
 
 def detectorCoverClose():
@@ -79,11 +479,36 @@ def transDefaultGet(energy):
     transDefault = np.interp(energy,transLUT['Energy'],transLUT['Position'])
     
     return transDefault
+
+
+def beam_center_trans_targets(transSet, energy):
+    """
+    Returns the attenuator transmissions for beam_center_align() as {trans: transmission}
+    
+    transSet: 'All', 'None', 'BCU' or 'RI', as in beam_center_align()
+    energy: X-ray energy [eV]
+    """
+    if transSet == 'None':
+        return {}
+    
+    transDefault = transDefaultGet(energy)
+    if blStrGet() != 'FMX':
+        return {trans_bcu: transDefault}
+    
+    transTargets = {}
+    if transSet in ['All', 'RI']:
+        transTargets[trans_ri] = transDefault
+    if transSet == 'BCU':
+        transTargets[trans_bcu] = transDefault
+    if transSet == 'All':
+        transTargets[trans_bcu] = 1
+    
+    return transTargets
     
     
 # Beam align functions
 
-def beam_center_align(transSet='All'):
+def beam_center_align(transSet='All', prepared=False):
     """
     Corrects alignment of goniometer and LSDC center point after a beam drift
     
@@ -99,6 +524,9 @@ def beam_center_align(transSet='All'):
               Set to 'None' if there are problems with all attenuators.
               Operator then has to choose a flux by hand that will not saturate scinti
               default = 'All'
+    prepared: Set to True if detector cover, Governor state AB, attenuators and CRLs
+              have already been set up, e.g. by setE(). Transmissions are then not restored.
+              default = False
               
     Examples
     --------
@@ -106,6 +534,12 @@ def beam_center_align(transSet='All'):
     RE(beam_center_align(transSet='None'))
     RE(beam_center_align(transSet='RI'))
     """
+    # Suspend the KB feedback while the beam and the crosshair are moved
+    with kb_feedback.paused():
+        return (yield from _beam_center_align(transSet=transSet, prepared=prepared))
+
+
+def _beam_center_align(transSet='All', prepared=False):
     # TODO:
     #  * Consider running with BCU attenuators only
     #  * Check for Vis screen actuators out
@@ -126,7 +560,7 @@ def beam_center_align(transSet='All'):
             print('transSet must be one of: All, None')
             return -1
         
-    if not govStatusGet('SA'):
+    if not prepared and not govStatusGet('SA'):
         print('Not in Governor state SA, exiting.')
         return -1
     
@@ -137,46 +571,33 @@ def beam_center_align(transSet='All'):
               'Exiting.')
         return -1
         
-    print('Closing detector cover')
-    detectorCoverClose()
-    
-    # Transition to Governor state AB (Auto-align Beam)
-    govStateSet('AB')
-    
-    # Set beam transmission that avoids scintillator saturation
-    # Default values are defined in settings as lookup table
-    if transSet != 'None':
-        transDefault = transDefaultGet( get_energy() )
-        if blStr == 'FMX':
-            if transSet in ['All', 'BCU']:
-                transOrgBCU = trans_get(trans=trans_bcu)
-            if transSet in ['All', 'RI']:
-                transOrgRI = trans_get(trans=trans_ri)
-                yield from trans_set(transDefault, trans=trans_ri)
-            if transSet == 'BCU':
-                yield from trans_set(transDefault, trans=trans_bcu)
-            if transSet == 'All':
-                yield from trans_set(1, trans=trans_bcu)
-        else:
-            transOrgBCU = trans_get(trans=trans_bcu)
-            yield from trans_set(transDefault, trans=trans_bcu)
-    
-    # Retract all CRLs, i.e. set beamsize to "not expanded"
-    # ToDo: write a "get_beamsize" to save current setting and restore later
-    set_beamsize('V0','H0')
+    if not prepared:
+        print('Closing detector cover')
+        yield from detectorCoverClose()
+        
+        # Transition to Governor state AB (Auto-align Beam)
+        govStateSet('AB')
+        
+        # Set beam transmission that avoids scintillator saturation
+        # Default values are defined in settings as lookup table
+        transTargets = beam_center_trans_targets(transSet, get_energy())
+        transOrg = {trans: trans_get(trans=trans) for trans in transTargets}
+        for trans, transmission in transTargets.items():
+            yield from trans_set(transmission, trans=trans)
+        
+        # Retract all CRLs, i.e. set beamsize to "not expanded"
+        # ToDo: write a "get_beamsize" to save current setting and restore later
+        yield from set_beamsize('V0','H0')
             
     # Retract backlight
     yield from bps.mv(light.y,govPositionGet('li', 'Out'))
     print('Light Y Out')
     
-    # TODO: use "yield from bps.mv(...)" instead of .put(...) below??!?
-
     # ROI1 centroid plugin does not work
     # Copy ROI1 geometry to ROI4 and use ROI4 centroid plugin
-    cam_8.roi4.min_xyz.min_x.put(cam_8.roi1.min_xyz.min_x.get())
-    cam_8.roi4.min_xyz.min_y.put(cam_8.roi1.min_xyz.min_y.get())
-    cam_8.roi4.size.x.put(cam_8.roi1.size.x.get())
-    cam_8.roi4.size.y.put(cam_8.roi1.size.y.get())
+    roiSetup = RoiTransaction()
+    roiSetup.copy(cam_8.roi1, cam_8.roi4)
+    roi4Ok = roiSetup.commit()
     
     yield from bps.mv(shutter_bcu.open, 1)
     print('BCU Shutter Open')
@@ -184,7 +605,9 @@ def beam_center_align(transSet='All'):
     
     # Check for focused beam on scinti. Do nothing if stats 4 max intensity < 20 counts
     # TODO: Verify 20 counts threshold for more settings
-    if cam_8.stats4.max_value.get() < 20:
+    if not roi4Ok:
+        print('ROI4 setup failed. No changes made.')
+    elif cam_8.stats4.max_value.get() < 20:
         print('Max intensity < 20 counts.',
               'Check beam intensity and focus on scinti, then repeat.',
               'No changes made.')
@@ -202,37 +625,41 @@ def beam_center_align(transSet='All'):
         # Get beam shift on Hi Mag
         # Assume the LSDC centering crosshair is in the center of the FOV
         # This works as long as cam_8 ROI1 does not hit the edge of the cam_8 image
-        beamHiMagDiffX = beamHiMagCentroidX - (cam_8.roi4.size.x.get()/2)
-        beamHiMagDiffY = beamHiMagCentroidY - (cam_8.roi4.size.y.get()/2)
+        roiShift = RoiTransaction()
+        roi4Geo = roiShift.get(cam_8.roi4)
+        beamHiMagDiffX = beamHiMagCentroidX - (roi4Geo['size_x']/2)
+        beamHiMagDiffY = beamHiMagCentroidY - (roi4Geo['size_y']/2)
         
-        # Do nothing if we see a too large shift
-        if beamHiMagDiffX>100 or beamHiMagDiffY>100:
+        # Do nothing without a valid centroid or if we see a too large shift
+        if not np.isfinite([beamHiMagDiffX, beamHiMagDiffY]).all():
+            print('No valid beam centroid.',
+                  'No changes made. Manual beam center correction needed.')
+            beamHiMagDiffX=0
+            beamHiMagDiffY=0
+        elif beamHiMagDiffX>100 or beamHiMagDiffY>100:
             print('Beam centroid change > 100 px detected.',
                   'No changes made. Manual beam center correction needed.')
             beamHiMagDiffX=0
             beamHiMagDiffY=0
         
-        # Correct Mag 4 (cam_8 ROI1)
-        # Adjust cam_8 ROI1 min_y, LSDC uses this for the Mag4 FOV.
-        # This works as long as cam_8 ROI1 does not hit the edge of the cam_8 image
-        cam_8.roi1.min_xyz.min_x.put(cam_8.roi1.min_xyz.min_x.get() + beamHiMagDiffX)
-        cam_8.roi1.min_xyz.min_y.put(cam_8.roi1.min_xyz.min_y.get() + beamHiMagDiffY)
-        
-        # Correct Mag 3 (cam_8 ROI2)
-        cam_8.roi2.min_xyz.min_x.put(cam_8.roi2.min_xyz.min_x.get() + beamHiMagDiffX)
-        cam_8.roi2.min_xyz.min_y.put(cam_8.roi2.min_xyz.min_y.get() + beamHiMagDiffY)
-        
         # Get beam shift on Lo Mag from Hi Mag shift and calibration factor ratio
         beamLoMagDiffX = beamHiMagDiffX * hiMagCal/loMagCal
         beamLoMagDiffY = beamHiMagDiffY * hiMagCal/loMagCal
         
-        # Correct Mag 1 (cam_7 ROI2)
-        cam_7.roi2.min_xyz.min_x.put(cam_7.roi2.min_xyz.min_x.get() + beamLoMagDiffX)
-        cam_7.roi2.min_xyz.min_y.put(cam_7.roi2.min_xyz.min_y.get() + beamLoMagDiffY)
+        # Correct Mag 4 (cam_8 ROI1) and Mag 3 (cam_8 ROI2)
+        # Adjust cam_8 ROI1 min_y, LSDC uses this for the Mag4 FOV.
+        # This works as long as cam_8 ROI1 does not hit the edge of the cam_8 image
+        roiShift.shift(cam_8.roi1, beamHiMagDiffX, beamHiMagDiffY)
+        roiShift.shift(cam_8.roi2, beamHiMagDiffX, beamHiMagDiffY)
+        
+        # Correct Mag 1 (cam_7 ROI2) and Mag 2 (cam_7 ROI3)
+        roiShift.shift(cam_7.roi2, beamLoMagDiffX, beamLoMagDiffY)
+        roiShift.shift(cam_7.roi3, beamLoMagDiffX, beamLoMagDiffY)
         
-        # Correct Mag 2 (cam_7 ROI3)
-        cam_7.roi3.min_xyz.min_x.put(cam_7.roi3.min_xyz.min_x.get() + beamLoMagDiffX)
-        cam_7.roi3.min_xyz.min_y.put(cam_7.roi3.min_xyz.min_y.get() + beamLoMagDiffY)
+        # All four crosshairs or none
+        if not roiShift.commit():
+            beamHiMagDiffY = 0
+            print('Crosshair correction failed. Gonio Y not moved.')
         
         time.sleep(3)
         
@@ -251,11 +678,6 @@ def beam_center_align(transSet='All'):
     govStateSet('SA')
     
     # Set previous beam transmission
-    if transSet != 'None':
-        if blStr == 'FMX':
-            if transSet in ['All', 'RI']:
-                yield from trans_set(transOrgRI, trans=trans_ri)
-            if transSet in ['All', 'BCU']:
-                yield from trans_set(transOrgBCU, trans=trans_bcu)
-        else:
-            yield from trans_set(transOrgBCU, trans=trans_bcu)
+    if not prepared:
+        for trans, transmission in transOrg.items():
+            yield from trans_set(transmission, trans=trans)
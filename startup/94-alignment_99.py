@@ -9,7 +9,191 @@ import numpy as np
 
 # Goniometer align functions
 
-def center_pin(cam=cam_8):
+def center_pin_roi4(cam, widthFraction, t=None):
+    """
+    Stages cam ROI4 as ROI2 narrowed to widthFraction of its width around its center
+
+    Returns the RoiTransaction t, a new one if None
+    """
+    if t is None:
+        t = RoiTransaction()
+    roi2 = t.get(cam.roi2)
+    width = roi2['size_x'] * widthFraction
+    t.set(cam.roi4, min_x=roi2['min_x'] + roi2['size_x']/2 - width/2, min_y=roi2['min_y'],
+          size_x=width, size_y=roi2['size_y'])
+    return t
+
+
+def center_pin_setup(cam):
+    """
+    Sets up cam ROI4, Proc1 and Stats4 to measure the pin centroid, returns the old centroid threshold
+    """
+    # Copy ROI2 geometry (HiMag Mag3 and LoMag Mag1) to ROI4, narrowed to 0.25 of
+    # the ROI2 width around its center, and use ROI4 centroid plugin
+    center_pin_roi4(cam, 0.25).commit()
+
+    # Invert camera image, so dark pin on light image becomes a peak
+    cam.proc1.scale.put(-1)
+
+    # High threshold, so AD centroid doesn't interpret background
+    camThresholdOld = cam.stats4.centroid_threshold.get()
+    cam.stats4.centroid_threshold.put(150)
+
+    return camThresholdOld
+
+
+def center_pin_restore(cam, camThresholdOld):
+    """
+    Restores cam Proc1 and Stats4 after center_pin_setup()
+    """
+    # De-invert image
+    cam.proc1.scale.put(1)
+
+    # Set thresold to previous value
+    cam.stats4.centroid_threshold.put(camThresholdOld)
+
+
+def runout_fit(omega, y):
+    """
+    Fits the runout of a point on a rotating pin, y = A*sin(omega) + B*cos(omega) + c
+
+    omega: Rotation angles [deg]
+    y: Measured positions, e.g. centroid Y [px]
+
+    Returns (A, B, c, rms), rms is the fit residual rms in units of y
+
+    Equivalent to y = R*sin(omega + phi) + c with R = sqrt(A^2+B^2), phi = atan2(B, A)
+    """
+    w = np.deg2rad(np.asarray(omega, dtype=float))
+    y = np.asarray(y, dtype=float)
+    M = np.column_stack([np.sin(w), np.cos(w), np.ones_like(w)])
+    (A, B, c), *_ = np.linalg.lstsq(M, y, rcond=None)
+    rms = np.sqrt(np.mean((M @ [A, B, c] - y)**2))
+
+    return A, B, c, rms
+
+
+def center_pin_rotate(cam=cam_8, rotationTime=10, minSamples=20):
+    """
+    Centers a pin in Y and Z from a continuous rotation there and back
+
+    Rotates Omega by +360 deg and back to the start at constant speed while
+    collecting the stats4 centroid Y of every new camera frame, tagged with the
+    Omega readback interpolated to the frame IOC timestamp. A least squares fit
+    of y = A*sin(omega) + B*cos(omega) + c per direction gives the same offsets
+    as center_pin() at 0/90/180/270 deg: Y offset = -B, Z offset = -A.
+    The frame timestamp lags the exposure, which shifts the fitted phase by
+    +/- speed*lag in the two directions; the average of both fits cancels it.
+
+    Requirements
+    ------------
+    * Alignment pin mounted. Pin should be aligned in X to within 0.25 of the Mag3 width
+
+    Parameters
+    ----------
+    cam: ophyd camera device. Should be cam_7 or cam_8 (default)
+    rotationTime: Duration of one rotation [s], default = 10
+    minSamples: Minimum number of frames per direction, default = 20
+
+    Examples
+    --------
+    RE(center_pin_rotate())
+    RE(center_pin_rotate(cam_7, rotationTime=20))
+    """
+
+    if cam not in [cam_7, cam_8]:
+        print('cam must be one of: [cam_7, cam_8]')
+        return -1
+
+    camThresholdOld = center_pin_setup(cam)
+    velocityOld = gonio.o.velocity.get()
+    omegaStart = gonio.o.user_readback.get()
+
+    frames = []   # IOC timestamp of each new frame
+    ys = []       # (IOC timestamp, centroid Y)
+    omegas = []   # (IOC timestamp, Omega readback)
+
+    def on_y(value, timestamp, **kwargs):
+        ys.append((timestamp, value))
+
+    def on_unique_id(value, timestamp, **kwargs):
+        frames.append(timestamp)
+
+    def on_omega(value, timestamp, **kwargs):
+        omegas.append((timestamp, value))
+
+    subscriptions = [(cam.stats4.centroid.y, cam.stats4.centroid.y.subscribe(on_y)),
+                     (gonio.o.user_readback, gonio.o.user_readback.subscribe(on_omega))]
+
+    def rotate():
+        yield from bps.mv(gonio.o.velocity, 360/rotationTime)
+        subscriptions.append((cam.stats4.unique_id, cam.stats4.unique_id.subscribe(on_unique_id, run=False)))
+        yield from bps.mv(gonio.o, omegaStart + 360)
+        yield from bps.mv(gonio.o, omegaStart)
+
+    def cleanup():
+        for sig, cid in subscriptions:
+            sig.unsubscribe(cid)
+        yield from bps.mv(gonio.o.velocity, velocityOld)
+        # Back to the start modulo 360 deg, by the shortest way after an abort
+        omegaNow = gonio.o.user_readback.get()
+        yield from bps.mv(gonio.o, omegaStart + 360*np.round((omegaNow - omegaStart)/360))
+        center_pin_restore(cam, camThresholdOld)
+
+    yield from bpp.finalize_wrapper(rotate(), cleanup())
+
+    frames = np.array(frames)
+    ys = np.array(ys)
+    omegas = np.array(omegas)
+    if len(frames) < 2*minSamples or len(ys) < 1 or len(omegas) < 2:
+        print('Only {} frames during rotation, need {}. No changes made.'.format(len(frames), 2*minSamples))
+        return -1
+
+    # The plugin posts UniqueId ahead of the centroid, so the centroid of a frame is the
+    # last Y update before the next frame, which is the previous value if Y did not change
+    ys = ys[np.argsort(ys[:, 0], kind='stable')]
+    nextFrame = np.append(frames[1:], np.inf)
+    iY = np.searchsorted(ys[:, 0], nextFrame, side='left') - 1
+    frameY = np.where(iY >= 0, ys[np.maximum(iY, 0), 1], np.nan)
+
+    inRange = (frames >= omegas[0, 0]) & (frames <= omegas[-1, 0]) & np.isfinite(frameY)
+    omega = np.interp(frames, omegas[:, 0], omegas[:, 1])
+
+    # One fit per direction, split where Omega turns
+    tTurn = omegas[np.argmax(omegas[:, 1]), 0]
+    fits = []
+    for direction, sel in (('+', inRange & (frames <= tTurn)), ('-', inRange & (frames > tTurn))):
+        if sel.sum() < minSamples:
+            print('Only {} frames rotating {}, need {}. No changes made.'.format(sel.sum(), direction, minSamples))
+            return -1
+        A, B, c, rms = runout_fit(omega[sel], frameY[sel])
+        print('Runout fit {}: {} frames, amplitude {:.3g} px, residual rms {:.3g} px'.format(
+            direction, sel.sum(), np.hypot(A, B), rms))
+        fits.append((A, B))
+    (A1, B1), (A2, B2) = fits
+    A, B = (A1 + A2)/2, (B1 + B2)/2
+    lagPhase = np.rad2deg(np.angle(complex(A1, B1) * complex(A2, -B2)))/2
+    print('Frame timestamp lag {:.2f} deg = {:.0f} ms, averaged out'.format(
+        lagPhase, 1e3*abs(lagPhase)*rotationTime/360))
+
+    # Camera calibration [um/px]
+    if cam==cam_8:
+        camCal = BL_calibration.HiMagCal.get()
+    elif cam==cam_7:
+        camCal = BL_calibration.LoMagCal.get()
+
+    # Center offsets Y and Z, as (c180 - c0)/2 and (c270 - c90)/2 in center_pin()
+    offsY = -B * camCal
+    print('Y offset = {:.6g} um'.format(offsY))
+    offsZ = -A * camCal
+    print('Z offset = {:.6g} um'.format(offsZ))
+
+    # Move pin to center
+    yield from bps.mvr(gonio.py,offsY)
+    yield from bps.mvr(gonio.pz,offsZ)
+
+
+def center_pin(cam=cam_8, continuous=False):
     """
     Centers a pin in Y
     
@@ -20,31 +204,31 @@ def center_pin(cam=cam_8):
     Parameters
     ----------
     cam: ophyd camera device. Should be cam_7 or cam_8 (default)
-    
+    continuous: Set to True to use center_pin_rotate(), a continuous rotation there and
+                back with a sinusoid fit instead of four Omega positions. default = False
+
     Examples
     --------
     RE(center_pin())
     RE(center_pin(cam_7))
+    RE(center_pin(continuous=True))
     """
-    
+    # Suspend the KB feedback, Stats4 shows the inverted pin image meanwhile
+    with kb_feedback.paused():
+        return (yield from _center_pin(cam=cam, continuous=continuous))
+
+
+def _center_pin(cam=cam_8, continuous=False):
+
+    if continuous:
+        return (yield from center_pin_rotate(cam))
+
     if cam not in [cam_7, cam_8]:
         print('cam must be one of: [cam_7, cam_8]')
         return -1
-    
-    # Copy ROI2 geometry (HiMag Mag3 and LoMag Mag1) to ROI4 and use ROI4 centroid plugin
-    cam.roi4.min_xyz.min_x.put(cam.roi2.min_xyz.min_x.get())
-    cam.roi4.min_xyz.min_y.put(cam.roi2.min_xyz.min_y.get())
-    cam.roi4.size.x.put(cam.roi2.size.x.get() * 0.25)
-    cam.roi4.size.y.put(cam.roi2.size.y.get())
-    cam.roi4.min_xyz.min_x.put(cam.roi2.min_xyz.min_x.get() + cam.roi2.size.x.get()/2 - cam.roi4.size.x.get()/2)
-    
-    # Invert camera image, so dark pin on light image becomes a peak
-    cam.proc1.scale.put(-1)
-    
-    # High threshold, so AD centroid doesn't interpret background
-    camThresholdOld = cam.stats4.centroid_threshold.get()
-    cam.stats4.centroid_threshold.put(150)
-    
+
+    camThresholdOld = center_pin_setup(cam)
+
     # Get centroids at Omega = 0, 90, 180, 270 deg
     yield from bps.mv(gonio.o,0)
     time.sleep(2)
@@ -62,6 +246,11 @@ def center_pin(cam=cam_8):
     time.sleep(2)
     c270 = centroid_avg(cam.stats4)[1]
     
+    if not np.isfinite([c0, c90, c180, c270]).all():
+        print('No valid pin centroid. No changes made.')
+        center_pin_restore(cam, camThresholdOld)
+        return -1
+    
     # Camera calibration [um/px]
     if cam==cam_8:
         camCal = BL_calibration.HiMagCal.get()
@@ -79,18 +268,18 @@ def center_pin(cam=cam_8):
     # Move pin to center
     yield from bps.mvr(gonio.py,offsY)
     yield from bps.mvr(gonio.pz,offsZ)
-    
-    # De-invert image
-    cam.proc1.scale.put(1)
-    
-    # Set thresold to previous value
-    cam.stats4.centroid_threshold.put(camThresholdOld)
-    
+
+    center_pin_restore(cam, camThresholdOld)
+
     
 def gonio_axis_align():
     """
     Center crosshair on pin
     
+    Both cameras are averaged at the same time, from the same frames window,
+    and all ROI geometry is computed from one read and then written.
+    Reports the rotation axis offset for HiMag and LoMag.
+    
     Requirements
     ------------
     * Alignment pin mounted and centered. Pin should be aligned in X to within 0.25 of the Mag3 width
@@ -100,60 +289,415 @@ def gonio_axis_align():
         * XF:17IDC-ES:FMX{Cam:8}Proc1:EnableOffsetScale
     """
     
-    # Invert camera image, so dark pin on light image becomes a peak
-    cam_7.proc1.scale.put(-1)
-    cam_8.proc1.scale.put(-1)
+    # ROI4 width as fraction of ROI2 width
+    roi4Width = {cam_8: 0.20, cam_7: 0.05}
     
+    # Frames to discard after a setting change, in case one is still in the pipeline
+    skipFrames = 1
+    
+    # Invert camera image, so dark pin on light image becomes a peak
     # High threshold, so AD centroid doesn't interpret background
     cam_8ThresholdOld = cam_8.stats4.centroid_threshold.get()
-    cam_8.stats4.centroid_threshold.put(150)
     cam_7ThresholdOld = cam_7.stats4.centroid_threshold.get()
-    cam_7.stats4.centroid_threshold.put(150)
-    
-    # HiMag
-    # Copy ROI2 geometry (HiMag Mag3) to ROI4 and use ROI4 centroid plugin
-    cam_8.roi4.min_xyz.min_x.put(cam_8.roi2.min_xyz.min_x.get())
-    cam_8.roi4.min_xyz.min_y.put(cam_8.roi2.min_xyz.min_y.get())
-    cam_8.roi4.size.x.put(cam_8.roi2.size.x.get() * 0.20)
-    cam_8.roi4.size.y.put(cam_8.roi2.size.y.get())
-    cam_8.roi4.min_xyz.min_x.put(cam_8.roi2.min_xyz.min_x.get() + cam_8.roi2.size.x.get()/2 - cam_8.roi4.size.x.get()/2)
-    
-    # LoMag
-    # Copy ROI2 geometry (LoMag Mag1) to ROI4 and use ROI4 centroid plugin
-    cam_7.roi4.min_xyz.min_x.put(cam_7.roi2.min_xyz.min_x.get())
-    cam_7.roi4.min_xyz.min_y.put(cam_7.roi2.min_xyz.min_y.get())
-    cam_7.roi4.size.x.put(cam_7.roi2.size.x.get() * 0.05)
-    cam_7.roi4.size.y.put(cam_7.roi2.size.y.get())
-    cam_7.roi4.min_xyz.min_x.put(cam_7.roi2.min_xyz.min_x.get() + cam_7.roi2.size.x.get()/2 - cam_7.roi4.size.x.get()/2)
-    
-    centerPinYHiMag0 = centroid_avg(cam_8.stats4)[1]
-    centerPinYLoMag0 = centroid_avg(cam_7.stats4)[1]
-    yield from bps.mvr(gonio.o,180)
-    time.sleep(2)
-    centerPinYHiMag180 = centroid_avg(cam_8.stats4)[1]
-    centerPinYLoMag180 = centroid_avg(cam_7.stats4)[1]
-    centerPinYHiMag = (centerPinYHiMag0 + centerPinYHiMag180)/2
-    centerPinYLoMag = (centerPinYLoMag0 + centerPinYLoMag180)/2
+    
+    def restore():
+        # De-invert image and set thresold to previous value, also after a failure or abort
+        yield from bps.mv(cam_7.proc1.scale, 1, cam_8.proc1.scale, 1,
+                          cam_8.stats4.centroid_threshold, cam_8ThresholdOld,
+                          cam_7.stats4.centroid_threshold, cam_7ThresholdOld)
+    
+    def align():
+        statuses = [cam_7.proc1.scale.set(-1), cam_8.proc1.scale.set(-1),
+                    cam_8.stats4.centroid_threshold.set(150), cam_7.stats4.centroid_threshold.set(150)]
+        
+        # Copy ROI2 geometry (HiMag Mag3, LoMag Mag1) to ROI4, narrowed around the ROI2 center,
+        # and use ROI4 centroid plugin. The transaction keeps the ROI geometry read once.
+        rois = RoiTransaction()
+        for cam, frac in roi4Width.items():
+            center_pin_roi4(cam, frac, t=rois)
+        if not rois.commit():
+            print('ROI4 setup failed. No changes made.')
+            return -1
+        geo = {roi: rois.get(roi) for roi in (cam_8.roi1, cam_8.roi2, cam_7.roi2, cam_7.roi3)}
+        for st in statuses:
+            st.wait(5)
+        
+        # Both cameras at the same time, only frames taken after the setup
+        hiMag0, loMag0 = centroid_average_multi([cam_8.stats4, cam_7.stats4], skipFrames=skipFrames)
+        yield from bps.mvr(gonio.o,180)
+        time.sleep(2)
+        hiMag180, loMag180 = centroid_average_multi([cam_8.stats4, cam_7.stats4], skipFrames=skipFrames)
+        if not np.isfinite([c.y for c in (hiMag0, loMag0, hiMag180, loMag180)]).all():
+            print('No valid pin centroid. No changes made.')
+            return -1
+        
+        centerPinYHiMag = (hiMag0.y + hiMag180.y)/2
+        centerPinYLoMag = (loMag0.y + loMag180.y)/2
+        
+        centerPinOffsYHiMag = centerPinYHiMag - geo[cam_8.roi2]['size_y'] / 2
+        centerPinOffsYLoMag = centerPinYLoMag - geo[cam_7.roi2]['size_y'] / 2
+        
+        print('Rotation axis offset HiMag = {:.2f} px = {:.3f} um'.format(
+            centerPinOffsYHiMag, centerPinOffsYHiMag * BL_calibration.HiMagCal.get()))
+        print('Rotation axis offset LoMag = {:.2f} px = {:.3f} um'.format(
+            centerPinOffsYLoMag, centerPinOffsYLoMag * BL_calibration.LoMagCal.get()))
+        
+        # Correct Mag 3 (cam_8 ROI2) and Mag 4 (cam_8 ROI1)
+        hiMagRoi2Y = geo[cam_8.roi2]['min_y'] + centerPinOffsYHiMag
+        rois.set(cam_8.roi2, min_y=hiMagRoi2Y)
+        rois.set(cam_8.roi1, min_y=hiMagRoi2Y + (geo[cam_8.roi2]['size_y'] - geo[cam_8.roi1]['size_y'])/2)
+        
+        # Correct Mag 1 (cam_7 ROI2) and Mag 2 (cam_7 ROI3)
+        loMagRoi2Y = geo[cam_7.roi2]['min_y'] + centerPinOffsYLoMag
+        rois.set(cam_7.roi2, min_y=loMagRoi2Y)
+        rois.set(cam_7.roi3, min_y=loMagRoi2Y + (geo[cam_7.roi2]['size_y'] - geo[cam_7.roi3]['size_y'])/2)
+        
+        # All four crosshairs or none
+        if not rois.commit():
+            print('Crosshair update failed. No changes made.')
+            return -1
+        
+        return
+    
+    return (yield from bpp.finalize_wrapper(align(), restore()))
+
+
+# Camera calibration functions
 
-    centerPinOffsYHiMag = centerPinYHiMag - cam_8.roi4.size.y.get() / 2
-    centerPinOffsYLoMag = centerPinYLoMag - cam_7.roi4.size.y.get() / 2
+CAMERA_CAL_SIGNALS = {'cam_8': 'HiMagCal', 'cam_7': 'LoMagCal'}
+
+
+def camera_calibration_fit(stage, shifts, minPeak=0.05):
+    """
+    Fits image shifts to stage displacements for one camera
     
-    # Correct Mag 3 (cam_8 ROI2)
-    cam_8.roi2.min_xyz.min_y.put(cam_8.roi2.min_xyz.min_y.get() + centerPinOffsYHiMag)
-    # Correct Mag 4 (cam_8 ROI1)
-    cam_8.roi1.min_xyz.min_y.put(cam_8.roi2.min_xyz.min_y.get() + (cam_8.roi2.size.y.get()-cam_8.roi1.size.y.get())/2)
+    Least squares fit of the 2x2 matrix M in shift = M @ displacement. Its
+    inverse P maps pixels to stage microns: the column norms are the pixel
+    sizes along image X and Y, the column angle the image rotation.
+    
+    stage: Stage displacements, shape (n, 2) [um]
+    shifts: Image shifts (dx, dy, peak) from image_shift(), shape (n, 3)
+    minPeak: Shifts with a lower correlation peak are not used, default = 0.05
+    
+    Returns a dict with keys cal, cal_x, cal_y [um/px], rotation [deg],
+    residual_px, residual_um, n, P, or None if there are too few valid shifts
+    """
+    stage = np.asarray(stage, dtype=float)
+    shifts = np.asarray(shifts, dtype=float)
+    valid = shifts[:, 2] >= minPeak
+    S, D = stage[valid], shifts[valid, :2]
+    if valid.sum() < 3 or np.linalg.matrix_rank(S) < 2:
+        return None
     
-    # Correct Mag 1 (cam_7 ROI2)
-    cam_7.roi2.min_xyz.min_y.put(cam_7.roi2.min_xyz.min_y.get() + centerPinOffsYLoMag)
-    # Correct Mag 2 (cam_7 ROI3)
-    cam_7.roi3.min_xyz.min_y.put(cam_7.roi2.min_xyz.min_y.get() + (cam_7.roi2.size.y.get()-cam_7.roi3.size.y.get())/2)
+    X = np.linalg.lstsq(S, D, rcond=None)[0]  # D = S @ X, M = X.T
+    P = np.linalg.inv(X.T)
+    calX, calY = np.linalg.norm(P, axis=0)
+    cal = np.sqrt(abs(np.linalg.det(P)))
+    residualPx = np.sqrt(np.mean(np.sum((D - S @ X)**2, axis=1)))
+    
+    return {'cal': cal, 'cal_x': calX, 'cal_y': calY,
+            'rotation': np.degrees(np.arctan2(P[1, 0], P[0, 0])),
+            'residual_px': residualPx, 'residual_um': residualPx * cal,
+            'n': int(valid.sum()), 'P': P}
 
-    # De-invert image
-    cam_7.proc1.scale.put(-1)
-    cam_8.proc1.scale.put(-1)
+
+def camera_calibrate(cams=None, motors=None, steps=(-20, -10, 10, 20), settleTime=0.5,
+                     boxes=None, minPeak=0.05, maxResidual=0.5, write=False):
+    """
+    Calibrates the camera pixel sizes by moving a sample by known steps
     
-    # Set thresold to previous value
-    cam_8.stats4.centroid_threshold.put(cam_8ThresholdOld)
-    cam_7.stats4.centroid_threshold.put(cam_7ThresholdOld)
+    Moves each of the two stage motors by steps from the current position and
+    measures the image shift on every camera by FFT phase correlation against
+    the start frame. Fits scale and rotation per camera, see
+    camera_calibration_fit(), and reports them with the current BL_calibration
+    values. The motors are moved back to the start position.
     
-    return
+    Requirements
+    ------------
+    * A sample with structure in both directions, e.g. a mesh or chip, in focus on both cameras
+    * Governor in SA state
+    
+    Parameters
+    ----------
+    cams: Cameras, default = [cam_8, cam_7]
+    motors: Two stage motors moving the sample across the image [um], e.g. the x and y
+            motors of a ChipScanner, default = (gonio.gx, gonio.py)
+    steps: Relative positions of each motor [um], default = (-20, -10, 10, 20)
+    settleTime: Wait after each move [s], default = 0.5
+    boxes: {camera: crop box (x0, y0, nx, ny)}, default = full frames.
+           Shifts must stay well below half the box size.
+    minPeak: Minimum phase correlation peak of a used shift, default = 0.05
+    maxResidual: Largest fit residual [px] for writing the calibration, default = 0.5
+    write: Write the pixel sizes to BL_calibration, default = False
+    
+    Returns {camera name: fit result}
+    
+    Examples
+    --------
+    RE(camera_calibrate())
+    RE(camera_calibrate(write=True))
+    RE(camera_calibrate(cams=[cam_7], steps=(-100, -50, 50, 100)))
+    RE(camera_calibrate(motors=(gonio.gx, gonio.pz)))
+    """
+    if not govStatusGet('SA'):
+        print('Not in Governor state SA, exiting')
+        return -1
+    
+    if cams is None:
+        cams = [cam_8, cam_7]
+    if motors is None:
+        motors = (gonio.gx, gonio.py)
+    if boxes is None:
+        boxes = {}
+    
+    origin = [m.position for m in motors]
+    points = [(d, 0) for d in steps] + [(0, d) for d in steps]
+    shifts = {cam.name: [] for cam in cams}
+    tStart = time.time()
+    
+    def move_to(point):
+        args = []
+        for m, o, d in zip(motors, origin, point):
+            args += [m, o + d]
+        yield from bps.mv(*args)
+        yield from bps.sleep(settleTime)
+    
+    def grab():
+        ids = {cam.name: cam.image.array_counter.get() for cam in cams}
+        return {cam.name: camera_frame(cam, box=boxes.get(cam), after_id=ids[cam.name]) for cam in cams}
+    
+    def inner():
+        refs = grab()
+        for point in points:
+            yield from move_to(point)
+            frames = grab()
+            for cam in cams:
+                shifts[cam.name].append(image_shift(refs[cam.name], frames[cam.name]))
+    
+    yield from bpp.finalize_wrapper(inner(), move_to((0, 0)))
+    
+    results = {}
+    for cam in cams:
+        fit = camera_calibration_fit(points, shifts[cam.name], minPeak=minPeak)
+        results[cam.name] = fit
+        if fit is None:
+            print('{}: too few valid image shifts, increase the crop box or reduce steps'.format(cam.name))
+            continue
+        
+        calSignal = getattr(BL_calibration, CAMERA_CAL_SIGNALS[cam.name]) if cam.name in CAMERA_CAL_SIGNALS else None
+        calOld = calSignal.get() if calSignal is not None else np.nan
+        print('{}: {:.5g} um/px (X {:.5g}, Y {:.5g}), rotation {:.2f} deg,'.format(
+            cam.name, fit['cal'], fit['cal_x'], fit['cal_y'], fit['rotation']),
+              'residual {:.2f} px = {:.3f} um, {} shifts, current {:.5g} um/px'.format(
+            fit['residual_px'], fit['residual_um'], fit['n'], calOld))
+        
+        if write and calSignal is not None:
+            if fit['residual_px'] > maxResidual:
+                print('{}: residual > {} px, calibration not written'.format(cam.name, maxResidual))
+                continue
+            calSignal.put(fit['cal'])
+            log_fmx('{} calibration {:.5g} um/px (was {:.5g}), residual {:.2f} px'.format(
+                CAMERA_CAL_SIGNALS[cam.name], fit['cal'], calOld, fit['residual_px']))
+    
+    print('Camera calibration took {:.0f} s'.format(time.time() - tStart))
+    
+    return results
+
+
+# Beam position feedback
+
+class KbFeedback(BackgroundLoop):
+    """
+    Keeps the beam on a target position with PI feedback on the KB piezo tweak voltages
+    
+    Reads the beam position from a camera stats plugin centroid or a BPM, and
+    corrects it with the VKB (Y) and HKB (X) tweak voltages. Per axis, the
+    voltage is
+    
+        V = V0 - (kp*e + ki*sum(e*dt)) / response
+    
+    with the position error e and the position response per volt. Voltage
+    changes are limited to maxRate and the voltage to vRange; the integral
+    is held while an axis is limited (anti-windup).
+    
+    The loop suspends, leaving the voltages as they are, unless the Governor
+    is in one of govStates with the beam on the scintillator and the RunEngine
+    is idle. It also suspends while the FOE or hutch shutter is closed, for the
+    camera also the BCU shutter, or while the intensity is below minIntensity.
+    Alignment plans suspend it with kb_feedback.paused(). Camera frames are
+    used once; steps without a new frame only count as stale.
+    
+    The response sign depends on the camera orientation, so start() refuses
+    to run until measure_response() has set it.
+    
+    Parameters
+    ----------
+    
+    source: 'cam' for the stats plugin centroid [px], 'bpm' for the BPM position, default = 'cam'
+    stats: Stats plugin, default = cam_8.stats4
+    bpm: BPM, default = bpm4
+    target: Target (x, y), default = None, the position at start
+    response: Position change per tweak volt (x, y) [px/V or BPM units/V],
+              default = None, to be measured with measure_response()
+    kp, ki: Proportional gain, integral gain [1/s], default = 0.3, 0.5
+    maxRate: Largest voltage change [V/s], default = 0.5
+    vRange: Tweak voltage limits [V], default = (-5, 5)
+    minIntensity: Suspend below this stats max value or BPM sum, default = 20
+    govStates: Governor states in which the loop may act, default = ('AB', 'BL')
+    period: Loop period [s], default = 0.2
+    
+    Examples
+    --------
+    
+    kb_feedback.measure_response()
+    kb_feedback.start()
+    kb_feedback.status()
+    kb_feedback.ki = 0.2
+    kb_feedback.stop()
+    kb_feedback_bpm = KbFeedback(source='bpm', minIntensity=1e-8)
+    """
+    
+    def __init__(self, source='cam', stats=cam_8.stats4, bpm=bpm4, target=None, response=None,
+                 kp=0.3, ki=0.5, maxRate=0.5, vRange=(-5, 5), minIntensity=20, govStates=('AB', 'BL'),
+                 period=0.2):
+        super().__init__('KB feedback ({})'.format(source), period)
+        if source not in ('cam', 'bpm'):
+            raise ValueError("source must be one of: 'cam', 'bpm'")
+        self.source = source
+        self.stats = stats
+        self.bpm = bpm
+        self.target = target
+        self.response = response
+        self.kp = kp
+        self.ki = ki
+        self.maxRate = maxRate
+        self.vRange = vRange
+        self.minIntensity = minIntensity
+        self.govStates = govStates
+        self.tweaks = (hkb_piezo_tweak, vkb_piezo_tweak)  # X, Y
+    
+    def reset_metrics(self):
+        super().reset_metrics()
+        self.metrics.update({'error_x': np.nan, 'error_y': np.nan, 'error_rms': np.nan,
+                             'v_x': np.nan, 'v_y': np.nan, 'stale': 0, 'limited': 0})
+        self._sumSq = 0.0
+        self._nErr = 0
+    
+    def position(self):
+        """
+        Returns the current beam position (x, y)
+        """
+        if self.source == 'cam':
+            return self.stats.centroid.x.get(), self.stats.centroid.y.get()
+        return self.bpm.x.get(), self.bpm.y.get()
+    
+    def intensity(self):
+        if self.source == 'cam':
+            return self.stats.max_value.get()
+        return self.bpm.sum_all.get()
+    
+    def start(self):
+        if self.running:
+            print('{} already running'.format(self.name))
+            return
+        if self.response is None:
+            print('{} response unknown, run measure_response() first'.format(self.name))
+            return
+        if self.target is None:
+            self.target = self.position()
+        self._reset_controller()
+        super().start()
+    
+    def _reset_controller(self):
+        self.v0 = np.array([t.get() for t in self.tweaks], dtype=float)
+        self.v = self.v0.copy()
+        self._integral = np.zeros(2)
+        self._lastId = None
+        self._lastTime = None
+    
+    def suspend_reason(self):
+        if RE.state != 'idle':
+            return 'RunEngine {}'.format(RE.state)
+        if not any(govStatusGet(state) == 1 for state in self.govStates):
+            return 'Governor not in {}'.format('/'.join(self.govStates))
+        if shutter_foe.status.get():
+            return 'FOE shutter closed'
+        if shutter_hutch_c.status.get():
+            return 'Hutch shutter closed'
+        if self.source == 'cam' and shutter_bcu.status.get():
+            return 'BCU shutter closed'
+        if self.intensity() < self.minIntensity:
+            return 'Low intensity'
+        return None
+    
+    def on_resume(self):
+        # Continue from the voltages as they are, e.g. after a manual change
+        self._reset_controller()
+    
+    def step(self):
+        if self.source == 'cam':
+            frameId = self.stats.unique_id.get()
+            if frameId == self._lastId:
+                self.metrics['stale'] += 1
+                return
+            self._lastId = frameId
+        
+        tNow = time.monotonic()
+        dt = self.period if self._lastTime is None else tNow - self._lastTime
+        self._lastTime = tNow
+        
+        error = np.array(self.position()) - np.array(self.target)
+        response = np.array(self.response, dtype=float)
+        
+        integral = self._integral + error*dt
+        vWanted = self.v0 - (self.kp*error + self.ki*integral) / response
+        vMax = self.maxRate*dt
+        v = np.clip(vWanted, self.v - vMax, self.v + vMax)
+        v = np.clip(v, *self.vRange)
+        limited = v != vWanted
+        
+        # Anti-windup: only integrate unlimited axes
+        self._integral = np.where(limited, self._integral, integral)
+        if limited.any():
+            self.metrics['limited'] += 1
+        
+        for tweak, vOld, vNew in zip(self.tweaks, self.v, v):
+            if vNew != vOld:
+                tweak.put(vNew)
+        self.v = v
+        
+        self._sumSq += np.sum(error**2)
+        self._nErr += 1
+        self.metrics.update({'error_x': error[0], 'error_y': error[1],
+                             'error_rms': np.sqrt(self._sumSq/self._nErr),
+                             'v_x': v[0], 'v_y': v[1]})
+    
+    def measure_response(self, dv=0.2, settleTime=1.0):
+        """
+        Measures the position response per tweak volt of both axes, sets and returns it
+        
+        Steps each tweak voltage by +dv and -dv around its current value. Run
+        with the loop stopped and beam on the camera or BPM.
+        """
+        if self.running:
+            print('Stop {} first'.format(self.name))
+            return None
+        
+        response = []
+        for axis, tweak in enumerate(self.tweaks):
+            v0 = tweak.get()
+            positions = []
+            for v in (v0 + dv, v0 - dv):
+                tweak.put(v)
+                time.sleep(settleTime)
+                positions.append(self.position()[axis])
+            tweak.put(v0)
+            response.append((positions[0] - positions[1]) / (2*dv))
+        time.sleep(settleTime)
+        
+        self.response = tuple(response)
+        print('{} response X = {:.4g} /V, Y = {:.4g} /V'.format(self.name, *self.response))
+        return self.response
+
+
+kb_feedback = KbFeedback()
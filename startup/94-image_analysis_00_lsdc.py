@@ -0,0 +1,543 @@
+# Python-side analysis of Prosilica camera frames
+#
+# Pulls frames from the AD ImagePlugin into numpy and computes the statistics
+# the AD Stats plugins provide, plus profile fits and pin edges, without
+# depending on ROI/Stats/Process plugin settings.
+#
+# Conventions follow NDPluginStats:
+# * Centroid and moments are computed from pixel values with values below the
+#   centroid threshold set to 0, in pixel coordinates of the analyzed array
+#   (i.e. relative to the ROI origin when a ROI is given)
+# * sigma_xy is the normalized covariance <(x-cx)(y-cy)>/(sigma_x*sigma_y)
+# * max_x/max_y give the first maximum pixel in row-major order
+
+import time
+import threading
+import numpy as np
+from collections import namedtuple
+from scipy.optimize import curve_fit
+
+
+FrameStats = namedtuple('FrameStats', ['total', 'min_value', 'max_value', 'max_x', 'max_y',
+                                       'mean', 'sigma', 'centroid_total', 'centroid_x', 'centroid_y',
+                                       'sigma_x', 'sigma_y', 'sigma_xy'])
+
+GaussFit = namedtuple('GaussFit', ['amplitude', 'center', 'sigma', 'offset'])
+
+PinEdges = namedtuple('PinEdges', ['top', 'bottom', 'center', 'width', 'tip'])
+
+
+def frame_layout(camera):
+    """
+    Returns the numpy shape of an ImagePlugin frame and the axis of its rows,
+    and the color axis or None for mono frames
+
+    AD orders dimensions fastest first (ArraySize0 = X for mono and RGB2/RGB3,
+    color for RGB1), numpy C order slowest first.
+    """
+    ndim = camera.image.ndimensions.get()
+    size = camera.image.array_size.get()
+    dims = [size.width, size.height, size.depth][:ndim]  # ArraySize0, 1, 2
+    shape = tuple(dims[::-1])
+
+    colorAxis = None
+    if ndim == 3:
+        colorAxis = [i for i, n in enumerate(shape) if n == 3][-1]
+    rowAxis = [i for i in range(len(shape)) if i != colorAxis][0]
+
+    return shape, rowAxis, colorAxis
+
+
+def roi_box(roi):
+    """
+    Returns the geometry of a ROI plugin as a box (x0, y0, nx, ny) [px]
+    """
+    return (int(roi.min_xyz.min_x.get()), int(roi.min_xyz.min_y.get()),
+            int(roi.size.x.get()), int(roi.size.y.get()))
+
+
+def frame_fetch(camera, roi=None, box=None, layout=None):
+    """
+    Returns the current ImagePlugin frame as a 2D float array, summed over colors
+
+    camera: ophyd camera object, e.g. cam_8
+    roi: ROI plugin whose geometry crops the frame, e.g. cam_8.roi1, default = None
+    box: Crop box (x0, y0, nx, ny) [px] instead of a ROI plugin, default = None
+    layout: frame_layout(camera), read from the camera if None
+
+    With a ROI, only the rows up to the bottom of the ROI are transferred when
+    rows are the slowest frame axis (mono, RGB1, RGB2), then the frame is
+    cropped in numpy. The image plugin has to receive the full camera frame.
+
+    Examples:
+    img = frame_fetch(cam_8)
+    img = frame_fetch(cam_8, roi=cam_8.roi1)
+    """
+    shape, rowAxis, colorAxis = layout if layout is not None else frame_layout(camera)
+
+    if roi is not None:
+        box = roi_box(roi)
+    if box is not None:
+        x0, y0, nx, ny = box
+        nRows = min(y0 + ny, shape[rowAxis])
+    else:
+        nRows = shape[rowAxis]
+
+    if rowAxis == 0:
+        shape = (nRows,) + shape[1:]
+    count = int(np.prod(shape))
+
+    frame = np.asarray(camera.image.array_data.get(count=count))[:count].reshape(shape)
+    if colorAxis is not None:
+        frame = frame.sum(axis=colorAxis)
+    frame = frame.astype(float)
+
+    if box is not None:
+        frame = frame[y0:y0 + ny, x0:x0 + nx]
+
+    return frame
+
+
+def frame_invert(frame, maxValue=None):
+    """
+    Returns the inverted frame maxValue - frame, default maxValue = frame maximum
+
+    Replaces inverting the image with the Process plugin (scale -1) for dark objects like a pin
+    """
+    if maxValue is None:
+        maxValue = frame.max()
+    return maxValue - frame
+
+
+def frame_stats(frame, threshold=0):
+    """
+    Returns AD Stats plugin style statistics of a 2D frame
+
+    frame: 2D array
+    threshold: Centroid threshold, pixel values below it count as 0 for the centroid
+
+    Returns FrameStats
+    """
+    ny, nx = frame.shape
+    iMax = int(np.argmax(frame))
+
+    w = np.where(frame < threshold, 0.0, frame) if threshold else frame
+    colSum = w.sum(axis=0)
+    rowSum = w.sum(axis=1)
+    m00 = colSum.sum()
+
+    x = np.arange(nx, dtype=float)
+    y = np.arange(ny, dtype=float)
+    if m00 > 0:
+        cx = colSum @ x / m00
+        cy = rowSum @ y / m00
+        sx = np.sqrt(max(colSum @ x**2 / m00 - cx**2, 0))
+        sy = np.sqrt(max(rowSum @ y**2 / m00 - cy**2, 0))
+        sxy = (y @ w @ x / m00 - cx*cy) / (sx*sy) if sx > 0 and sy > 0 else 0.0
+    else:
+        cx = cy = sx = sy = sxy = np.nan
+
+    return FrameStats(total=frame.sum(), min_value=frame.min(), max_value=frame.flat[iMax],
+                      max_x=iMax % nx, max_y=iMax // nx,
+                      mean=frame.mean(), sigma=frame.std(),
+                      centroid_total=m00, centroid_x=cx, centroid_y=cy,
+                      sigma_x=sx, sigma_y=sy, sigma_xy=sxy)
+
+
+def _gauss(x, amplitude, center, sigma, offset):
+    return amplitude*np.exp(-0.5*((x - center)/sigma)**2) + offset
+
+
+def profile_fit(profile):
+    """
+    Fits a Gaussian with offset to a 1D profile, seeded from its moments
+
+    Returns GaussFit, with NaN values if the fit fails
+    """
+    profile = np.asarray(profile, dtype=float)
+    x = np.arange(len(profile), dtype=float)
+    offset = np.percentile(profile, 10)
+    w = np.clip(profile - offset, 0, None)
+    if w.sum() <= 0:
+        return GaussFit(np.nan, np.nan, np.nan, np.nan)
+    center = w @ x / w.sum()
+    sigma = max(np.sqrt(w @ (x - center)**2 / w.sum()), 0.5)
+    try:
+        p, _ = curve_fit(_gauss, x, profile, p0=(w.max(), center, sigma, offset))
+    except (RuntimeError, ValueError):
+        return GaussFit(np.nan, np.nan, np.nan, np.nan)
+    return GaussFit(p[0], p[1], abs(p[2]), p[3])
+
+
+def frame_profiles(frame, threshold=0, fit=True):
+    """
+    Returns average X and Y profiles of a frame, and their Gaussian fits
+
+    frame: 2D array
+    threshold: Pixel values below it count as 0
+    fit: Fit Gaussians to the profiles, default = True
+
+    Returns (profileX, profileY, fitX, fitY), fits are None if fit=False
+    """
+    w = np.where(frame < threshold, 0.0, frame) if threshold else frame
+    profileX = w.mean(axis=0)
+    profileY = w.mean(axis=1)
+    if not fit:
+        return profileX, profileY, None, None
+    return profileX, profileY, profile_fit(profileX), profile_fit(profileY)
+
+
+def pin_edges(frame, threshold, invert=False, tipSide='left'):
+    """
+    Finds the top and bottom edge of a horizontal pin in every column
+
+    frame: 2D array
+    threshold: Pixels above it belong to the pin (after inversion)
+    invert: Set to True for a dark pin on a bright background, default = False
+    tipSide: Side of the frame the pin tip points to, 'left' or 'right'
+
+    Returns PinEdges with per-column arrays top, bottom, center, width [px]
+    (NaN for columns without pin) and the tip column (NaN without pin).
+    """
+    if invert:
+        frame = frame_invert(frame)
+    mask = frame > threshold
+    ny = mask.shape[0]
+
+    hasPin = mask.any(axis=0)
+    top = np.where(hasPin, np.argmax(mask, axis=0), np.nan)
+    bottom = np.where(hasPin, ny - 1 - np.argmax(mask[::-1], axis=0), np.nan)
+
+    cols = np.flatnonzero(hasPin)
+    if len(cols) == 0:
+        tip = np.nan
+    else:
+        tip = cols[0] if tipSide == 'left' else cols[-1]
+
+    return PinEdges(top=top, bottom=bottom, center=(top + bottom)/2,
+                    width=bottom - top + 1, tip=tip)
+
+
+def frame_analyze(camera, roi=None, threshold=0, invert=False, fit=False):
+    """
+    Fetches a frame and returns its AD style statistics
+
+    camera: ophyd camera object, e.g. cam_8
+    roi: ROI plugin to crop to, e.g. cam_8.roi1, default = None
+    threshold: Centroid threshold, default = 0
+    invert: Invert the frame first, for a dark object, default = False
+    fit: Also return Gaussian fits of the X and Y profiles, default = False
+
+    Returns FrameStats, or (FrameStats, fitX, fitY) if fit=True
+
+    Examples
+    --------
+    frame_analyze(cam_8, roi=cam_8.roi1)
+    frame_analyze(cam_8, roi=cam_8.roi2, threshold=150, invert=True)
+    """
+    frame = frame_fetch(camera, roi=roi)
+    if invert:
+        frame = frame_invert(frame)
+    stats = frame_stats(frame, threshold=threshold)
+    if not fit:
+        return stats
+    _, _, fitX, fitY = frame_profiles(frame, threshold=threshold)
+    return stats, fitX, fitY
+
+
+def frame_benchmark(camera, roi=None, threshold=0, n=20):
+    """
+    Prints fetch and analysis rates for a camera
+
+    Examples
+    --------
+    frame_benchmark(cam_8, roi=cam_8.roi1)
+    frame_benchmark(cam_7)
+    """
+    tFetch = np.zeros(n)
+    tStats = np.zeros(n)
+    for i in range(n):
+        t0 = time.perf_counter()
+        frame = frame_fetch(camera, roi=roi)
+        t1 = time.perf_counter()
+        frame_stats(frame, threshold=threshold)
+        tStats[i] = time.perf_counter() - t1
+        tFetch[i] = t1 - t0
+
+    print('{} frame {}x{}: fetch {:.1f} ms, stats {:.1f} ms, {:.1f} Hz'.format(
+        camera.name, frame.shape[1], frame.shape[0], 1e3*np.median(tFetch), 1e3*np.median(tStats),
+        1/np.median(tFetch + tStats)))
+
+
+def image_shift(ref, img, window=True):
+    """
+    Returns the shift (dx, dy) [px] of img relative to ref by FFT phase correlation,
+    and the correlation peak height
+
+    The peak is refined to sub-pixel precision with parabolic fits in X and Y.
+    A peak height near 1 means a clean shift, near 0 no match, e.g. when the
+    shift is a large fraction of the frame.
+
+    ref, img: 2D arrays of the same shape
+    window: Apply a Hann window against edge effects, default = True
+
+    Returns (dx, dy, peak)
+    """
+    ref = np.asarray(ref, dtype=float)
+    img = np.asarray(img, dtype=float)
+    ny, nx = ref.shape
+    ref = ref - ref.mean()
+    img = img - img.mean()
+    if window:
+        w = np.outer(np.hanning(ny), np.hanning(nx))
+        ref, img = ref*w, img*w
+
+    cross = np.fft.fft2(img) * np.conj(np.fft.fft2(ref))
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    corr = np.fft.ifft2(cross).real
+
+    iy, ix = np.unravel_index(np.argmax(corr), corr.shape)
+
+    def vertex(a, b, c):
+        d = a - 2*b + c
+        return 0.5*(a - c)/d if d < 0 else 0.0
+
+    dy = iy + vertex(corr[(iy - 1) % ny, ix], corr[iy, ix], corr[(iy + 1) % ny, ix])
+    dx = ix + vertex(corr[iy, (ix - 1) % nx], corr[iy, ix], corr[iy, (ix + 1) % nx])
+    if dy > ny/2:
+        dy -= ny
+    if dx > nx/2:
+        dx -= nx
+
+    return dx, dy, corr[iy, ix]
+
+
+frame_grabbers = {}
+
+
+class FrameGrabber:
+    """
+    Keeps the last frames of a camera in a preallocated ring buffer
+
+    Opt-in background grabber: subscribes to the ImagePlugin ArrayCounter and
+    fetches each new frame in a worker thread, cropped to box, into a numpy
+    ring buffer with frame IDs and timestamps. Plans then ask for the latest
+    frame after an ArrayCounter value without a transfer of their own. Counter updates
+    that arrive while a fetch is running are merged, so the grabber never
+    queues up behind a fast camera.
+
+    Frame IDs and timestamps are those of the ArrayCounter update that started
+    the fetch. The buffer holds at most n frames and at most maxMemory bytes.
+
+    camera: ophyd camera object, e.g. cam_8
+    roi: ROI plugin to crop to, geometry read at start(), default = None
+    box: Crop box (x0, y0, nx, ny) [px] instead of a ROI plugin, default = None (full frame)
+    n: Number of frames, default = 10
+    maxMemory: Buffer size limit [bytes], default = 200e6
+    dtype: Buffer data type, default = np.float32
+
+    Examples:
+    grabber = FrameGrabber(cam_8, roi=cam_8.roi1, n=20)
+    grabber.start()
+    frame, frameId, t = grabber.latest(after_id=cam_8.image.array_counter.get(), timeout=2)
+    grabber.stop()
+    """
+
+    def __init__(self, camera, roi=None, box=None, n=10, maxMemory=200e6, dtype=np.float32):
+        self.camera = camera
+        self.roi = roi
+        self.box = box
+        self.n = n
+        self.maxMemory = maxMemory
+        self.dtype = np.dtype(dtype)
+        self.skipped = 0
+        self.errors = 0
+        self._frames = None
+        self._ids = None
+        self._t = None
+        self._count = 0
+        self._cond = threading.Condition()
+        self._pending = threading.Event()
+        self._pendingFrame = (0, 0.0)
+        self._stop = threading.Event()
+        self._thread = None
+        self._cid = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _allocate(self):
+        self.layout = frame_layout(self.camera)
+        shape, _, colorAxis = self.layout
+        height, width = [m for i, m in enumerate(shape) if i != colorAxis]
+
+        box = roi_box(self.roi) if self.roi is not None else self.box
+        if box is None:
+            box = (0, 0, width, height)
+        x0, y0 = min(max(box[0], 0), width), min(max(box[1], 0), height)
+        nx, ny = min(box[2], width - x0), min(box[3], height - y0)
+        if nx < 1 or ny < 1:
+            raise ValueError('Crop box {} outside the {}x{} frame'.format(box, width, height))
+        self.box = (x0, y0, nx, ny)
+
+        n = min(self.n, int(self.maxMemory // (nx*ny*self.dtype.itemsize)))
+        if n < 1:
+            raise ValueError('One {}x{} frame exceeds maxMemory = {:.3g} bytes'.format(nx, ny, self.maxMemory))
+        self._frames = np.zeros((n, ny, nx), dtype=self.dtype)
+        self._ids = np.zeros(n, dtype=int)
+        self._t = np.zeros(n)
+        self._count = 0
+
+    def _on_counter(self, value, timestamp=None, **kwargs):
+        if self._pending.is_set():
+            self.skipped += 1
+        self._pendingFrame = (value, timestamp if timestamp is not None else time.time())
+        self._pending.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._pending.wait(0.2):
+                continue
+            self._pending.clear()
+            frameId, t = self._pendingFrame
+            try:
+                frame = frame_fetch(self.camera, box=self.box, layout=self.layout)
+                with self._cond:
+                    i = self._count % len(self._frames)
+                    self._frames[i] = frame
+                    self._ids[i] = frameId
+                    self._t[i] = t
+                    self._count += 1
+                    self._cond.notify_all()
+            except Exception:
+                self.errors += 1
+
+    def start(self):
+        if self.running:
+            return
+        self._allocate()
+        self._stop.clear()
+        self._pending.clear()
+        self._thread = threading.Thread(target=self._run, name=self.camera.name + '_grabber', daemon=True)
+        self._thread.start()
+        counter = self.camera.image.array_counter
+        self._cid = counter.subscribe(self._on_counter, run=False)
+
+    def stop(self):
+        if self._cid is not None:
+            self.camera.image.array_counter.unsubscribe(self._cid)
+            self._cid = None
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def latest(self, after_id=None, timeout=0):
+        """
+        Returns the latest (frame, frameId, timestamp), or None
+
+        after_id: Only return a frame with an ArrayCounter above this value, default = None
+        timeout: Wait up to timeout [s] for such a frame, default = 0
+
+        Frame IDs and the camera ArrayCounter come from the same IOC, unlike
+        the frame timestamps and the local clock, so a frame after a move is
+        selected by the counter read once the move is done.
+        """
+        def ready():
+            if self._count == 0:
+                return False
+            return after_id is None or self._ids[(self._count - 1) % len(self._frames)] > after_id
+
+        with self._cond:
+            if not self._cond.wait_for(ready, timeout):
+                return None
+            i = (self._count - 1) % len(self._frames)
+            return self._frames[i].copy(), self._ids[i], self._t[i]
+
+    def frames(self):
+        """
+        Returns copies of the buffered frames, IDs and timestamps, oldest first
+        """
+        with self._cond:
+            n = min(self._count, len(self._frames))
+            order = (np.arange(self._count - n, self._count)) % len(self._frames)
+            return self._frames[order], self._ids[order].copy(), self._t[order].copy()
+
+    def contains(self, box):
+        """
+        True if the grabber box covers box (x0, y0, nx, ny), None meaning the full frame
+        """
+        if self._frames is None:
+            return False
+        if box is None:
+            shape, _, colorAxis = self.layout
+            height, width = [m for i, m in enumerate(shape) if i != colorAxis]
+            box = (0, 0, width, height)
+        x0, y0, nx, ny = self.box
+        return (box[0] >= x0 and box[1] >= y0 and
+                box[0] + box[2] <= x0 + nx and box[1] + box[3] <= y0 + ny)
+
+    def status(self):
+        print('{}: {}, box {}, {} frames buffered of {} ({:.1f} MB), {} skipped, {} errors'.format(
+            self.camera.name, 'running' if self.running else 'stopped', self.box,
+            min(self._count, len(self._frames)) if self._frames is not None else 0,
+            len(self._frames) if self._frames is not None else 0,
+            self._frames.nbytes/1e6 if self._frames is not None else 0,
+            self.skipped, self.errors))
+
+
+def frame_grabber_start(camera, **kwargs):
+    """
+    Starts a background FrameGrabber for camera, used by camera_frame()
+
+    Keyword arguments are passed to FrameGrabber
+
+    Examples:
+    frame_grabber_start(cam_8, n=5)
+    frame_grabber_start(cam_7, roi=cam_7.roi2, maxMemory=50e6)
+    """
+    frame_grabber_stop(camera)
+    grabber = FrameGrabber(camera, **kwargs)
+    grabber.start()
+    frame_grabbers[camera.name] = grabber
+    grabber.status()
+    return grabber
+
+
+def frame_grabber_stop(camera):
+    """
+    Stops and removes the background FrameGrabber of camera
+    """
+    grabber = frame_grabbers.pop(camera.name, None)
+    if grabber is not None:
+        grabber.stop()
+
+
+def camera_frame(camera, box=None, after_id=None, timeout=2):
+    """
+    Returns a camera frame as a 2D float array cropped to box, summed over colors
+
+    Uses the buffered frame of a running grabber for camera if its box covers
+    box, waiting up to timeout [s] for a frame after ArrayCounter after_id. Otherwise,
+    or if none arrives, the frame is fetched directly.
+
+    camera: ophyd camera object, e.g. cam_8
+    box: Crop box (x0, y0, nx, ny) [px], default = None (full frame)
+    after_id: ArrayCounter value the frame has to be after, default = None
+
+    Examples:
+    img = camera_frame(cam_8)
+    img = camera_frame(cam_8, box=(500, 400, 200, 200), after_id=cam_8.image.array_counter.get())
+    """
+    grabber = frame_grabbers.get(camera.name)
+    if grabber is not None and grabber.running and grabber.contains(box):
+        latest = grabber.latest(after_id=after_id, timeout=timeout)
+        if latest is not None:
+            frame = latest[0].astype(float)
+            if box is None:
+                return frame
+            x0, y0 = box[0] - grabber.box[0], box[1] - grabber.box[1]
+            return frame[y0:y0 + box[3], x0:x0 + box[2]]
+
+    return frame_fetch(camera, box=box)
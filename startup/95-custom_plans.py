@@ -2,6 +2,7 @@ import bluesky.preprocessors as bpp
 import bluesky.plans as bp
 import bluesky.plan_stubs as bps
 import epics
+import numpy as np
 
 
 def simple_ascan(camera, stats, motor, start, end, steps):
@@ -20,7 +21,7 @@ def simple_ascan(camera, stats, motor, start, end, steps):
             motor_name = motor.name
     
     # Setup plots
-    fig, ax1 = plt.subplots()
+    fig, ax1 = figure_manager.subplots('simple_ascan')
     ax1.grid(True)
 
     # Best-Effort Callback table will interfere with LiveTable
@@ -34,11 +35,15 @@ def simple_ascan(camera, stats, motor, start, end, steps):
         bec_table_enabled = bec._table_enabled
         bec.disable_table()
         
-    @bpp.subs_decorator(LivePlot(stats_name, motor_name, ax=ax1))
-    @bpp.subs_decorator(LiveTable([motor_name, stats_name]))
+    @bpp.subs_decorator(LivePlotThrottled(stats_name, motor_name, ax=ax1))
+    @bpp.subs_decorator(LiveTableBatched([motor_name, stats_name]))
     @bpp.reset_positions_decorator([motor])
     def inner():
-        yield from bp.scan([camera], motor, start, end, steps)
+        scan = bp.scan([camera], motor, start, end, steps)
+        # Only read the plotted stats value
+        if stats:
+            scan = read_profile_wrapper(scan, camera, 'minimal', stats)
+        yield from scan
 
     yield from inner()
     
@@ -47,7 +52,8 @@ def simple_ascan(camera, stats, motor, start, end, steps):
         bec.enable_table()
         
 
-def mirror_scan(mir, start, end, steps, gap=None, speed=None, camera=None, filepath=None, filename=None):
+def mirror_scan(mir, start, end, steps, gap=None, speed=None, camera=None, filepath=None, filename=None,
+                hdf5=False):
     """Scans a slit aperture center over a mirror against a camera
 
     Parameters
@@ -92,6 +98,12 @@ def mirror_scan(mir, start, end, steps, gap=None, speed=None, camera=None, filep
             AMX: xf17id2b-ioc2
             FMX: xf17id1c-ioc2
 
+    hdf5: bool (default=False)
+        If True, stream the pictures into one compressed HDF5 file instead of
+        TIFF files. The camera needs an HDF5 plugin, e.g. camera=cam_7_hdf5.
+        In both modes the file plugin is set up directly and not staged, so
+        the files bypass databroker: no Resource/Datum documents are emitted.
+
     """
     mirrors = {
         'hfm': {
@@ -130,7 +142,11 @@ def mirror_scan(mir, start, end, steps, gap=None, speed=None, camera=None, filep
     slt_ctr     = m['slt_ctr']
     slt_gap     = m['slt_gap']
     cam         = camera.cam if camera else m['camera'].cam
-    tiff        = camera.tiff if camera else m['camera'].tiff
+    writer_cam  = camera if camera else m['camera']
+    if hdf5 and not hasattr(writer_cam, 'hdf5'):
+        print(f"{writer_cam.name} has no HDF5 plugin, use e.g. camera=cam_7_hdf5")
+        return
+    writer      = writer_cam.hdf5 if hdf5 else writer_cam.tiff
     stats       = camera.stats4 if camera else m['camera'].stats4
     encoder_idx = m['encoder_idx']
 
@@ -182,6 +198,7 @@ def mirror_scan(mir, start, end, steps, gap=None, speed=None, camera=None, filep
         def __init__(self, *args, **kwargs):
             self._last_point = 0
             self._collection_ts = None
+            self._buffers = ()
 
             self._ts = zebra.pos_capt.data.time
             self._centroid_x = stats.ts_centroid.x
@@ -194,30 +211,38 @@ def mirror_scan(mir, start, end, steps, gap=None, speed=None, camera=None, filep
 
         def kickoff(self):
             self._collection_ts = time.time()
+            self._last_point = 0
+
+            # Zebra positions count with NUM_DOWN, centroids with the time series point
+            self._buffers = (
+                ZebraCaptureBuffer({'time': self._ts, self._enc.name: self._enc},
+                                   counter=zebra.pos_capt.data.num_downloaded, size=steps),
+                ZebraCaptureBuffer({sig.name: sig for sig in (self._centroid_x, self._centroid_y)},
+                                   counter=stats.ts_current_point, size=steps),
+            )
             return zebra.kickoff()
 
         def complete(self):
             return zebra.complete()
 
-        def collect(self):
-            data = {
-                sig: sig.get(use_monitor=False) for sig in self._data_sources
-            }
-
-            timestamps = self._ts.get(use_monitor=False) + self._collection_ts
-
-            min_len = min([len(d) for d in data.values()])
-            cur_time = time.time()
+        def collect_pages(self):
+            # Read everything once the Zebra download is done
+            done = zebra.complete().done
+            for buf in self._buffers:
+                buf.update(force=done)
 
-            for i in range(self._last_point, min_len):
-                yield {
-                    'data': { sig.name: data[sig][i] for sig in data },
-                    'timestamps': { sig.name: timestamps[i] for sig in data },
-                    'time': cur_time
-                }
+            min_len = min([buf.n for buf in self._buffers], default=0)
+            if min_len <= self._last_point:
+                return
 
+            data = {}
+            for buf in self._buffers:
+                data.update(buf.arrays(self._last_point, min_len))
+            timestamps = data.pop('time') + self._collection_ts
             self._last_point = min_len
 
+            yield from zebra_event_pages(np.full(len(timestamps), time.time()), data, timestamps)
+
         def describe_collect(self):
             return {
                 'primary': {
@@ -236,11 +261,11 @@ def mirror_scan(mir, start, end, steps, gap=None, speed=None, camera=None, filep
     y2 = stats.ts_centroid.y.name
     x = getattr(zebra.pos_capt.data, f'enc{encoder_idx+1}').name
 
-    fig, ax1 = plt.subplots()
+    fig, ax1 = figure_manager.subplots('mirror_scan')
     ax2 = ax1.twinx()
 
-    lp1 = LivePlot(y1, x, ax=ax1, color='r')
-    lp2 = LivePlot(y2, x, ax=ax2, color='b')
+    lp1 = LivePlotThrottled(y1, x, ax=ax1, color='r')
+    lp2 = LivePlotThrottled(y2, x, ax=ax2, color='b')
 
     # Set axes labels after creating LivePlots
     ax1.set_title(name)
@@ -248,11 +273,17 @@ def mirror_scan(mir, start, end, steps, gap=None, speed=None, camera=None, filep
     ax1.set_ylabel('Centroid X', color='r')
     ax2.set_ylabel('Centroid Y', color='b')
 
-    @bpp.subs_decorator([lp1, lp2, LiveTable([y1, y2])])
+    # File plugin settings to restore, HDF5 also has compression and chunking
+    writerSigs = [writer.enable, writer.auto_increment, writer.file_path, writer.file_name,
+                  writer.file_template, writer.file_write_mode, writer.num_capture]
+    if hdf5:
+        writerSigs += [writer.compression, writer.zlevel, writer.num_row_chunks, writer.num_col_chunks,
+                       writer.num_frames_chunks]
+
+    @bpp.subs_decorator([lp1, lp2, LiveTableBatched([y1, y2])])
     @bpp.reset_positions_decorator([cam.acquire, cam.trigger_mode, slt_gap, #slt_ctr, <- this fails with FailedStatus
                                     stats.enable, stats.compute_centroid])
-    @bpp.reset_positions_decorator([tiff.enable, tiff.auto_increment, tiff.file_path, tiff.file_name,
-                                    tiff.file_template, tiff.file_write_mode, tiff.num_capture])
+    @bpp.reset_positions_decorator(writerSigs)
     @bpp.reset_positions_decorator([slt_ctr.velocity]) # slt_ctr.velocity has to be restored before slt_ctr
     @bpp.run_decorator()
     def inner():
@@ -263,18 +294,39 @@ def mirror_scan(mir, start, end, steps, gap=None, speed=None, camera=None, filep
             if fp[-1] != '/':
                 fp+= '/'
 
-            print("Saving files as", "".join((fp, filename, "_XXX.tif")))
-            print("First file number:", cam_8.tiff.file_number.get())
-
-            yield from bps.mv(
-                tiff.enable, 1,
-                tiff.auto_increment, 1,
-                tiff.file_path, fp,
-                tiff.file_name, filename,
-                tiff.file_template, "%s%s_%3.3d.tif",
-                tiff.file_write_mode, 1, # Capture mode
-                tiff.num_capture, steps,
-            )
+            if hdf5:
+                print("Saving frames to", "".join((fp, filename, "_XXX.h5")))
+                print("File number:", writer.file_number.get())
+
+                # One file in Stream mode, one frame per chunk
+                yield from bps.mv(
+                    writer.enable, 1,
+                    writer.auto_increment, 1,
+                    writer.file_path, fp,
+                    writer.file_name, filename,
+                    writer.file_template, "%s%s_%3.3d.h5",
+                    writer.file_write_mode, "Stream",
+                    writer.num_capture, steps,
+                    writer.compression, "zlib",
+                    writer.zlevel, 1,
+                    writer.num_row_chunks, 0,
+                    writer.num_col_chunks, 0,
+                    writer.num_frames_chunks, 1,
+                )
+                yield from bps.abs_set(writer.capture, 1)
+            else:
+                print("Saving files as", "".join((fp, filename, "_XXX.tif")))
+                print("First file number:", cam_8.tiff.file_number.get())
+
+                yield from bps.mv(
+                    writer.enable, 1,
+                    writer.auto_increment, 1,
+                    writer.file_path, fp,
+                    writer.file_name, filename,
+                    writer.file_template, "%s%s_%3.3d.tif",
+                    writer.file_write_mode, 1, # Capture mode
+                    writer.num_capture, steps,
+                )
 
         # Prepare statistics plugin
         yield from bps.mv(
@@ -311,17 +363,21 @@ def mirror_scan(mir, start, end, steps, gap=None, speed=None, camera=None, filep
         yield from bps.abs_set(slt_ctr, end + move_slack)
 
         while not st.done:
-            yield from bps.collect(flyer, stream=True)
+            yield from bps.collect(flyer)
             yield from bps.sleep(0.2)
 
         yield from bps.sleep(1)
-        yield from bps.collect(flyer, stream=True)
+        yield from bps.collect(flyer)
 
         yield from bps.mv(stats.ts_control, "Stop")
 
         # Stop the camera after the scan
         yield from bps.mv(cam.acquire, 0)   # Stop camera...
 
+        # Close the HDF5 file
+        if hdf5 and filepath is not None and filename is not None:
+            yield from bps.abs_set(writer.capture, 0)
+
     yield from inner()
 
 
@@ -347,11 +403,12 @@ def wire_scan(detector, motor, start, stop, steps, sleep_time=1):
 
         return (yield from bps.trigger_and_read(list(detectors)+[motor]))
 
-    table = LiveTable([detector, motor])
+    table = LiveTableBatched([detector, motor])
     y_name = detector.name
     if y_name == 'mercury':
         y_name += '_mca_rois_roi0_count'
-    plot = LivePlot(y_name, motor.name)
+    fig, ax = figure_manager.subplots('wire_scan')
+    plot = LivePlotThrottled(y_name, motor.name, ax=ax)
 
     @bpp.subs_decorator([table, plot])
     def inner():
@@ -362,7 +419,8 @@ def wire_scan(detector, motor, start, stop, steps, sleep_time=1):
     yield from inner()
         
     
-def focus_scan(steps, step_size=2, speed=None, cam=cam_7, filename='test', folder='/tmp/', use_roi4=False):
+def focus_scan(steps, step_size=2, speed=None, cam=cam_7, filename='test', folder='/tmp/', use_roi4=False,
+               hdf5=False):
     """ Scans a sample along Z against a camera, taking pictures in the process.
 
     Parameters
@@ -392,15 +450,26 @@ def focus_scan(steps, step_size=2, speed=None, cam=cam_7, filename='test', folde
     use_roi4: bool
         If True, temporarily set the camera ROI to the same dimensions as the ROI4
         plugin during the acquisition. Default: False
+
+    hdf5: bool
+        If True, stream all pictures into one compressed HDF5 file instead of
+        one TIFF file per picture. The camera needs an HDF5 plugin, e.g. cam_7_hdf5.
+        In both modes the file plugin is set up directly and not staged, so
+        the files bypass databroker: no Resource/Datum documents are emitted.
+        Default: False
     """
     if folder[-1] != '/':
         folder += '/'
 
+    if hdf5 and not hasattr(cam, 'hdf5'):
+        print(f"{cam.name} has no HDF5 plugin, use e.g. cam_7_hdf5")
+        return
+
     # Devices
     py = gonio.py
     pz = gonio.pz
     zebra = zebra3
-    tiff = cam.tiff
+    writer = cam.hdf5 if hdf5 else cam.tiff
     roi = cam.roi4
     cam = cam.cam
 
@@ -460,11 +529,15 @@ def focus_scan(steps, step_size=2, speed=None, cam=cam_7, filename='test', folde
         collect=[False, True, True, False]
     )
 
+    # File plugin settings to restore, HDF5 also has compression and chunking
+    writerSigs = [writer.file_write_mode, writer.num_capture, writer.auto_save, writer.auto_increment,
+                  writer.file_path, writer.file_name, writer.file_template, writer.file_number, writer.enable]
+    if hdf5:
+        writerSigs += [writer.compression, writer.zlevel, writer.num_row_chunks, writer.num_col_chunks,
+                       writer.num_frames_chunks]
+
     @bpp.reset_positions_decorator([cam.acquire, cam.trigger_mode, cam.min_x, cam.min_y,
-                                cam.size.size_x, cam.size.size_y, gonio.py, gonio.pz,
-                                tiff.file_write_mode, tiff.num_capture, tiff.auto_save,
-                                tiff.auto_increment, tiff.file_path, tiff.file_name,
-                                tiff.file_number, tiff.enable])
+                                cam.size.size_x, cam.size.size_y, gonio.py, gonio.pz] + writerSigs)
     @bpp.reset_positions_decorator([gonio.py.velocity, gonio.pz.velocity])
     @bpp.run_decorator()
     def inner():
@@ -484,19 +557,28 @@ def focus_scan(steps, step_size=2, speed=None, cam=cam_7, filename='test', folde
                 cam.size.size_y, roi.size.y.get()
             )
 
-        # Prepare TIFF Plugin
+        # Prepare TIFF or HDF5 Plugin
+        if hdf5:
+            # One file, one frame per chunk
+            yield from bps.mv(
+                writer.compression, "zlib",
+                writer.zlevel, 1,
+                writer.num_row_chunks, 0,
+                writer.num_col_chunks, 0,
+                writer.num_frames_chunks, 1)
+
         yield from bps.mv(
-            tiff.file_write_mode, "Stream",
-            tiff.num_capture, steps,
-            tiff.auto_save, 1,
-            tiff.auto_increment, 1,
-            tiff.file_path, folder,
-            tiff.file_name, filename,
-            tiff.file_template, "%s%s_%d.tif",
-            tiff.file_number, 1,
-            tiff.enable, 1)
-
-        yield from bps.abs_set(tiff.capture, 1)
+            writer.file_write_mode, "Stream",
+            writer.num_capture, steps,
+            writer.auto_save, 1,
+            writer.auto_increment, 1,
+            writer.file_path, folder,
+            writer.file_name, filename,
+            writer.file_template, "%s%s_%d.h5" if hdf5 else "%s%s_%d.tif",
+            writer.file_number, 1,
+            writer.enable, 1)
+
+        yield from bps.abs_set(writer.capture, 1)
 
         yield from bps.abs_set(cam.acquire, 1) # wait=False
 
@@ -525,7 +607,7 @@ def focus_scan(steps, step_size=2, speed=None, cam=cam_7, filename='test', folde
             gonio.pz, end_z + slack_z
         )
 
-        yield from bps.abs_set(tiff.capture, 0)
+        yield from bps.abs_set(writer.capture, 0)
 
         print(f"{cam.array_counter.get()} images captured")
 
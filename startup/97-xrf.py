@@ -1,8 +1,11 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import time
 import os
+import pandas as pd
+import bluesky.plans as bp
 import bluesky.plan_stubs as bps
+import bluesky.preprocessors as bpp
+from scipy.signal import savgol_filter
 
 
 def xrf_spectrum_read(dataDir = '/tmp', filename=0):
@@ -28,7 +31,7 @@ def xrf_spectrum_plot(xrfSpectrum, ax=0, figsizeX=9.5, figsizeY=5, label='XRF sp
     xrf_spectrum_plot(xrfSpectrum, label='Spectrum 01')
     """
     
-    if not ax: fig, ax = plt.subplots(figsize=(figsizeX,figsizeY))
+    if not ax: fig, ax = figure_manager.subplots('xrf_spectrum', figsize=(figsizeX,figsizeY))
     
     ax.plot(xrfSpectrum, label=label)
         
@@ -47,7 +50,7 @@ def xrf_file_plot(specFile, dataDir = '/tmp', ax=0, figsizeX=9.5, figsizeY=5, sh
     xrf_file_plot('20220317_01.csv', dataDir=dataDir, ax=ax, figsizeX=6)
     """
     
-    if not ax: fig, ax = plt.subplots(figsize=(figsizeX,figsizeY))
+    if not ax: fig, ax = figure_manager.subplots('xrf_file ' + specFile, figsize=(figsizeX,figsizeY))
     
     datafileName = dataDir + '/' + specFile
     xrfSpectrum = np.loadtxt(datafileName, delimiter=',', skiprows=0)
@@ -110,4 +113,155 @@ def xrf_spectrum_collect(dataDir = '/tmp', filename=0, label='XRF spectrum'):
     
     xrfSpectrum = xrf_spectrum_read(dataDir = dataDir, filename=filename)
     
-    xrf_spectrum_plot(xrfSpectrum, label=label)
\ No newline at end of file
+    xrf_spectrum_plot(xrfSpectrum, label=label)
+
+
+xrf_edge_result = None
+
+
+def _local_max(x, y, halfWidth=3):
+    """
+    Returns the position of the maximum of y(x) refined by a local quadratic fit
+    """
+    i = int(np.argmax(y))
+    i0, i1 = max(0, i - halfWidth), min(len(x), i + halfWidth + 1)
+    if i1 - i0 < 3:
+        return x[i]
+    a, b, _ = np.polyfit(x[i0:i1], y[i0:i1], 2)
+    if a >= 0:
+        return x[i]
+    return float(np.clip(-b/(2*a), x[i0], x[i1-1]))
+
+
+def xrf_edge_analyze(energy, signal, smoothPoints=7, remoteOffset=100):
+    """
+    Finds inflection and peak energies of an absorption edge scan
+
+    The normalized signal is smoothed with a Savitzky-Golay filter. The
+    inflection is the maximum of its derivative, the peak the maximum of the
+    signal above the inflection, both refined by local quadratic fits.
+
+    energy: Scan energies [eV]
+    signal: Normalized fluorescence signal
+    smoothPoints: Savitzky-Golay window [points], default = 7
+    remoteOffset: High energy remote above the inflection [eV], default = 100
+
+    Returns a dict with keys peak, inflection, remote [eV]
+    """
+    order = np.argsort(energy)
+    energy = np.asarray(energy, dtype=float)[order]
+    signal = np.asarray(signal, dtype=float)[order]
+
+    window = min(smoothPoints, len(energy) - (1 - len(energy) % 2))
+    smooth = savgol_filter(signal, window, min(3, window - 1)) if window >= 3 else signal
+    deriv = np.gradient(smooth, energy)
+
+    inflection = _local_max(energy, deriv)
+    above = energy >= inflection
+    peak = _local_max(energy[above], smooth[above])
+
+    return {'peak': peak, 'inflection': inflection, 'remote': inflection + remoteOffset,
+            'smooth': smooth, 'derivative': deriv}
+
+
+def xrf_edge_scan(start, stop, step, countTime=0.5, roi='roi0', gapTol=5.0,
+                  remoteOffset=100, smoothPoints=7, dataDir='/tmp', filename=0):
+    """
+    Absorption edge scan with the XIA Mercury ROI count normalized to BPM1
+
+    Steps the HDCM energy in small steps, with the undulator gap following the
+    ivu_gap LUT whenever its position changes by more than gapTol. Only the
+    configured Mercury ROI count is read. Inflection, peak and remote energies
+    are found with xrf_edge_analyze() and can be passed to setE().
+
+    Transition from Governor SA to XF state, scan, return to SA.
+
+    Requirements
+    ------------
+    Governor in state SA
+    Mercury ROI set to the fluorescence line of the edge
+
+    Parameters
+    ----------
+
+    start, stop, step: Energy range and step [eV]
+    countTime: Mercury real time per point [s], default = 0.5
+    roi: Mercury ROI, default = 'roi0'
+    gapTol: Largest undulator gap deviation from the LUT before the gap is moved [um], default = 5.0
+    remoteOffset: High energy remote above the inflection [eV], default = 100
+    smoothPoints: Savitzky-Golay window [points], default = 7
+    dataDir, filename: Save the scan to csv if filename is given
+
+    Returns a dict with keys peak, inflection, remote [eV] and data (DataFrame),
+    also kept in xrf_edge_result
+
+    Examples
+    --------
+
+    RE(xrf_edge_scan(12618, 12698, 1))
+    RE(xrf_edge_scan(12618, 12698, 1, countTime=1, filename='Se_edge_01.csv'))
+    RE(setE(xrf_edge_result['peak']))
+    """
+    global xrf_edge_result
+
+    if not govStatusGet('SA'):
+        print('Not in Governor state SA, exiting')
+        return
+
+    energies = np.arange(start, stop + step/2, step)
+    lut = read_lut('ivu_gap')
+    roiCount = getattr(mercury.mca.rois, roi).count
+    readAttrsOrg = mercury.read_attrs
+
+    def per_step(detectors, stepPos, pos_cache):
+        gap = np.interp(stepPos[hdcm.e], lut['Energy'], lut['Position'])
+        if abs(gap - ivu_gap.gap.user_setpoint.get()) > gapTol:
+            yield from bps.mv(ivu_gap, gap)
+        yield from bps.one_nd_step(detectors, stepPos, pos_cache)
+
+    def inner():
+        yield from bps.mv(mercury.count_time, countTime)
+        yield from bps.mv(shutter_bcu.open, 0)
+        uid = yield from bp.list_scan([mercury, bpm1, ivu_gap], hdcm.e, energies, per_step=per_step)
+        return uid
+
+    def cleanup():
+        mercury.read_attrs = readAttrsOrg
+        yield from bps.mv(shutter_bcu.close, 1)
+        govStateSet('SA')
+
+    # Transition to Governor state XF (X-ray Fluorescence)
+    govStateSet('XF')
+    mercury.read_attrs = ['mca.rois.{}.count'.format(roi)]
+    uid = yield from bpp.finalize_wrapper(inner(), cleanup())
+
+    table = db[uid].table()
+    data = pd.DataFrame({'Energy': table[hdcm.e.name].values,
+                         'Counts': table[roiCount.name].values,
+                         'BPM1': table[bpm1.sum_all.name].values})
+    data['Normalized'] = data['Counts'] / data['BPM1']
+    if filename: data.to_csv(os.path.join(dataDir, filename), index=False)
+
+    edge = xrf_edge_analyze(data['Energy'], data['Normalized'],
+                            smoothPoints=smoothPoints, remoteOffset=remoteOffset)
+
+    fig, ax = figure_manager.subplots('xrf_edge_scan')
+    ax.plot(data['Energy'], data['Normalized'], '.', label='Normalized')
+    ax.plot(np.sort(data['Energy']), edge['smooth'], label='Smoothed')
+    for key in ('inflection', 'peak', 'remote'):
+        ax.axvline(edge[key], ls='--', color='gray')
+    ax.set_xlabel('Energy [eV]')
+    ax.set_ylabel(roiCount.name + ' / BPM1')
+    ax.legend(loc=4)
+
+    print('Inflection {:.1f} eV, peak {:.1f} eV, remote {:.1f} eV'.format(
+        edge['inflection'], edge['peak'], edge['remote']))
+    log_fmx('Edge scan {}-{} eV: inflection {:.1f} eV, peak {:.1f} eV'.format(
+        start, stop, edge['inflection'], edge['peak']))
+
+    for key in ('peak', 'inflection', 'remote'):
+        print('RE(setE({:.1f}))  # {}'.format(edge[key], key))
+
+    xrf_edge_result = {'peak': edge['peak'], 'inflection': edge['inflection'],
+                       'remote': edge['remote'], 'data': data}
+    return xrf_edge_result